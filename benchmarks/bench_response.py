@@ -0,0 +1,391 @@
+"""
+Benchmark of the response-extraction hot path (get_fov_resp, get_resp_imgs, get_fov_resp_mn_md, get_dist_dff) on synthetic sessions.
+
+Each synthetic session contains chunked registered tiffs with suite2p naming (suite2p/plane0/reg_tif_chan1/file00XXX_chan1.tif)
+and a MarkPoints-style TSeries .xml protocol, which is parsed with the same functions as the photostim notebook.
+Every function is run in a separate process so that the peak RSS is measured per function. Results are stored as JSON so that runs can be compared.
+get_fov_resp_baseline is the original get_fov_resp (whole tiff files read with tifffile.imread), get_fov_resp is checked to be faster than it on every case
+(the script exits with an error otherwise).
+
+Usage:
+    python benchmarks/bench_response.py --preset small --out bench_small.json
+    python benchmarks/bench_response.py --preset small --out bench_new.json --compare bench_small.json
+"""
+
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import multiprocessing as mp
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import warnings
+import xml.etree.ElementTree as ET
+from queue import Empty
+
+import numpy as np
+import tifffile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from photostim_deve.response.io import parse_mark_points, mp_dict_to_stim_list, get_all_tiff_paths
+from photostim_deve.response.compute import get_fov_resp, get_fov_resp_mn_md, get_dist_dff
+from photostim_deve.image_analysis.compute import get_resp_imgs
+
+FRAME_PERIOD = 0.033602476
+
+# (n_frames, fov_shape, n_points, repetitions, chunk_n_frames)
+PRESETS = {
+    'tiny': [
+        dict(n_frames=600, fov_shape=(64, 64), n_points=4, repetitions=5, chunk_n_frames=250),
+    ],
+    'small': [
+        dict(n_frames=3000, fov_shape=(128, 128), n_points=10, repetitions=10, chunk_n_frames=500),
+        dict(n_frames=3000, fov_shape=(256, 256), n_points=10, repetitions=10, chunk_n_frames=500),
+        dict(n_frames=3000, fov_shape=(256, 256), n_points=40, repetitions=5, chunk_n_frames=500),
+        dict(n_frames=6000, fov_shape=(256, 256), n_points=10, repetitions=10, chunk_n_frames=1000),
+    ],
+    'full': [
+        dict(n_frames=9000, fov_shape=(512, 512), n_points=20, repetitions=10, chunk_n_frames=1000),
+        dict(n_frames=36000, fov_shape=(512, 512), n_points=45, repetitions=20, chunk_n_frames=1000),
+    ],
+}
+
+
+def make_session(session_path, n_frames=3000, fov_shape=(256, 256), n_points=10, repetitions=10, chunk_n_frames=500, compression=None, seed=0):
+    """
+    Write a synthetic photostim session: chunked registered tiffs (suite2p naming) with a response around each stimulated point and a MarkPoints-style protocol.
+
+    Parameters:
+    ----------
+    session_path : str
+        Directory of the session (created if it does not exist).
+    n_frames : int
+        Number of frames in the movie.
+    fov_shape : tuple
+        Shape of the FOV in pixels.
+    n_points : int
+        Number of stimulation points.
+    repetitions : int
+        Number of repetitions of each point.
+    chunk_n_frames : int
+        Number of frames per tiff file.
+    compression : str or None
+        Tiff compression (e. g. 'zlib'), None for uncompressed tiffs.
+    seed : int
+        Seed of the random number generator.
+
+    Returns:
+    -------
+    tiff_dir : str
+        Directory containing the registered tiffs.
+    """
+
+    rng = np.random.default_rng(seed)
+    tiff_dir = os.path.join(session_path, 'suite2p', 'plane0', 'reg_tif_chan1')
+    os.makedirs(tiff_dir, exist_ok=True)
+
+    # 1) MarkPoints protocol spread over the movie (leaving 10% at the start and end)
+    initial_delay = 0.1 * n_frames * FRAME_PERIOD * 1000
+    duration = 50
+    inter_point_delay = (0.8 * n_frames * FRAME_PERIOD * 1000) / (n_points * repetitions) - duration
+    point_xy = rng.uniform(0.1, 0.9, size=(n_points, 2))
+
+    root = ET.Element('PVMarkPointSeriesElements', Iterations='1', IterationDelay='0.00')
+    mp_elem = ET.SubElement(root, 'PVMarkPointElement', Repetitions=str(repetitions), UncagingLaser='Uncaging', UncagingLaserPower='1000')
+    galvo_elem = ET.SubElement(mp_elem, 'PVGalvoPointElement', InitialDelay=str(initial_delay), InterPointDelay=str(inter_point_delay), Duration=str(duration), SpiralRevolutions='7', AllPointsAtOnce='False', Points='Group 1', Indices=f'1-{n_points}')
+    for i in range(n_points):
+        ET.SubElement(galvo_elem, 'Point', Index=str(i+1), X=str(point_xy[i, 0]), Y=str(point_xy[i, 1]), IsSpiral='True')
+    ET.ElementTree(root).write(os.path.join(session_path, 'TSeries-bench.xml'), encoding='utf-8', xml_declaration=True)
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        _, all_frame, all_point, all_coords_x, all_coords_y = mp_dict_to_stim_list(parse_mark_points(session_path), frame_period=FRAME_PERIOD, fov_shape=fov_shape)
+
+    # 2) movie: noisy baseline plus a decaying gaussian response around the stimulated point, written one tiff file at a time
+    y_idx, x_idx = np.indices(fov_shape)
+    bsln_img = rng.uniform(500, 1500, size=fov_shape)
+
+    for chunk_on in range(0, n_frames, chunk_n_frames):
+        chunk_off = min(chunk_on + chunk_n_frames, n_frames)
+        chunk = bsln_img + rng.normal(0, 50, size=(chunk_off - chunk_on, *fov_shape))
+
+        for (stim_frame, point) in zip(all_frame.astype(int), all_point.astype(int)):
+            if stim_frame + 30 < chunk_on or stim_frame >= chunk_off:
+                continue
+            blob = 800 * np.exp(-((y_idx - all_coords_x[point]) ** 2 + (x_idx - all_coords_y[point]) ** 2) / (2 * 8 ** 2))
+            for t in range(max(stim_frame, chunk_on), min(stim_frame + 30, chunk_off)):
+                chunk[t - chunk_on] += blob * np.exp(-(t - stim_frame) / 10)
+
+        tifffile.imwrite(os.path.join(tiff_dir, f'file00{chunk_on:03d}_chan1.tif'), np.clip(chunk, 0, 4095).astype(np.int16), compression=compression)
+
+    return tiff_dir
+
+
+def get_fov_resp_baseline(all_tiff_paths, all_frame, bsln_n_frames=10, resp_n_frames=10, fov_shape=(512, 512)):
+    """
+    Original get_fov_resp: every tiff file is read whole and the windows of the stimulations it contains are averaged (reference for the speedup of get_fov_resp).
+    """
+
+    n_stim = len(all_frame)
+    fov_bsln = np.zeros((n_stim, fov_shape[0], fov_shape[1]))
+    fov_resp = np.zeros((n_stim, fov_shape[0], fov_shape[1]))
+    fov_diff = np.zeros((n_stim, fov_shape[0], fov_shape[1]))
+
+    cum_frames = 0
+    for tiff_path in all_tiff_paths:
+        tiff = tifffile.imread(tiff_path)
+        n_frames = tiff.shape[0]
+
+        for (j, stim_frame) in enumerate(all_frame):
+            if stim_frame < cum_frames or stim_frame >= cum_frames + n_frames:
+                continue
+
+            bsln_on, bsln_off = int(stim_frame - cum_frames - bsln_n_frames), int(stim_frame - cum_frames - 1)
+            resp_on, resp_off = int(stim_frame - cum_frames + 1), int(stim_frame - cum_frames + resp_n_frames)
+
+            fov_bsln[j] = np.mean(tiff[bsln_on:bsln_off], axis=0)
+            fov_resp[j] = np.mean(tiff[resp_on:resp_off], axis=0)
+            fov_diff[j] = fov_resp[j] - fov_bsln[j]
+
+        cum_frames += n_frames
+
+    return fov_bsln, fov_resp, fov_diff
+
+
+def load_session(session_path, fov_shape):
+    with contextlib.redirect_stdout(io.StringIO()):
+        _, all_frame, all_point, all_coords_x, all_coords_y = mp_dict_to_stim_list(parse_mark_points(session_path), frame_period=FRAME_PERIOD, fov_shape=fov_shape)
+
+    return all_frame.astype(int), all_point.astype(int), all_coords_x, all_coords_y
+
+
+def run_func(func_name, session_path, case, n_workers, queue):
+    """
+    Run a single function on a session (in a child process) and put (wall time, peak RSS in MB, RSS before the call in MB, n_items) in the queue.
+    """
+
+    fov_shape = tuple(case['fov_shape'])
+    all_frame, all_point, all_coords_x, all_coords_y = load_session(session_path, fov_shape)
+    all_tiff_paths = get_all_tiff_paths(os.path.join(session_path, 'suite2p', 'plane0', 'reg_tif_chan1'))
+
+    if func_name == 'get_fov_resp_mn_md':
+        fov_diff = np.load(os.path.join(session_path, 'fov_diff.npy'), mmap_mode='r')
+    elif func_name == 'get_dist_dff':
+        fov_map = np.load(os.path.join(session_path, 'fov_map.npy'))
+
+    rss_unit = 1 if sys.platform == 'darwin' else 1024 # ru_maxrss is in bytes on macOS and in kB on linux
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * rss_unit / 1e6
+
+    warnings.simplefilter('ignore', RuntimeWarning) # empty distance bins give NaN
+    with contextlib.redirect_stdout(io.StringIO()):
+        t0 = time.perf_counter()
+        if func_name == 'get_fov_resp':
+            get_fov_resp(all_tiff_paths, all_frame, fov_shape=fov_shape, n_workers=n_workers)
+            n_items = case['n_frames']
+        elif func_name == 'get_fov_resp_baseline':
+            get_fov_resp_baseline(all_tiff_paths, all_frame, fov_shape=fov_shape)
+            n_items = case['n_frames']
+        elif func_name == 'get_resp_imgs':
+            get_resp_imgs(all_tiff_paths, all_frame, all_point, fov_shape=fov_shape, frame_period=FRAME_PERIOD, n_workers=n_workers)
+            n_items = case['n_frames']
+        elif func_name == 'get_fov_resp_mn_md':
+            get_fov_resp_mn_md(fov_diff, all_point, n_workers=n_workers)
+            n_items = fov_diff.shape[0]
+        elif func_name == 'get_dist_dff':
+            get_dist_dff(fov_map, all_point, all_coords_x, all_coords_y, fov_shape=fov_shape, n_dist_bins=int(np.ceil(np.hypot(*fov_shape))))
+            n_items = fov_map.shape[0]
+        else:
+            raise ValueError(f"Unknown function {func_name}")
+        wall_time = time.perf_counter() - t0
+
+    rss_peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * rss_unit / 1e6
+
+    queue.put((wall_time, rss_peak, rss_before, n_items))
+
+
+def run_child(func_name, session_path, case, n_workers, timeout):
+    """
+    Run run_func in a child process and wait for its result for at most timeout seconds.
+
+    Returns:
+    -------
+    run : tuple or None
+        (wall time, peak RSS in MB, RSS before the call in MB, n_items), None if the child failed (exception, killed e. g. by OOM) or timed out.
+    error : str or None
+        Reason of the failure.
+    """
+
+    ctx = mp.get_context('spawn')
+    queue = ctx.Queue()
+    proc = ctx.Process(target=run_func, args=(func_name, session_path, case, n_workers, queue))
+    proc.start()
+
+    # poll so that a child that dies without a result is detected right away instead of at the timeout
+    run = None
+    deadline = time.monotonic() + timeout
+    while run is None and time.monotonic() < deadline:
+        try:
+            run = queue.get(timeout=min(1, max(deadline - time.monotonic(), 0)))
+        except Empty:
+            if not proc.is_alive():
+                try: # the result may have been flushed just before the exit
+                    run = queue.get(timeout=1)
+                except Empty:
+                    break
+
+    if run is None and proc.is_alive():
+        proc.terminate()
+        proc.join()
+        return None, f"timed out after {timeout} s"
+
+    proc.join()
+    if proc.exitcode != 0:
+        return None, f"exit code {proc.exitcode}"
+    if run is None:
+        return None, "no result"
+
+    return run, None
+
+
+def bench_case(case, work_dir, funcs, n_workers=1, n_repeats=1, compression=None, timeout=3600):
+    """
+    Generate the session for a case and benchmark every function on it.
+
+    Returns:
+    -------
+    results : list
+        One dictionary per function with the case parameters, wall time (best of n_repeats), peak RSS and items (frames, trials or points) per second.
+        Functions that failed or timed out in any run are recorded with status 'failed' and the error (and no timings).
+    """
+
+    case_str = f"f{case['n_frames']}_{case['fov_shape'][0]}x{case['fov_shape'][1]}_p{case['n_points']}_r{case['repetitions']}"
+    session_path = os.path.join(work_dir, case_str)
+    print(f"Generating session {case_str}...")
+    make_session(session_path, compression=compression, **case)
+
+    # intermediate inputs for the functions working on response maps (computed once, outside of the measurement)
+    all_frame, all_point, _, _ = load_session(session_path, tuple(case['fov_shape']))
+    with contextlib.redirect_stdout(io.StringIO()):
+        all_tiff_paths = get_all_tiff_paths(os.path.join(session_path, 'suite2p', 'plane0', 'reg_tif_chan1'))
+        _, _, fov_diff = get_fov_resp(all_tiff_paths, all_frame, fov_shape=tuple(case['fov_shape']))
+        fov_map, _ = get_fov_resp_mn_md(fov_diff, all_point, md_mode=None)
+    np.save(os.path.join(session_path, 'fov_diff.npy'), np.asarray(fov_diff))
+    np.save(os.path.join(session_path, 'fov_map.npy'), fov_map)
+
+    results = []
+    for func_name in funcs:
+        runs = []
+        error = None
+        for _ in range(n_repeats):
+            run, error = run_child(func_name, session_path, case, n_workers, timeout)
+            if error is not None:
+                break
+            runs.append(run)
+
+        if error is not None:
+            results.append(dict(case=case_str, func=func_name, n_workers=n_workers, compression=compression, **case, status='failed', error=error))
+            print(f"  {func_name:<22} FAILED ({error})")
+            continue
+
+        (wall_time, rss_peak, rss_before, n_items) = min(runs, key=lambda run: run[0])
+        result = dict(case=case_str, func=func_name, n_workers=n_workers, compression=compression, **case, status='ok',
+                      wall_time_s=wall_time, peak_rss_mb=rss_peak, rss_before_mb=rss_before, n_items=n_items, items_per_s=n_items / wall_time)
+        results.append(result)
+        print(f"  {func_name:<22} {wall_time:8.3f} s  {rss_peak:8.1f} MB peak RSS  {n_items / wall_time:10.1f} items/s")
+
+    return results
+
+
+def check_baseline(results, min_time=0.1):
+    """
+    Check that get_fov_resp is faster than get_fov_resp_baseline on every case where both ran
+    (cases where the baseline takes less than min_time seconds are only reported, their timings are dominated by noise).
+
+    Returns:
+    -------
+    slower : list
+        Cases where get_fov_resp is not faster than the baseline.
+    """
+
+    by_key = {(r['case'], r['func']): r for r in results if r.get('status') == 'ok'}
+
+    slower = []
+    for (case_str, func_name), r in by_key.items():
+        if func_name != 'get_fov_resp' or (case_str, 'get_fov_resp_baseline') not in by_key:
+            continue
+        speedup = by_key[(case_str, 'get_fov_resp_baseline')]['wall_time_s'] / r['wall_time_s']
+        r['speedup_vs_baseline'] = speedup
+        print(f"{case_str:<28} get_fov_resp speedup vs baseline: {speedup:.2f}")
+        if speedup <= 1 and by_key[(case_str, 'get_fov_resp_baseline')]['wall_time_s'] >= min_time:
+            slower.append(case_str)
+
+    return slower
+
+
+def get_meta():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = None
+
+    return dict(date=datetime.datetime.now().isoformat(), commit=commit, python=platform.python_version(), numpy=np.__version__,
+                tifffile=tifffile.__version__, platform=platform.platform(), n_cpus=os.cpu_count())
+
+
+def compare_results(results, prev_results):
+    """
+    Print the speedup of each (case, function) with respect to a previous run.
+    """
+
+    prev = {(r['case'], r['func'], r['n_workers']): r for r in prev_results}
+    print(f"\n{'case':<28} {'function':<22} {'prev (s)':>10} {'now (s)':>10} {'speedup':>8} {'RSS ratio':>10}")
+    for r in results:
+        key = (r['case'], r['func'], r['n_workers'])
+        if key not in prev or r.get('status') == 'failed' or prev[key].get('status') == 'failed':
+            continue
+        p = prev[key]
+        print(f"{r['case']:<28} {r['func']:<22} {p['wall_time_s']:10.3f} {r['wall_time_s']:10.3f} {p['wall_time_s'] / r['wall_time_s']:8.2f} {r['peak_rss_mb'] / p['peak_rss_mb']:10.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--preset', default='small', choices=list(PRESETS.keys()), help='set of synthetic sessions to benchmark')
+    parser.add_argument('--funcs', nargs='+', default=['get_fov_resp_baseline', 'get_fov_resp', 'get_resp_imgs', 'get_fov_resp_mn_md', 'get_dist_dff'], help='functions to benchmark')
+    parser.add_argument('--n_workers', type=int, default=1, help='n_workers passed to the functions that support it')
+    parser.add_argument('--n_repeats', type=int, default=1, help='number of runs per function (the fastest is reported)')
+    parser.add_argument('--timeout', type=float, default=3600, help='maximum time in seconds of a single run (the function is recorded as failed after it)')
+    parser.add_argument('--compression', default=None, help="tiff compression of the synthetic sessions (e. g. 'zlib')")
+    parser.add_argument('--work_dir', default=None, help='directory for the synthetic sessions (default is a temporary directory)')
+    parser.add_argument('--out', default='bench_response.json', help='path of the JSON file with the results')
+    parser.add_argument('--compare', default=None, help='JSON file of a previous run to compare against')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        work_dir = args.work_dir if args.work_dir is not None else tmp_dir
+
+        results = []
+        for case in PRESETS[args.preset]:
+            results.extend(bench_case(case, work_dir, args.funcs, n_workers=args.n_workers, n_repeats=args.n_repeats, compression=args.compression, timeout=args.timeout))
+
+    slower = check_baseline(results)
+
+    with open(args.out, 'w') as f:
+        json.dump(dict(meta=get_meta(), preset=args.preset, results=results), f, indent=2, default=lambda x: list(x) if isinstance(x, tuple) else str(x))
+    print(f"Saved results to {args.out}")
+
+    if args.compare is not None:
+        with open(args.compare, 'r') as f:
+            compare_results(results, json.load(f)['results'])
+
+    if len(slower) > 0:
+        sys.exit(f"get_fov_resp is not faster than the baseline on: {', '.join(slower)}")
+
+
+if __name__ == '__main__':
+    main()
@@ -2,6 +2,8 @@ import os
 import numpy as np
 import xml.etree.ElementTree as ET
 
+from photostim_deve.response.io import load_stat, get_stat_field
+
 # 1) Functions to read segmentation results from Suite2p and Cellpose
 
 def get_med_img_s2p(data_path):
@@ -33,7 +35,7 @@ def get_med_img_s2p(data_path):
 
     s2p_path = os.path.join(data_path, 'suite2p', 'plane0')
     ops = np.load(os.path.join(s2p_path, 'ops.npy'), allow_pickle=True).item()
-    stat = np.load(os.path.join(s2p_path, 'stat.npy'), allow_pickle=True)
+    stat = load_stat(s2p_path) # columnar sidecar if available (see save_stat_columns)
     iscell = np.load(os.path.join(s2p_path, 'iscell.npy'), allow_pickle=True)
     f = np.load(os.path.join(s2p_path, 'F.npy'), allow_pickle=True)
 
@@ -42,16 +44,11 @@ def get_med_img_s2p(data_path):
     print(f'Found: {sum(iscell_bool)} cells based on iscell manual curation.')
     s2p_idxs = np.arange(iscell.shape[0])[iscell_bool]
 
-    stat_iscell = []
-    meds = []
-    for i, s in enumerate(stat):
-        if iscell_bool[i]:
-            stat_iscell.append(s)
-            meds.append(s['med'])
+    meds = get_stat_field(stat, 'med')[iscell_bool]
 
     mn_image = ops['meanImg']
     
-    return np.array(meds), mn_image, s2p_idxs, ops, f
+    return meds, mn_image, s2p_idxs, ops, f
 
 
 def get_seg_img_cp(data_path):
@@ -3,9 +3,13 @@ import tifffile
 import matplotlib.pyplot as plt
 import os
 
+from concurrent.futures import ThreadPoolExecutor
+
 from photostim_deve.image_analysis.plot import plot_resp_imgs
+from photostim_deve.response.io import as_reg_movie
+from photostim_deve.response.compute import iter_window_means_chunks, alloc_stack, get_stack_diff
 
-def get_resp_imgs(all_tiff_paths, stim_frames, stim_type, frame_avg_mode='mean', bsln_dur=500, resp_dur=2000, fov_shape=(512, 512), frame_period=0.033602476, plot_debug=False): 
+def get_resp_imgs(all_tiff_paths, stim_frames, stim_type, frame_avg_mode='mean', bsln_dur=500, resp_dur=2000, fov_shape=(512, 512), frame_period=0.033602476, plot_debug=False, comp_f_mean=True, n_workers=1, dtype=np.float32, out_dir=None, diff_mode='lazy'): 
     """ 
     Extract response images for each stimulation trail by taking the mean (or median) of the fluorescence of the frames in the 'baseline' and 'response' windows. 
     It also calculates the difference between the two. 
@@ -14,8 +18,8 @@ def get_resp_imgs(all_tiff_paths, stim_frames, stim_type, frame_avg_mode='mean',
     
     Parameters: 
     ---------- 
-    all_tiff_paths : list 
-        List of paths to the registered tiff files for each trial. 
+    all_tiff_paths : list, RegTiffMovie or RegBinMovie
+        List of paths to the registered tiff files for each trial (or a RegTiffMovie / RegBinMovie, e. g. to read directly from suite2p data.bin). 
     stim_frames : list 
         List of frame indices for each stimulation. 
     stim_type : list 
@@ -32,6 +36,16 @@ def get_resp_imgs(all_tiff_paths, stim_frames, stim_type, frame_avg_mode='mean',
         Exact frame period from metadata used to convert from time to frame index. Default is 0.033602476 (for '30Hz' acquisition). 
     plot_debug : bool
         Whether to plot the mean fluorescence across all pixels for each frame with the baseline and response windows overlaid for debugging and sanity checking the synchronisation. Default is False.
+    comp_f_mean : bool
+        Whether to compute f_mean (requires reading every frame of the movie, otherwise only the frames in the baseline and response windows are read). Default is True (always True if plot_debug is True).
+    n_workers : int
+        Number of threads used to decode and reduce the tiff files concurrently. Default is 1.
+    dtype : np.dtype
+        Data type of the output arrays. Default is np.float32.
+    out_dir : str or None
+        If not None the output arrays are written to resp_bsln.npy, resp_resp.npy (and resp_diff.npy) in out_dir and returned as memory-mapped arrays. Default is None (in memory).
+    diff_mode : str or None
+        How to return resp_diff: 'lazy' (StackDiff, computed on indexing), 'array' (stored as a full array) or None. Default is 'lazy'.
         
 
     Returns: 
@@ -40,91 +54,100 @@ def get_resp_imgs(all_tiff_paths, stim_frames, stim_type, frame_avg_mode='mean',
         Array of shape (n_stim_types, n_stim_repetitions, height, width) containing the baseline images for each stimulation type and repetition. 
     resp_resp : np.ndarray
         Array of shape (n_stim_types, n_stim_repetitions, height, width) containing the response images for each stimulation type and repetition.
-    resp_diff : np.ndarray
-        Array of shape (n_stim_types, n_stim_repetitions, height, width) containing the response - baseline images for each stimulation type and repetition.
+    resp_diff : np.ndarray, StackDiff or None
+        Array of shape (n_stim_types, n_stim_repetitions, height, width) containing the response - baseline images for each stimulation type and repetition (see diff_mode).
     f_mean : np.ndarray
-        The mean fluorescence across all pixels for each frame, used for debugging and sanity checking the synchronisation.
+        The mean fluorescence across all pixels for each frame, used for debugging and sanity checking the synchronisation (None if comp_f_mean is False).
     """
 
+    if frame_avg_mode not in ['mean', 'median']:
+        raise ValueError(f"Invalid mode: {frame_avg_mode}. Mode should be 'mean' or 'median'.") 
+
+    stim_frames = np.asarray(stim_frames, dtype=int)
+    stim_type = np.asarray(stim_type)
+
     n_stim_types = len(np.unique(stim_type))
     n_stim_repetitions = len(stim_type) // n_stim_types # assuming equal number of repetitions for each stim type
     
     bsln_n_frames = int(np.ceil((bsln_dur/1000) / (frame_period))) # convert baseline duration from ms to number of frames
     resp_n_frames = int(np.ceil((resp_dur/1000) / (frame_period))) # convert response duration from ms to number of frames
 
-    resp_bsln = np.zeros((n_stim_types, n_stim_repetitions, *fov_shape))
-    resp_resp = np.zeros((n_stim_types, n_stim_repetitions, *fov_shape)) 
-    resp_diff = np.zeros((n_stim_types, n_stim_repetitions, *fov_shape))
-
-    f_mean = [] # used for debugging plot
-
-    stim_idx_count = 0 # counter to keep track of the index of the current stimulation in the original stim_frames array to use for indexing the response arrays
-
-    # 1) Loop thorough motion-corrected tiff files to extract response images
-    for (i, tiff_path) in enumerate(all_tiff_paths):
-
-        print(f'Processing tiff file: {tiff_path}')
+    resp_bsln = alloc_stack((n_stim_types, n_stim_repetitions, *fov_shape), dtype=dtype, out_dir=out_dir, name='resp_bsln')
+    resp_resp = alloc_stack((n_stim_types, n_stim_repetitions, *fov_shape), dtype=dtype, out_dir=out_dir, name='resp_resp')
+
+    # 1) Single virtual movie over the motion-corrected tiff files or suite2p binary (windows crossing into the next tiff file are read from both files)
+    movie = as_reg_movie(all_tiff_paths)
+
+    # 2) Loop through stim types (currently this only applies to photostim, since in evoked there is only one stim type) and their repetitions
+    all_trial = [] # (stim type, repetition) of each trial with valid windows
+    for j in range(n_stim_types): 
+
+        stim_type_j_frames = stim_frames[stim_type == j] # get the stim frames for the current stim type 
+
+        for k, stim_frame in enumerate(stim_type_j_frames): 
+            # add exception to skip the trial (in case the baseline window starts before the first frame) (edge case)
+            if stim_frame - bsln_n_frames < 0:
+                print(f"Skipping trial at frame {stim_frame} \nBaseline window extends beyond the start of the movie.")
+                continue
+
+            all_trial.append((j, k, stim_frame))
+
+    bsln_start = np.array([stim_frame - bsln_n_frames for (_, _, stim_frame) in all_trial], dtype=int)
+    bsln_end = np.array([stim_frame for (_, _, stim_frame) in all_trial], dtype=int)
+    resp_start = bsln_end
+    resp_end = np.minimum(bsln_end + resp_n_frames, movie.n_frames) # truncate at the end of the movie
+
+    # 3) Calculate the baseline, response and the difference
+    if frame_avg_mode == 'mean':
+        # all trials at once (each frame is read and summed only once even if windows overlap)
+        wind_on = np.stack((bsln_start, resp_start), axis=1).ravel()
+        wind_off = np.stack((bsln_end, resp_end), axis=1).ravel()
+        for (w, mn) in iter_window_means_chunks(movie, wind_on, wind_off, np.repeat(bsln_end, 2), n_workers=n_workers):
+            (j, k, _) = all_trial[w // 2]
+            resp_cond = resp_bsln if w % 2 == 0 else resp_resp # windows alternate baseline, response
+            resp_cond[j, k] = mn if mn is not None else np.nan
+
+    elif frame_avg_mode == 'median':
+        def median_trial(t):
+            (j, k, _) = all_trial[t]
+            resp_bsln[j, k] = np.median(movie[bsln_start[t]:bsln_end[t]], axis=0) 
+            resp_resp[j, k] = np.median(movie[resp_start[t]:resp_end[t]], axis=0) 
+
+        # each trial writes only to its own (stim type, repetition) entry
+        with ThreadPoolExecutor(max_workers=n_workers) as executor:
+            list(executor.map(median_trial, range(len(all_trial))))
+
+    resp_diff = get_stack_diff(resp_resp, resp_bsln, diff_mode=diff_mode, out_dir=out_dir, name='resp_diff')
+
+    # 4) Mean fluorescence across all pixels for each frame (one chunk per thread)
+    f_mean = None
+    if comp_f_mean or plot_debug:
+        def f_mean_chunk(i):
+            (chunk_on, chunk_off) = movie.chunk_bounds[i]
+            print(f'Processing frames {chunk_on}-{chunk_off} (chunk {i+1}/{len(movie.chunk_bounds)})')
+            return np.mean(movie[chunk_on:chunk_off], axis=(1, 2))
+
+        with ThreadPoolExecutor(max_workers=n_workers) as executor:
+            f_mean = np.concatenate(list(executor.map(f_mean_chunk, range(len(movie.chunk_bounds)))))
+
+    if plot_debug:
+        for (chunk_on, chunk_off) in movie.chunk_bounds:
+            for j in range(n_stim_types):
+                plt.figure(figsize=(20, 2)) 
+                plt.plot(f_mean[chunk_on:chunk_off]) # plot the mean fluorescence for the current tiff file to check for synchronisation
 
-        # Taking the current and +1th tiff file in case the stimulus time crosses into the next tiff file (due to chunking) (edge case)
-        if i != len(all_tiff_paths) - 1:
-            tiff_data = np.concatenate((tifffile.imread(tiff_path), tifffile.imread(all_tiff_paths[i+1])), axis=0) 
-            f_mean.append(np.mean(tiff_data[:tiff_data.shape[0]//2], axis=(1, 2))) # for debugging plot
-        else: 
-            tiff_data = tifffile.imread(tiff_path) 
-            f_mean.append(np.mean(tiff_data, axis=(1, 2))) # for debugging plot
+                trial_in_tiff = [(t, k) for (t, (j_t, k, stim_frame)) in enumerate(all_trial) if j_t == j and chunk_on <= stim_frame < chunk_off]
+                for (t, k) in trial_in_tiff:
+                    plt.axvline(bsln_start[t] - chunk_on, color=f'C{k}', linestyle=':')
+                    plt.axvline(resp_start[t] - chunk_on, color=f'C{k}', linestyle='--', label=f's{j}, r{k}')
+                    plt.axvline(resp_end[t] - chunk_on, color=f'C{k}', linestyle=':')
 
-        # 2) Loop through stim types (currently this only applies to photostim, since in evoked there is only one stim type) in the current tiff file
-        for j in range(n_stim_types): 
+                plt.legend(loc='upper center', ncol=len(trial_in_tiff), fontsize='small') if len(trial_in_tiff) > 0 else None
+                plt.show()
+                for (_, k) in trial_in_tiff:
+                    plot_resp_imgs(resp_bsln[j, k], resp_resp[j, k], resp_resp[j, k] - resp_bsln[j, k], j=j, l=k)
 
-            stim_type_j_frames = stim_frames[stim_type == j] # get the stim frames for the current stim type 
-            
-            # setting the bounds for stimulus times (add the bsln_nframes+1 in case the stimulus time crosses into the next tiff file (due to chunking) (edge case))
-            frame_lims = (i * tiff_data.shape[0]//2, (i+1) * tiff_data.shape[0]//2 + bsln_n_frames + 1) 
+    if movie is not all_tiff_paths: # release the tiff files opened here
+        movie.close()
 
-            stim_type_j_frames_in_tiff = stim_type_j_frames[(stim_type_j_frames >= frame_lims[0]) & (stim_type_j_frames < frame_lims[1])] # get the stim frames that are in the current tiff file 
-            stim_type_j_frames_in_tiff = stim_type_j_frames_in_tiff - frame_lims[0] # adjust the frame indices to be relative to the current tiff file (assuming each tiff file has the same number of frames except last one)
-                        
-            if plot_debug:
-                plt.figure(figsize=(20, 2)) 
-                plt.plot(f_mean[-1]) # plot the mean fluorescence for the current tiff file to check for synchronisation
-            
-            # 3) Loop through repetitions of stim type j in the current tiff file
-            for k, stim_frame in enumerate(stim_type_j_frames_in_tiff): 
-                stim_idx = stim_idx_count # get the index of the current stimulation in the original stim_frames array to use for indexing the response arrays
-                bsln_start = stim_frame - bsln_n_frames
-                bsln_end = stim_frame
-                resp_start = stim_frame
-                resp_end = stim_frame + resp_n_frames
-
-                # add exception to skip the trial (in case the stimulus time crosses into the next tiff file (due to chunking) (edge case))
-                if bsln_start < 0:
-                    print(f"Skipping trial at frame {stim_frame} \nBaseline window extends beyond the start of the tiff file. \nTrial was accounted for in the previous loop iteration (tiff file).")
-                    continue
-
-                if plot_debug:
-                    plt.axvline(bsln_start, color=f'C{k}', linestyle=':')
-                    plt.axvline(resp_start, color=f'C{k}', linestyle='--', label=f's{j}, r{k}')
-                    plt.axvline(resp_end, color=f'C{k}', linestyle=':')
-                
-                # 4) Calculate the baseline, response and the difference
-                if frame_avg_mode == 'mean':
-                    resp_bsln[j, stim_idx] = np.mean(tiff_data[bsln_start:bsln_end], axis=0)
-                    resp_resp[j, stim_idx] = np.mean(tiff_data[resp_start:resp_end], axis=0)
-                    resp_diff[j, stim_idx] = resp_resp[j, stim_idx] - resp_bsln[j, stim_idx]
-                elif frame_avg_mode == 'median':
-                    resp_bsln[j, stim_idx] = np.median(tiff_data[bsln_start:bsln_end], axis=0) 
-                    resp_resp[j, stim_idx] = np.median(tiff_data[resp_start:resp_end], axis=0) 
-                    resp_diff[j, stim_idx] = resp_resp[j, stim_idx] - resp_bsln[j, stim_idx] 
-                else: 
-                    raise ValueError(f"Invalid mode: {frame_avg_mode}. Mode should be 'mean' or 'median'.") 
-                
-                stim_idx_count += 1 # increment the stim index counter after processing each stimulation trial
-
-            if plot_debug:
-                plt.legend(loc='upper center', ncol=len(stim_type_j_frames_in_tiff), fontsize='small') if len(stim_type_j_frames_in_tiff) > 0 else None
-                plt.show()
-                for l in range(len(stim_type_j_frames_in_tiff)):
-                    plot_resp_imgs(resp_bsln[j, l], resp_resp[j, l], resp_diff[j, l], j=j, l=l)
-                    
-                    
-    return resp_bsln, resp_resp, resp_diff, np.concatenate(f_mean)
\ No newline at end of file
+    return resp_bsln, resp_resp, resp_diff, f_mean
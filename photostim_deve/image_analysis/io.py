@@ -5,6 +5,8 @@ import pandas as pd
 
 from suite2p.registration import register
 
+from photostim_deve.response.io import load_stat, StatColumns
+
 def get_all_fov_image(subject_path, session_type='_a', session_reg_idx=0,run_motcorr=True, fov_imsize=(1024, 1024), nimg_init=128, force_recompute=False):
 
     """
@@ -268,7 +270,7 @@ def get_s2p_rois_filt(session_path, filt_by='t2p', t2p_idxs_session=None, cell_p
         List of suite2p ROI indices. (used for cross-referencing with other suite2p and track2p data)
     """
 
-    stat = np.load(os.path.join(session_path, 'suite2p', 'plane0', 'stat.npy'), allow_pickle=True)
+    stat = load_stat(os.path.join(session_path, 'suite2p', 'plane0')) # columnar sidecar if available (see save_stat_columns)
     iscell = np.load(os.path.join(session_path, 'suite2p', 'plane0', 'iscell.npy'), allow_pickle=True)
     idxs = np.arange(len(stat))
 
@@ -276,27 +278,32 @@ def get_s2p_rois_filt(session_path, filt_by='t2p', t2p_idxs_session=None, cell_p
     if filt_by == 't2p':
         if t2p_idxs_session is None:
             raise ValueError("t2p_idxs_session must be provided when filt_by is 't2p'")
-        idxs_filt = np.array([i for i in idxs if i in t2p_idxs_session])
+        idxs_filt = idxs[np.isin(idxs, t2p_idxs_session)]
     elif filt_by == 'iscell_cell_prob':
         if cell_prob_thr is None:
             raise ValueError("cell_prob_thr must be provided when filt_by is 'iscell_cell_prob'")
-        idxs_filt = np.array([i for i in idxs if iscell[i, 1] >= cell_prob_thr])
+        idxs_filt = idxs[iscell[:, 1] >= cell_prob_thr]
     elif filt_by == 'iscell_manual_cur':    
-        idxs_filt = np.array([i for i in idxs if iscell[i, 0] == 1])
+        idxs_filt = idxs[iscell[:, 0] == 1]
     else:
         raise ValueError("Invalid filt_by option. Choose from 't2p', 'iscell_cell_prob', 'iscell_manual_cur'.")
     
     print(f"Number of ROIs after filtering: {len(idxs_filt)} out of {len(stat)}")
 
     # Now index the stat to only include filtered ROIs
-    stat_filt = [stat[i] for i in idxs_filt]
+    if isinstance(stat, StatColumns):
+        stat_filt = stat[idxs_filt]
+        ypix_filt, xpix_filt = stat_filt.get_ragged('ypix'), stat_filt.get_ragged('xpix')
+    else:
+        stat_filt = [stat[i] for i in idxs_filt]
+        ypix_filt, xpix_filt = [s['ypix'] for s in stat_filt], [s['xpix'] for s in stat_filt]
 
     # flip the convention to match photostim coordinates (x,y)
-    roi_s2p = [np.stack([s['ypix'], s['xpix']], axis=1) for s in stat_filt]
+    roi_s2p = [np.stack([ypix, xpix], axis=1) for (ypix, xpix) in zip(ypix_filt, xpix_filt)]
 
     # flip the convention to match photostim coordinates (x,y)
-    x_s2p_med = np.array([np.median(s['ypix']) for s in stat_filt])
-    y_s2p_med = np.array([np.median(s['xpix']) for s in stat_filt])
+    x_s2p_med = np.array([np.median(ypix) for ypix in ypix_filt])
+    y_s2p_med = np.array([np.median(xpix) for xpix in xpix_filt])
     
     roi_s2p_idxs = idxs_filt
 
@@ -1,23 +1,285 @@
-import tifffile
 import os
+import warnings
 import numpy as np
 
-from scipy.interpolate import interp1d
+from collections import deque
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
 
+from photostim_deve.response.io import as_reg_movie
+
+
+def alloc_stack(shape, dtype=np.float32, out_dir=None, name='stack'):
+    """
+    Allocate an output stack (e. g. of per-trial response images) either in memory or on disk.
+
+    Parameters:
+    ----------
+    shape : tuple
+        Shape of the stack.
+    dtype : np.dtype
+        Data type of the stack (default is np.float32).
+    out_dir : str or None
+        If None the stack is allocated in memory, otherwise it is written to out_dir/{name}.npy and returned as a memory-mapped array (np.lib.format.open_memmap),
+        so it can be reloaded later with np.load(..., mmap_mode='r').
+    name : str
+        Name of the .npy file (only used if out_dir is not None).
+
+    Returns:
+    -------
+    stack : np.ndarray or np.memmap
+        The zero-initialised stack.
+    """
+
+    if out_dir is None:
+        return np.zeros(shape, dtype=dtype)
+
+    os.makedirs(out_dir, exist_ok=True)
+    stack_path = os.path.join(out_dir, f'{name}.npy')
+    print(f"Writing {name} {shape} to {stack_path}")
+
+    return np.lib.format.open_memmap(stack_path, mode='w+', dtype=dtype, shape=tuple(shape))
+
+class StackDiff:
+
+    def __init__(self, stack_a, stack_b):
+        """
+        Lazy difference (stack_a - stack_b) of two stacks of the same shape (e. g. response - baseline).
+        Only the indexed entries are subtracted, so the difference never needs to be stored as a full third copy.
+        Supports the indexing used on the per-trial stacks (fov_diff[j], fov_diff[point_mask, :, :], ...) and np.asarray.
+
+        Parameters:
+            stack_a: array
+                stack to subtract from (e. g. fov_resp)
+            stack_b: array
+                stack to subtract (e. g. fov_bsln)
+        """
+
+        if stack_a.shape != stack_b.shape:
+            raise ValueError(f"Shapes of stacks do not match: {stack_a.shape} and {stack_b.shape}")
+
+        self.stack_a = stack_a
+        self.stack_b = stack_b
+
+        self.shape = stack_a.shape
+        self.ndim = stack_a.ndim
+        self.dtype = np.result_type(stack_a.dtype, stack_b.dtype)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        return self.stack_a[key] - self.stack_b[key]
+
+    def __array__(self, dtype=None, copy=None):
+        diff = np.subtract(self.stack_a, self.stack_b)
+        return diff.astype(dtype) if dtype is not None else diff
+
+def get_stack_diff(stack_a, stack_b, diff_mode='lazy', out_dir=None, name='diff'):
+    """
+    Get the difference between two stacks (e. g. response - baseline) according to diff_mode.
+
+    Parameters:
+    ----------
+    stack_a : np.ndarray
+        Stack to subtract from.
+    stack_b : np.ndarray
+        Stack to subtract.
+    diff_mode : str or None
+        'lazy' to return a StackDiff (computed on indexing), 'array' to compute and store the full difference (in memory or in out_dir/{name}.npy), None to skip it.
+    out_dir : str or None
+        Directory for the memory-mapped output (see alloc_stack).
+    name : str
+        Name of the .npy file (only used if out_dir is not None and diff_mode is 'array').
+
+    Returns:
+    -------
+    stack_diff : StackDiff, np.ndarray or None
+        The difference between the stacks.
+    """
+
+    if diff_mode == 'lazy':
+        return StackDiff(stack_a, stack_b)
+    elif diff_mode == 'array':
+        stack_diff = alloc_stack(stack_a.shape, dtype=stack_a.dtype, out_dir=out_dir, name=name)
+        for i in range(stack_a.shape[0]): # one entry at a time to avoid a temporary full copy
+            stack_diff[i] = stack_a[i] - stack_b[i]
+        return stack_diff
+    elif diff_mode is None:
+        return None
+    else:
+        raise ValueError(f"Invalid diff_mode: {diff_mode}. Should be 'lazy', 'array' or None.")
+
+def iter_window_means(frames, wind_on, wind_off):
+    """
+    Compute the mean frame within each window [wind_on, wind_off) of a movie in a single pass over the frames.
+    A running (prefix) sum of the frames is accumulated once and the sum within each window is read out as the difference of the prefix sums at its edges,
+    so every frame is summed at most once no matter how many windows overlap it or how long they are. Frames that are not inside any window are never read.
+
+    Parameters:
+    ----------
+    frames : np.ndarray or array-like
+        The movie (shape: (n_frames, height, width)). Anything that supports .shape and frames[a:b] slicing can be used.
+    wind_on : np.ndarray
+        Index of the first frame of each window.
+    wind_off : np.ndarray
+        Index of the frame after the last frame of each window (windows with wind_off <= wind_on are empty).
+
+    Yields:
+    -------
+    k : int
+        Index of the window.
+    wind_mn : np.ndarray or None
+        The mean frame in window k (shape: (height, width)) or None if the window is empty. Windows are yielded in the order in which they close.
+    """
+
+    wind_on = np.asarray(wind_on, dtype=int)
+    wind_off = np.asarray(wind_off, dtype=int)
+
+    valid = wind_off > wind_on
+
+    for k in np.where(~valid)[0]:
+        yield k, None
+
+    if not np.any(valid):
+        return
+
+    bounds = np.unique(np.concatenate((wind_on[valid], wind_off[valid])))
+
+    open_at = {} # windows starting at each bound
+    close_at = {} # windows ending at each bound
+    for k in np.where(valid)[0]:
+        open_at.setdefault(wind_on[k], []).append(k)
+        close_at.setdefault(wind_off[k], []).append(k)
+
+    running = np.zeros(frames.shape[1:], dtype=np.float64) # prefix sum of all frames read so far
+    snap = {} # prefix sums at the start of windows that are still open
+    snap_refs = {} # number of open windows referencing each snapshot
+    n_open = 0
+
+    for (b, bound) in enumerate(bounds):
+        # 1) close windows ending here (sum = difference of prefix sums)
+        for k in close_at.get(bound, []):
+            on = wind_on[k]
+            yield k, (running - snap[on]) / (bound - on)
+            snap_refs[on] -= 1
+            if snap_refs[on] == 0:
+                del snap[on], snap_refs[on]
+            n_open -= 1
+
+        # 2) open windows starting here (store the current prefix sum)
+        if bound in open_at:
+            snap[bound] = running.copy()
+            snap_refs[bound] = len(open_at[bound])
+            n_open += len(open_at[bound])
+
+        # 3) add the frames up to the next bound, but only if some window covers them
+        if n_open > 0 and b < len(bounds) - 1:
+            running += np.sum(frames[bound:bounds[b+1]], axis=0, dtype=np.float64)
+
+def iter_window_means_chunks(movie, wind_on, wind_off, wind_frame, n_workers=1, wind_batch=16):
+    """
+    Same as iter_window_means, but the windows are split by the tiff file (chunk) that contains their reference frame (e. g. the stimulation frame)
+    and the chunks are decoded and reduced concurrently in a thread pool (tifffile decoding and the numpy reductions release the GIL).
+    Each worker owns the windows of its chunk (frames of windows that cross into a neighbouring chunk are read by the owning worker) and results are yielded in chunk order.
+    The windows of a chunk are reduced wind_batch at a time and at most 2 * n_workers batches are in flight, so at most 2 * n_workers * wind_batch mean frames are held
+    at once no matter how many windows a chunk contains (the serial path streams the means one by one).
+
+    Parameters:
+    ----------
+    movie : RegTiffMovie, RegBinMovie or np.ndarray
+        The movie (shape: (n_frames, height, width)). If it has no chunk_bounds attribute it is treated as a single chunk.
+    wind_on : np.ndarray
+        Index of the first frame of each window.
+    wind_off : np.ndarray
+        Index of the frame after the last frame of each window.
+    wind_frame : np.ndarray
+        Reference frame of each window used to assign it to a chunk.
+    n_workers : int
+        Number of threads (default is 1, e. g. serial).
+    wind_batch : int
+        Maximum number of windows reduced by a worker at once (default is 16).
+
+    Yields:
+    -------
+    k : int
+        Index of the window.
+    wind_mn : np.ndarray or None
+        The mean frame in window k or None if the window is empty.
+    """
+
+    wind_on = np.asarray(wind_on, dtype=int)
+    wind_off = np.asarray(wind_off, dtype=int)
+    wind_frame = np.asarray(wind_frame, dtype=int)
+
+    chunk_bounds = getattr(movie, 'chunk_bounds', [(0, movie.shape[0])])
+    chunk_start = np.array([chunk_on for (chunk_on, _) in chunk_bounds], dtype=int)
+    wind_chunk = np.clip(np.searchsorted(chunk_start, wind_frame, side='right') - 1, 0, len(chunk_bounds) - 1)
+
+    chunk_wind = [np.where(wind_chunk == i)[0] for i in range(len(chunk_bounds))]
+    batch_wind = [wind_idxs[batch_on:batch_on + wind_batch] for wind_idxs in chunk_wind for batch_on in range(0, len(wind_idxs), wind_batch)]
+
+    def iter_batch(wind_idxs):
+        for (k, mn) in iter_window_means(movie, wind_on[wind_idxs], wind_off[wind_idxs]):
+            yield wind_idxs[k], mn
+
+    def reduce_batch(wind_idxs):
+        return list(iter_batch(wind_idxs))
+
+    if n_workers == 1:
+        for wind_idxs in batch_wind:
+            yield from iter_batch(wind_idxs)
+        return
+
+    # keep at most 2 * n_workers batches in flight so that finished batches waiting for an earlier one stay bounded
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        futures = deque()
+        for wind_idxs in batch_wind:
+            futures.append(executor.submit(reduce_batch, wind_idxs))
+            if len(futures) >= 2 * n_workers:
+                yield from futures.popleft().result()
+
+        while len(futures) > 0:
+            yield from futures.popleft().result()
+
+def get_window_means(frames, wind_on, wind_off):
+    """
+    Compute the mean frame within each window [wind_on, wind_off) of a movie (see iter_window_means).
+
+    Parameters:
+    ----------
+    frames : np.ndarray or array-like
+        The movie (shape: (n_frames, height, width)).
+    wind_on : np.ndarray
+        Index of the first frame of each window.
+    wind_off : np.ndarray
+        Index of the frame after the last frame of each window.
+
+    Returns:
+    -------
+    wind_mn : np.ndarray
+        The mean frame in each window (shape: (n_wind, height, width)). Empty windows are NaN (as for np.mean of an empty slice).
+    """
+
+    wind_mn = np.zeros((len(wind_on), *frames.shape[1:]))
+
+    for (k, mn) in iter_window_means(frames, wind_on, wind_off):
+        wind_mn[k] = mn if mn is not None else np.nan
+
+    return wind_mn
 
 # IMPORTANT: For now excluding the stimulation frame itself
-# IMPORTANT: Deal with the edge case where the stimulation frame is at the beginning or end of the tiff file
-# IMPORTANT: Figure out what is causing the mean of empty slice error (catch the RuntimeWarning)
+# NOTE: Windows crossing the boundary between two tiff files are read from both files (RegTiffMovie), windows crossing the start/end of the movie are truncated
 # USE THIS TO DEBUG: warnings.filterwarnings('error')
-def get_fov_resp(all_tiff_paths, all_frame, bsln_n_frames=10, resp_n_frames=10, fov_shape=(512, 512)):
+def get_fov_resp(all_tiff_paths, all_frame, bsln_n_frames=10, resp_n_frames=10, fov_shape=(512, 512), n_workers=1, dtype=np.float32, out_dir=None, diff_mode='lazy'):
     """
     IMPORTANT!!! THIS FUNCTION IS DEPRECATED (replace with the function in photostim_deve.image_analysis.compute)!!!
     Load the tiff files and extract the mean fluorescence in the baseline and response windows for each stimulation.
 
     Parameters:
     ----------
-    all_tiff_paths : list
-        A list of paths to the tiff files containing the fluorescence data.
+    all_tiff_paths : list, RegTiffMovie or RegBinMovie
+        A list of paths to the tiff files containing the fluorescence data (or a RegTiffMovie / RegBinMovie, e. g. to read directly from suite2p data.bin).
     all_frame : list
         A list of frame indices of stimulation (each entry is a single trial of a single point).
     bsln_n_frames : int
@@ -26,8 +288,16 @@ def get_fov_resp(all_tiff_paths, all_frame, bsln_n_frames=10, resp_n_frames=10,
         The number of frames after the stimulation to use for the response window (default is 10).
     fov_shape : tuple
         The shape of the FOV in pixels (default is (512, 512)).
-    comp_fov_dyn: tuple
-        If to compute the 'dynamics' of the average response (e. g. each frame of the stim window not just before and after)
+    n_workers : int
+        Number of threads used to decode and reduce the tiff files concurrently (default is 1).
+    dtype : np.dtype
+        Data type of the output stacks (default is np.float32).
+    out_dir : str or None
+        If not None the output stacks are written to fov_bsln.npy, fov_resp.npy (and fov_diff.npy) in out_dir and returned as memory-mapped arrays (default is None, e. g. in memory).
+    diff_mode : str or None
+        How to return fov_diff: 'lazy' (StackDiff, computed on indexing), 'array' (stored as a full stack) or None (default is 'lazy').
+
+    For the 'dynamics' of the average response (e. g. each frame of the stim window not just before and after, previously 'comp_fov_dyn') see get_fov_resp_dyn.
         
     Returns:
     -------
@@ -35,46 +305,404 @@ def get_fov_resp(all_tiff_paths, all_frame, bsln_n_frames=10, resp_n_frames=10,
         A 2D array of the mean fluorescence in the baseline window for each stimulation point (shape: (n_stim, fov_shape[0], fov_shape[1])).
     fov_resp : np.ndarray
         A 2D array of the mean fluorescence in the response window for each stimulation point (shape: (n_stim, fov_shape[0], fov_shape[1])).
-    fov_diff : np.ndarray
-        A 2D array of the difference between the two (response - baseline)
+    fov_diff : np.ndarray, StackDiff or None
+        A 2D array of the difference between the two (response - baseline), see diff_mode.
     """
 
+    movie = as_reg_movie(all_tiff_paths)
+    print(f"Loaded registered movie with {movie.n_frames} frames ({len(movie.chunk_bounds)} chunks)")
+
+    all_frame = np.asarray(all_frame, dtype=int)
     n_stim = len(all_frame)
 
-    fov_bsln = np.zeros((n_stim, fov_shape[0], fov_shape[1]))
-    fov_resp = np.zeros((n_stim, fov_shape[0], fov_shape[1]))
-    fov_diff = np.zeros((n_stim, fov_shape[0], fov_shape[1])) # difference between response and baseline
+    fov_bsln = alloc_stack((n_stim, fov_shape[0], fov_shape[1]), dtype=dtype, out_dir=out_dir, name='fov_bsln')
+    fov_resp = alloc_stack((n_stim, fov_shape[0], fov_shape[1]), dtype=dtype, out_dir=out_dir, name='fov_resp')
 
-    cum_frames = 0 # cumulative frames loaded so far (to get correct offset for each trial)
-    
-    for i, tiff_path in enumerate(all_tiff_paths):
-        print(f"Loading tiff file {i+1}/{len(all_tiff_paths)}: {tiff_path}")
-        tiff = tifffile.imread(tiff_path)
-        # tiff = tiff / uint12_max * 255
-        # tiff = tiff.astype(np.uint8)
-        
-        n_frames = tiff.shape[0]
-        
-        for (j, stim_frame) in enumerate(all_frame):
-            if stim_frame < cum_frames or stim_frame >= cum_frames + n_frames:
-                continue
-            
-            bsln_on = int(stim_frame - cum_frames - bsln_n_frames)
-            bsln_off = int(stim_frame - cum_frames - 1) # excluding the stimulation frame
+    # 1) baseline and response windows in global frame indices (truncated at the start/end of the movie)
+    bsln_on = np.clip(all_frame - bsln_n_frames, 0, movie.n_frames)
+    bsln_off = np.clip(all_frame - 1, 0, movie.n_frames) # excluding the stimulation frame
+
+    resp_on = np.clip(all_frame + 1, 0, movie.n_frames) # excluding the stimulation frame
+    resp_off = np.clip(all_frame + resp_n_frames, 0, movie.n_frames)
 
-            resp_on = int(stim_frame - cum_frames + 1) # excluding the stimulation frame
-            resp_off = int(stim_frame - cum_frames + resp_n_frames)
-            print(f'Processing stim: {j} resp_onset: {resp_on}, resp_offset: {resp_off}, bsln_offset: {bsln_off}, bsln_onset: {bsln_on}')
+    # 2) compute the mean in all windows in a single pass (only frames inside a window are read), tiff files are processed by n_workers threads
+    wind_on = np.stack((bsln_on, resp_on), axis=1).ravel()
+    wind_off = np.stack((bsln_off, resp_off), axis=1).ravel()
+    for (k, mn) in iter_window_means_chunks(movie, wind_on, wind_off, np.repeat(all_frame, 2), n_workers=n_workers):
+        fov_cond = fov_bsln if k % 2 == 0 else fov_resp # windows alternate baseline, response
+        fov_cond[k // 2, :, :] = mn if mn is not None else np.nan
 
-            fov_bsln[j, :, :] = np.mean(tiff[bsln_on:bsln_off, :, :], axis=0)
-            fov_resp[j, :, :] = np.mean(tiff[resp_on:resp_off, :, :], axis=0)
-            fov_diff[j, :, :] = fov_resp[j, :, :] - fov_bsln[j, :, :]
+    fov_diff = get_stack_diff(fov_resp, fov_bsln, diff_mode=diff_mode, out_dir=out_dir, name='fov_diff') # difference between response and baseline
 
-        cum_frames += n_frames
+    if movie is not all_tiff_paths: # release the tiff files opened here
+        movie.close()
 
     return fov_bsln, fov_resp, fov_diff
 
-def get_fov_resp_mn_md(fov_cond, all_point):
+def iter_movie_blocks(movie, frame_ranges, block_n_frames=64, n_workers=1):
+    """
+    Read the frames of a movie in the given ranges block by block, with up to 2 * n_workers blocks read ahead in a thread pool (blocks are yielded in order).
+
+    Parameters:
+    ----------
+    movie : RegTiffMovie, RegBinMovie or np.ndarray
+        The movie (shape: (n_frames, height, width)).
+    frame_ranges : list
+        List of (first frame, frame after the last frame) ranges to read.
+    block_n_frames : int
+        Maximum number of frames per block (default is 64).
+    n_workers : int
+        Number of threads reading ahead (default is 1, e. g. no read-ahead).
+
+    Yields:
+    -------
+    block_on : int
+        Index of the first frame of the block.
+    block_off : int
+        Index of the frame after the last frame of the block.
+    block : np.ndarray
+        The frames of the block (shape: (block_off - block_on, height, width)).
+    """
+
+    blocks = [(on, min(on + block_n_frames, off)) for (range_on, off) in frame_ranges for on in range(range_on, off, block_n_frames)]
+
+    if n_workers == 1:
+        for (block_on, block_off) in blocks:
+            yield block_on, block_off, movie[block_on:block_off]
+        return
+
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        futures = deque()
+        for (block_on, block_off) in blocks:
+            futures.append((block_on, block_off, executor.submit(lambda on, off: np.asarray(movie[on:off]), block_on, block_off)))
+            if len(futures) >= 2 * n_workers:
+                (on, off, future) = futures.popleft()
+                yield on, off, future.result()
+
+        while len(futures) > 0:
+            (on, off, future) = futures.popleft()
+            yield on, off, future.result()
+
+def get_fov_resp_dyn(all_tiff_paths, all_frame, all_point, n_pre=10, n_post=30, fov_shape=(512, 512), block_n_frames=64, n_workers=1, dtype=np.float32, out_dir=None):
+    """
+    Get the dynamics of the average response of each point frame by frame (peri-stimulus movies), e. g. to look at the spatial spread of the response over time.
+    The frames around the stimulations are read once, in order, and each block of frames is added (as a view) to the running sum of every trial window it overlaps,
+    so per-trial windows are never stacked and memory scales with n_points * (n_pre + n_post) frames.
+
+    Parameters:
+    ----------
+    all_tiff_paths : list, RegTiffMovie or RegBinMovie
+        A list of paths to the tiff files containing the fluorescence data (or a RegTiffMovie / RegBinMovie, e. g. to read directly from suite2p data.bin).
+    all_frame : list
+        A list of frame indices of stimulation (each entry is a single trial of a single point).
+    all_point : list
+        A list of indices of the stimulated points corresponding to each stimulation.
+    n_pre : int
+        Number of frames before the stimulation frame (default is 10).
+    n_post : int
+        Number of frames from the stimulation frame on (including it, default is 30).
+    fov_shape : tuple
+        The shape of the FOV in pixels (default is (512, 512)).
+    block_n_frames : int
+        Number of frames read at once (default is 64).
+    n_workers : int
+        Number of threads reading blocks ahead (default is 1).
+    dtype : np.dtype
+        Data type of the output (default is np.float32).
+    out_dir : str or None
+        If not None the output is written to out_dir/fov_dyn.npy and returned as a memory-mapped array (see alloc_stack).
+
+    Returns:
+    -------
+    fov_dyn : np.ndarray
+        The average movie around the stimulation for each point (shape: (n_points, n_pre + n_post, fov_shape[0], fov_shape[1])). Index n_pre is the stimulation frame.
+        Frames outside of the movie are excluded from the average (NaN if no trial contributes).
+    fov_dyn_n : np.ndarray
+        The number of trials contributing to each frame of the average movie of each point (shape: (n_points, n_pre + n_post)).
+    """
+
+    movie = as_reg_movie(all_tiff_paths)
+    print(f"Loaded registered movie with {movie.n_frames} frames ({len(movie.chunk_bounds)} chunks)")
+
+    all_frame = np.asarray(all_frame, dtype=int)
+    unique_point, point_idx = np.unique(all_point, return_inverse=True)
+
+    fov_dyn = alloc_stack((len(unique_point), n_pre + n_post, fov_shape[0], fov_shape[1]), dtype=dtype, out_dir=out_dir, name='fov_dyn')
+    fov_dyn_n = np.zeros((len(unique_point), n_pre + n_post), dtype=int)
+
+    # 1) peri-stimulus windows and the (merged) frame ranges they cover
+    wind_on = all_frame - n_pre
+    wind_off = all_frame + n_post
+
+    frame_ranges = []
+    for j in np.argsort(wind_on):
+        (on, off) = (max(wind_on[j], 0), min(wind_off[j], movie.n_frames))
+        if on >= off:
+            continue
+        if len(frame_ranges) > 0 and on <= frame_ranges[-1][1]:
+            frame_ranges[-1] = (frame_ranges[-1][0], max(frame_ranges[-1][1], off))
+        else:
+            frame_ranges.append((on, off))
+
+    # 2) single pass over the covered frames: add each block to the overlapping part of every trial window
+    for (block_on, block_off, block) in iter_movie_blocks(movie, frame_ranges, block_n_frames=block_n_frames, n_workers=n_workers):
+        for j in np.where((wind_on < block_off) & (wind_off > block_on))[0]:
+            (t0, t1) = (max(block_on, wind_on[j]), min(block_off, wind_off[j]))
+            fov_dyn[point_idx[j], t0-wind_on[j]:t1-wind_on[j]] += block[t0-block_on:t1-block_on]
+            fov_dyn_n[point_idx[j], t0-wind_on[j]:t1-wind_on[j]] += 1
+
+    # 3) sums to averages (one point at a time to avoid a temporary copy of the full output)
+    for p in range(len(unique_point)):
+        n = fov_dyn_n[p][:, None, None]
+        fov_dyn[p] = np.divide(fov_dyn[p], n, out=np.full(fov_dyn.shape[1:], np.nan, dtype=dtype), where=n > 0)
+
+    if movie is not all_tiff_paths: # release the tiff files opened here
+        movie.close()
+
+    return fov_dyn, fov_dyn_n
+
+class PointStats:
+
+    def __init__(self, n_points, fov_shape=(512, 512)):
+        """
+        Online (streaming) per-point statistics of response images: running mean and variance (Welford) and the number of trials for each pixel.
+        NaN pixels of a trial are ignored (as in np.nanmean / np.nanvar), so trials never need to be stacked.
+
+        Parameters:
+            n_points: int
+                number of stimulation points
+            fov_shape: tuple
+                shape of the FOV in pixels
+        """
+
+        self.n_points = n_points
+        self.fov_shape = tuple(fov_shape)
+
+        self.count = np.zeros((n_points, *self.fov_shape), dtype=np.int32)
+        self.mean = np.zeros((n_points, *self.fov_shape), dtype=np.float64)
+        self.m2 = np.zeros((n_points, *self.fov_shape), dtype=np.float64) # sum of squared deviations from the mean
+
+    def update(self, point, img):
+        """
+        Fold the image of a single trial into the statistics of its point.
+
+        Parameters:
+            point: int
+                index of the point (0 to n_points - 1)
+            img: array (height x width)
+                response image of the trial (NaN pixels are skipped)
+        """
+
+        valid = ~np.isnan(img)
+        self.count[point] += valid
+
+        delta = np.where(valid, img - self.mean[point], 0)
+        self.mean[point] += np.divide(delta, self.count[point], out=np.zeros(self.fov_shape), where=valid)
+        self.m2[point] += np.where(valid, delta * (img - self.mean[point]), 0)
+
+    def get_mean(self):
+        """
+        Returns:
+            mn: array (n_points x height x width)
+                mean across trials for each point (NaN where no valid trials)
+        """
+
+        return np.where(self.count > 0, self.mean, np.nan)
+
+    def get_var(self, ddof=0):
+        """
+        Parameters:
+            ddof: int
+                delta degrees of freedom (default is 0, as np.nanvar)
+
+        Returns:
+            var: array (n_points x height x width)
+                variance across trials for each point (NaN where count <= ddof)
+        """
+
+        n = self.count - ddof
+        return np.divide(self.m2, n, out=np.full(self.m2.shape, np.nan), where=n > 0)
+
+def get_fov_resp_point_stats(all_tiff_paths, all_frame, all_point, bsln_n_frames=10, resp_n_frames=10, fov_shape=(512, 512), n_workers=1, keep_trials=False, dtype=np.float32, out_dir=None):
+    """
+    Fused (streaming) version of get_fov_resp followed by get_fov_resp_mn_md: the difference image (response - baseline) of each trial is folded into
+    per-point running statistics (PointStats) as soon as both of its windows are computed, so peak memory scales with the number of points instead of the number of trials.
+    The windows are the same as in get_fov_resp.
+
+    Parameters:
+    ----------
+    all_tiff_paths : list, RegTiffMovie or RegBinMovie
+        A list of paths to the tiff files containing the fluorescence data (or a RegTiffMovie / RegBinMovie, e. g. to read directly from suite2p data.bin).
+    all_frame : list
+        A list of frame indices of stimulation (each entry is a single trial of a single point).
+    all_point : list
+        A list of indices of the stimulated points corresponding to each stimulation.
+    bsln_n_frames : int
+        The number of frames before the stimulation to use for the baseline window (default is 10).
+    resp_n_frames : int
+        The number of frames after the stimulation to use for the response window (default is 10).
+    fov_shape : tuple
+        The shape of the FOV in pixels (default is (512, 512)).
+    n_workers : int
+        Number of threads used to decode and reduce the tiff files concurrently (default is 1).
+    keep_trials : bool
+        If to also keep the per-trial difference images (default is False).
+    dtype : np.dtype
+        Data type of the per-trial stack (only used if keep_trials is True, default is np.float32).
+    out_dir : str or None
+        If not None the per-trial stack is written to out_dir/fov_diff.npy (see alloc_stack).
+
+    Returns:
+    -------
+    fov_map : np.ndarray
+        The mean difference image across trials for each point (shape: (n_points, fov_shape[0], fov_shape[1])), as fov_cond_mn of get_fov_resp_mn_md.
+    fov_map_var : np.ndarray
+        The variance across trials for each point and pixel (shape: (n_points, fov_shape[0], fov_shape[1])).
+    fov_map_n : np.ndarray
+        The number of (non-NaN) trials for each point and pixel (shape: (n_points, fov_shape[0], fov_shape[1])).
+    fov_diff : np.ndarray or None
+        The per-trial difference images (shape: (n_stim, fov_shape[0], fov_shape[1])) if keep_trials is True, otherwise None.
+    """
+
+    movie = as_reg_movie(all_tiff_paths)
+    print(f"Loaded registered movie with {movie.n_frames} frames ({len(movie.chunk_bounds)} chunks)")
+
+    all_frame = np.asarray(all_frame, dtype=int)
+    unique_point, point_idx = np.unique(all_point, return_inverse=True)
+    n_stim = len(all_frame)
+
+    point_stats = PointStats(len(unique_point), fov_shape=fov_shape)
+    fov_diff = alloc_stack((n_stim, fov_shape[0], fov_shape[1]), dtype=dtype, out_dir=out_dir, name='fov_diff') if keep_trials else None
+
+    # 1) baseline and response windows in global frame indices (as in get_fov_resp)
+    bsln_on = np.clip(all_frame - bsln_n_frames, 0, movie.n_frames)
+    bsln_off = np.clip(all_frame - 1, 0, movie.n_frames) # excluding the stimulation frame
+
+    resp_on = np.clip(all_frame + 1, 0, movie.n_frames) # excluding the stimulation frame
+    resp_off = np.clip(all_frame + resp_n_frames, 0, movie.n_frames)
+
+    wind_on = np.stack((bsln_on, resp_on), axis=1).ravel()
+    wind_off = np.stack((bsln_off, resp_off), axis=1).ravel()
+
+    # 2) fold each trial into the statistics of its point as soon as both of its windows are done (chunks are reduced in order, so the result is deterministic)
+    pending = {} # windows of trials that are not complete yet
+    for (k, mn) in iter_window_means_chunks(movie, wind_on, wind_off, np.repeat(all_frame, 2), n_workers=n_workers):
+        j = k // 2
+        mn = mn if mn is not None else np.full(fov_shape, np.nan)
+
+        if j not in pending:
+            pending[j] = (k, mn)
+            continue
+
+        (k_other, mn_other) = pending.pop(j)
+        (fov_bsln_j, fov_resp_j) = (mn, mn_other) if k % 2 == 0 else (mn_other, mn)
+        fov_diff_j = fov_resp_j - fov_bsln_j
+
+        point_stats.update(point_idx[j], fov_diff_j)
+        if keep_trials:
+            fov_diff[j] = fov_diff_j
+
+    if movie is not all_tiff_paths: # release the tiff files opened here
+        movie.close()
+
+    return point_stats.get_mean(), point_stats.get_var(), point_stats.count, fov_diff
+
+def get_median_tiled(stack, tile_rows=64):
+    """
+    Exact median across the first axis of a stack of images (e. g. trials), computed in float32 tiles of rows with np.partition (selection instead of a full sort).
+    Tiles without NaNs skip the NaN handling of np.nanmedian, tiles containing NaNs fall back to it.
+
+    Parameters:
+    ----------
+    stack : np.ndarray
+        Stack of images (shape: (n, height, width)).
+    tile_rows : int
+        Number of image rows per tile (default is 64).
+
+    Returns:
+    -------
+    stack_md : np.ndarray
+        The median image (shape: (height, width)), NaN-aware as np.nanmedian.
+    """
+
+    n = stack.shape[0]
+    stack_md = np.full(stack.shape[1:], np.nan, dtype=np.float32)
+
+    if n == 0:
+        return stack_md
+
+    kth = [n // 2 - 1, n // 2] if n % 2 == 0 else [n // 2]
+
+    for r0 in range(0, stack.shape[1], tile_rows):
+        tile = np.asarray(stack[:, r0:r0+tile_rows], dtype=np.float32)
+
+        if np.isnan(tile).any():
+            stack_md[r0:r0+tile_rows] = np.nanmedian(tile, axis=0)
+            continue
+
+        tile = np.partition(tile, kth, axis=0)
+        stack_md[r0:r0+tile_rows] = np.mean(tile[kth], axis=0)
+
+    return stack_md
+
+def get_median_hist(stack, n_bins=256, tile_rows=64):
+    """
+    Approximate median across the first axis of a stack of images from a per-pixel histogram (for quick-look runs).
+    Each pixel's values are quantised into n_bins equal bins between their min and max and the bins holding the two middle values are found by bisection
+    on the cumulative histogram (log2(n_bins) passes over the bin codes instead of a sort). The median is the mean of the two bin centres,
+    so the error is at most half a bin width ((max - min) / (2 * n_bins)).
+
+    Parameters:
+    ----------
+    stack : np.ndarray
+        Stack of images (shape: (n, height, width)).
+    n_bins : int
+        Number of histogram bins per pixel (default is 256).
+    tile_rows : int
+        Number of image rows per tile (default is 64).
+
+    Returns:
+    -------
+    stack_md : np.ndarray
+        The approximate median image (shape: (height, width)), NaN where all values are NaN.
+    """
+
+    stack_md = np.full(stack.shape[1:], np.nan, dtype=np.float32)
+
+    if stack.shape[0] == 0:
+        return stack_md
+
+    for r0 in range(0, stack.shape[1], tile_rows):
+        tile = np.asarray(stack[:, r0:r0+tile_rows], dtype=np.float32)
+
+        valid = ~np.isnan(tile)
+        n_valid = valid.sum(axis=0)
+        lo = np.min(np.where(valid, tile, np.inf), axis=0)
+        hi = np.max(np.where(valid, tile, -np.inf), axis=0)
+        width = np.where(hi > lo, (hi - lo) / n_bins, 1)
+
+        # 1) quantise to bin codes (NaNs go above the last bin so they are never counted)
+        bin_code = np.clip(np.where(valid, (tile - lo) / width, 0).astype(int), 0, n_bins - 1)
+        bin_code[~valid] = n_bins
+
+        # 2) bisection for the first bin where the cumulative count reaches the rank of each middle value
+        md_bin = []
+        for rank in [(n_valid + 1) // 2, n_valid // 2 + 1]:
+            b_lo = np.zeros(n_valid.shape, dtype=int)
+            b_hi = np.full(n_valid.shape, n_bins - 1, dtype=int)
+            while np.any(b_lo < b_hi):
+                b_mid = (b_lo + b_hi) // 2
+                reached = np.sum(bin_code <= b_mid, axis=0) >= rank
+                b_hi = np.where(reached, b_mid, b_hi)
+                b_lo = np.where(reached, b_lo, b_mid + 1)
+            md_bin.append(b_lo)
+
+        tile_md = np.where(hi > lo, lo + ((md_bin[0] + md_bin[1]) / 2 + 0.5) * width, lo)
+        stack_md[r0:r0+tile_rows] = np.where(n_valid > 0, tile_md, np.nan)
+
+    return stack_md
+
+def get_fov_resp_mn_md(fov_cond, all_point, md_mode='exact', n_workers=1, tile_rows=64, n_hist_bins=256):
     """
     Get the mean fluorescence response for each point across all trials.
 
@@ -85,114 +713,1105 @@ def get_fov_resp_mn_md(fov_cond, all_point):
         Can be either baseline, response or difference (response - baseline).
     all_point : list
         A list of indices of the stimulated points corresponding to each stimulation.
+    md_mode : str or None
+        How to compute the median: 'exact' (float32 tiles with np.partition, see get_median_tiled), 'approx' (per-pixel histogram, see get_median_hist)
+        or None to skip the median (default is 'exact').
+    n_workers : int
+        Number of threads used to process the points in parallel (default is 1).
+    tile_rows : int
+        Number of image rows per tile for the median (default is 64).
+    n_hist_bins : int
+        Number of histogram bins per pixel for md_mode='approx' (default is 256).
     Returns:
     -------
     fov_cond_mn : np.ndarray
         A 3D array of the mean across all points for the given condition (shape: (len(unique_point), fov_shape[0], fov_shape[1])).
+    fov_cond_md : np.ndarray or None
+        A 3D array of the median across all points for the given condition (shape: (len(unique_point), fov_shape[0], fov_shape[1])).
     
     """
     
+    if md_mode not in ['exact', 'approx', None]:
+        raise ValueError(f"Invalid md_mode: {md_mode}. Should be 'exact', 'approx' or None.")
+
+    all_point = np.asarray(all_point)
     unique_point = np.unique(all_point)
     fov_cond_mn = np.zeros((len(unique_point), fov_cond.shape[1], fov_cond.shape[2]))
-    fov_cond_md = np.zeros((len(unique_point), fov_cond.shape[1], fov_cond.shape[2]))
+    fov_cond_md = np.zeros((len(unique_point), fov_cond.shape[1], fov_cond.shape[2])) if md_mode is not None else None
 
-    for point in unique_point:
+    def point_mn_md(point):
         point = int(point)
         point_mask = all_point == point
-        fov_cond_mn[point, :, :] = np.nanmean(fov_cond[point_mask, :, :], axis=0)
-        fov_cond_md[point, :, :] = np.nanmedian(fov_cond[point_mask, :, :], axis=0)
+        fov_cond_point = fov_cond[point_mask, :, :]
+
+        fov_cond_mn[point, :, :] = np.nanmean(fov_cond_point, axis=0)
+        if md_mode == 'exact':
+            fov_cond_md[point, :, :] = get_median_tiled(fov_cond_point, tile_rows=tile_rows)
+        elif md_mode == 'approx':
+            fov_cond_md[point, :, :] = get_median_hist(fov_cond_point, n_bins=n_hist_bins, tile_rows=tile_rows)
+
+    # each point writes only to its own entry of the output arrays
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        list(executor.map(point_mn_md, unique_point))
 
     return fov_cond_mn, fov_cond_md
 
-def get_dist_dff(fov_map, all_point, all_coords_x, all_coords_y, fov_shape=(512, 512), n_dist_bins=724):
+def get_dist_labels(fov_shape, coords_x, coords_y, dist_bins):
     """
-    Calculate the df/f of a pixel in the response map as a function of distance from the stimulus point.
-    This function computes the mean and standard deviation across pixels within specified distance bins from each stimulus point.
-    
-    ------------------
-    
+    Assign to every pixel of the FOV the index of its distance bin from a stimulus point.
+    Pixel (r, c) has distance sqrt((r - coords_x)**2 + (c - coords_y)**2) and label j-1 if dist_bins[j-1] <= distance < dist_bins[j] (same convention as the response maps in get_dist_dff).
+
     Parameters:
-        fov_map : (np.ndarray)
-            The response map with shape (n_stim_points, height, width) where each slice corresponds to a mean pixel response to a stimulus point (averaged across all repetitions of that stimulus).
-        all_point : (np.ndarray)
-            Array of stimulus point indices corresponding to each stimulation.
-        all_coords_x : (np.ndarray)
-            X coordinates of the stimulus point corresponding to each stimulation
-        all_coords_y : (np.ndarray)
-            Y coordinates of the stimulus point corresponding to each stimulation
-        fov_shape : (tuple)
-            Shape of the field of view (height, width).
-        n_dist_bins : (int)
-            Number of distance bins to compute statistics for.
+    ----------
+    fov_shape : tuple
+        Shape of the field of view (height, width).
+    coords_x : float
+        X coordinate of the stimulus point (rows of the response map).
+    coords_y : float
+        Y coordinate of the stimulus point (columns of the response map).
+    dist_bins : np.ndarray
+        Edges of the distance bins.
 
     Returns:
-        dist_diff_mn : (np.ndarray)
-            Each row corresponds to the mean of the pixel values for all pixels within a distance bin from a stimulus point. Rows correspond to different stimulus points.
-        dist_diff_std : (np.ndarray)
-            Each row corresponds to the standard deviation of the pixel values for all pixels within a distance bin from a stimulus point. Rows correspond to different stimulus points.
-
+    -------
+    dist_labels : np.ndarray
+        Bin index of every pixel with shape fov_shape, -1 for pixels outside of the bins.
     """
 
-    dist_max = np.sqrt(fov_shape[0]**2 + fov_shape[1]**2)  # Maximum distance in pixels (diagonal of the FOV)
-    dist_bins = np.linspace(0, dist_max, n_dist_bins)  # Create bins for distances
+    r_idx, c_idx = np.indices(fov_shape)
+    distance_map = np.sqrt((r_idx - coords_x) ** 2 + (c_idx - coords_y) ** 2)
 
-    dist_diff_mn = np.zeros((len(np.unique(all_point)), n_dist_bins))
-    dist_diff_std = np.zeros((len(np.unique(all_point)), n_dist_bins))
+    dist_labels = np.searchsorted(dist_bins, distance_map, side='right') - 1
+    dist_labels[dist_labels >= len(dist_bins) - 1] = -1
 
-    for i in np.unique(all_point):
-        coords_x = all_coords_x[i]
-        coords_y = all_coords_y[i]
+    return dist_labels
 
-        print(f"Stimulus Point {i}: Coordinates: ({coords_x}, {coords_y})")
-        
-        # Create a distance map
-        y_indices, x_indices = np.indices(fov_shape)
-        distance_map = np.sqrt((x_indices - coords_x) ** 2 + (y_indices - coords_y) ** 2).T
 
-        for j in range(1, n_dist_bins):
-            dist_mask = np.zeros(fov_shape, dtype=bool)
-            dist_mask = (distance_map >= dist_bins[j-1]) & (distance_map < dist_bins[j])
+@lru_cache(maxsize=8)
+def get_dist_lut(fov_shape, n_dist_bins):
+    """
+    Distance and distance-bin lookup tables for all pixel offsets within a FOV, memoised per (fov_shape, n_dist_bins) (bounded LRU, the tables are read-only).
+    Entry [dr + height, dc + width] corresponds to the offset (dr, dc) with dr in [-height, height) and dc in [-width, width), so the labels for a stimulus point at integer
+    coordinates (cx, cy) are the slice [height - cx:2*height - cx, width - cy:2*width - cy].
+
+    Parameters:
+    ----------
+    fov_shape : tuple
+        Shape of the field of view (height, width).
+    n_dist_bins : int
+        Number of distance bins (edges np.linspace(0, sqrt(height**2 + width**2), n_dist_bins) as in get_dist_dff).
 
-            mn = np.mean(fov_map[i][dist_mask])
-            std = np.std(fov_map[i][dist_mask])
+    Returns:
+    -------
+    dist_lut : np.ndarray
+        Distance of every offset with shape (2*height, 2*width).
+    label_lut : np.ndarray
+        Distance bin of every offset with shape (2*height, 2*width), -1 outside of the bins.
+    """
 
-            dist_diff_mn[i, j-1] = mn
-            dist_diff_std[i, j-1] = std
+    height, width = fov_shape
+    dist_bins = np.linspace(0, np.sqrt(height**2 + width**2), n_dist_bins)
 
-    return dist_diff_mn, dist_diff_std
+    dr, dc = np.indices((2 * height, 2 * width))
+    dist_lut = np.sqrt((dr - height) ** 2 + (dc - width) ** 2)
 
+    label_lut = np.searchsorted(dist_bins, dist_lut, side='right') - 1
+    label_lut[label_lut >= n_dist_bins - 1] = -1
+    label_lut = label_lut.astype(np.int32)
 
-def compute_dist_kernel(dist_diff_mn, n_dist_bins=724):
+    dist_lut.setflags(write=False)
+    label_lut.setflags(write=False)
+
+    return dist_lut, label_lut
+
+
+def get_dist_labels_lut(fov_shape, n_dist_bins, coords_x, coords_y):
     """
-    Compute the distance kernel from the mean df/f as a function of distance from the stimulus point.
-    
+    Distance bin labels of a stimulus point sliced from the lookup table of get_dist_lut.
+    Integer coordinates give a single label map. Sub-pixel coordinates give the label maps of the 4 surrounding integer points with bilinear weights,
+    so that every pixel contributes to (up to) 4 bins.
+
     Parameters:
-        dist_diff_mn : (np.ndarray)
-            Each row corresponds to the mean of the pixel values for all pixels within a distance bin from a stimulus point. Rows correspond to different stimulus points.
-        n_dist_bins : (int)
-            Number of distance bins to compute statistics for. This should match the number of distance bins used in get_dist_dff.
-    
+    ----------
+    fov_shape : tuple
+        Shape of the field of view (height, width).
+    n_dist_bins : int
+        Number of distance bins.
+    coords_x : float
+        X coordinate of the stimulus point (rows of the response map), within [0, height].
+    coords_y : float
+        Y coordinate of the stimulus point (columns of the response map), within [0, width].
+
     Returns:
-        k1d : (np.ndarray)
-            The distance kernel computed as the mean of the mean df/f across all stimulus points.
+    -------
+    dist_labels : np.ndarray
+        Label maps with shape (n_taps, height, width) (n_taps is 1, 2 or 4).
+    dist_weights : np.ndarray
+        Bilinear weight of each label map with shape (n_taps,).
+    """
+
+    _, label_lut = get_dist_lut(tuple(fov_shape), n_dist_bins)
+
+    return slice_label_lut(label_lut, fov_shape, coords_x, coords_y)
+
+
+def slice_label_lut(label_lut, fov_shape, coords_x, coords_y):
+    """
+    Label maps of a stimulus point sliced from a label lookup table over all pixel offsets (get_dist_lut, get_polar_lut), with bilinear weights for sub-pixel coordinates
+    (see get_dist_labels_lut).
+
+    Parameters:
+    ----------
+    label_lut : np.ndarray
+        Label of every offset with shape (2*height, 2*width) (offset (dr, dc) at [dr + height, dc + width]).
+    fov_shape : tuple
+        Shape of the field of view (height, width).
+    coords_x : float
+        X coordinate of the stimulus point (rows of the response map), within [0, height].
+    coords_y : float
+        Y coordinate of the stimulus point (columns of the response map), within [0, width].
+
+    Returns:
+    -------
+    dist_labels : np.ndarray
+        Label maps with shape (n_taps, height, width) (n_taps is 1, 2 or 4).
+    dist_weights : np.ndarray
+        Bilinear weight of each label map with shape (n_taps,).
+    """
+
+    height, width = fov_shape
+
+    ix, iy = int(np.floor(coords_x)), int(np.floor(coords_y))
+    fx, fy = coords_x - ix, coords_y - iy
+
+    dist_labels = []
+    dist_weights = []
+    for (cx, cy, w) in [(ix, iy, (1 - fx) * (1 - fy)), (ix + 1, iy, fx * (1 - fy)), (ix, iy + 1, (1 - fx) * fy), (ix + 1, iy + 1, fx * fy)]:
+        if w == 0:
+            continue
+        dist_labels.append(label_lut[height - cx:2 * height - cx, width - cy:2 * width - cy])
+        dist_weights.append(w)
+
+    return np.stack(dist_labels), np.array(dist_weights)
+
+
+def get_polar_labels_offsets(dr, dc, r_bins, n_theta):
+    """
+    Polar (radius x angle) bin label of pixel offsets (dr, dc) from a stimulus point: label i_r * n_theta + i_theta,
+    with i_r the radius bin (r_bins[i_r] <= sqrt(dr**2 + dc**2) < r_bins[i_r + 1]) and i_theta the angle bin of arctan2(dc, dr) (n_theta equal bins over [-pi, pi)).
+
+    Parameters:
+    ----------
+    dr : np.ndarray
+        Offsets along x (rows).
+    dc : np.ndarray
+        Offsets along y (columns).
+    r_bins : np.ndarray
+        Edges of the radius bins.
+    n_theta : int
+        Number of angle bins.
+
+    Returns:
+    -------
+    polar_labels : np.ndarray
+        Polar bin of every offset, -1 outside of the radius bins.
+    """
+
+    r_labels = np.searchsorted(r_bins, np.sqrt(dr ** 2 + dc ** 2), side='right') - 1
+    theta_labels = np.minimum(((np.arctan2(dc, dr) + np.pi) / (2 * np.pi / n_theta)).astype(int), n_theta - 1)
+
+    polar_labels = r_labels * n_theta + theta_labels
+    polar_labels[(r_labels < 0) | (r_labels >= len(r_bins) - 1)] = -1
+
+    return polar_labels
+
+
+@lru_cache(maxsize=8)
+def get_polar_lut(fov_shape, n_r, n_theta, r_max):
+    """
+    Polar bin lookup table for all pixel offsets within a FOV (same layout as get_dist_lut), memoised per (fov_shape, n_r, n_theta, r_max) (bounded LRU, read-only).
+
+    Parameters:
+    ----------
+    fov_shape : tuple
+        Shape of the field of view (height, width).
+    n_r : int
+        Number of radius bins (edges np.linspace(0, r_max, n_r + 1)).
+    n_theta : int
+        Number of angle bins.
+    r_max : float
+        Maximum radius.
+
+    Returns:
+    -------
+    label_lut : np.ndarray
+        Polar bin of every offset with shape (2*height, 2*width), -1 outside of the radius bins (see get_polar_labels_offsets).
+    """
+
+    height, width = fov_shape
+    r_bins = np.linspace(0, r_max, n_r + 1)
+
+    dr, dc = np.indices((2 * height, 2 * width))
+    label_lut = get_polar_labels_offsets(dr - height, dc - width, r_bins, n_theta).astype(np.int32)
+    label_lut.setflags(write=False)
+
+    return label_lut
+
+
+def use_label_lut(fov_shape, coords_x, coords_y, dist_mode):
+    """
+    Whether the labels of a stimulus point are sliced from a label lookup table (get_dist_lut, get_polar_lut) for the given dist_mode.
+    'lut' only uses the table for integer coordinates, where it gives the same labels as 'exact', 'bilinear' also for sub-pixel coordinates (bilinear weights over the 4
+    surrounding integer points, see get_dist_labels_lut). Points outside of the FOV never use the table.
+
+    Parameters:
+    ----------
+    fov_shape : tuple
+        Shape of the field of view (height, width).
+    coords_x : float
+        X coordinate of the stimulus point (rows of the response map).
+    coords_y : float
+        Y coordinate of the stimulus point (columns of the response map).
+    dist_mode : str
+        'exact', 'lut' or 'bilinear'.
+
+    Returns:
+    -------
+    use_lut : bool
+        True if the labels are sliced from the lookup table.
+    """
+
+    if dist_mode not in ['exact', 'lut', 'bilinear']:
+        raise ValueError(f"Unknown dist_mode {dist_mode}")
+
+    in_fov = (0 <= coords_x <= fov_shape[0]) and (0 <= coords_y <= fov_shape[1])
+    is_int = float(coords_x).is_integer() and float(coords_y).is_integer()
+
+    return in_fov and (dist_mode == 'bilinear' or (dist_mode == 'lut' and is_int))
+
+
+def get_point_dist_labels(fov_shape, n_dist_bins, coords_x, coords_y, dist_mode='lut'):
+    """
+    Distance bin label maps of a single stimulus point, as used by get_dist_dff and get_dist_dff_trials.
+
+    Parameters:
+    ----------
+    fov_shape : tuple
+        Shape of the field of view (height, width).
+    n_dist_bins : int
+        Number of distance bins (edges np.linspace(0, sqrt(height**2 + width**2), n_dist_bins)).
+    coords_x : float
+        X coordinate of the stimulus point (rows of the response map).
+    coords_y : float
+        Y coordinate of the stimulus point (columns of the response map).
+    dist_mode : str
+        'exact' to compute the exact distance of every pixel (see get_dist_labels), 'lut' to slice the labels from the cached lookup table for integer
+        coordinates (same labels, other points use 'exact', default), 'bilinear' to also slice them for sub-pixel coordinates with bilinear weights (see use_label_lut).
+
+    Returns:
+    -------
+    dist_labels : np.ndarray
+        Label maps with shape (n_taps, height, width).
+    dist_weights : np.ndarray
+        Weight of each label map with shape (n_taps,).
+    """
+
+    if use_label_lut(fov_shape, coords_x, coords_y, dist_mode):
+        return get_dist_labels_lut(fov_shape, n_dist_bins, coords_x, coords_y)
+
+    dist_bins = np.linspace(0, np.sqrt(fov_shape[0]**2 + fov_shape[1]**2), n_dist_bins)
+    return get_dist_labels(fov_shape, coords_x, coords_y, dist_bins)[None], np.ones(1)
+
+
+def get_radial_profile(imgs, all_dist_labels, n_bins, all_dist_weights=None):
+    """
+    Compute the mean and standard deviation of the pixels of each image in every distance bin, for all images at once.
+    Every pixel is visited twice (np.bincount for the sums and counts, then again for the sums of squared deviations from the bin mean), instead of once per bin.
+
+    Parameters:
+    ----------
+    imgs : np.ndarray
+        Images with shape (n_imgs, height, width).
+    all_dist_labels : np.ndarray
+        Distance bin index of every pixel of each image with shape (n_imgs, height, width) (or (height, width) if shared by all images), -1 for pixels to ignore.
+        With weights, the label maps of each image have shape (n_imgs, n_taps, height, width).
+    n_bins : int
+        Number of distance bins.
+    all_dist_weights : np.ndarray or None
+        Weight of each label map with shape (n_imgs, n_taps) (e. g. bilinear weights from get_dist_labels_lut), None if every pixel has a single label.
+
+    Returns:
+    -------
+    prof_mn : np.ndarray
+        (Weighted) mean of the pixels in every bin with shape (n_imgs, n_bins) (NaN for empty bins).
+    prof_std : np.ndarray
+        (Weighted) standard deviation of the pixels in every bin with shape (n_imgs, n_bins) (NaN for empty bins).
+    prof_count : np.ndarray
+        (Weighted) number of pixels in every bin with shape (n_imgs, n_bins).
+    """
+
+    imgs = np.asarray(imgs)
+    n_imgs = imgs.shape[0]
+
+    if all_dist_weights is None:
+        all_dist_labels = np.broadcast_to(all_dist_labels, imgs.shape)
+        img_idx = np.arange(n_imgs)[:, None, None]
+        vals = imgs
+        weights = None
+    else:
+        n_taps = all_dist_labels.shape[1]
+        img_idx = np.arange(n_imgs)[:, None, None, None]
+        vals = np.broadcast_to(imgs[:, None], all_dist_labels.shape)
+        weights = np.broadcast_to(np.asarray(all_dist_weights).reshape(n_imgs, n_taps, 1, 1), all_dist_labels.shape)
+
+    # 1) offset the labels of each image so that a single bincount covers all images, pixels outside of the bins are dropped
+    valid = all_dist_labels >= 0
+    flat_labels = (all_dist_labels + img_idx * n_bins)[valid]
+    flat_vals = vals[valid].astype(np.float64)
+    flat_weights = np.ones_like(flat_vals) if weights is None else weights[valid]
+
+    # 2) sums and counts per bin
+    prof_count = np.bincount(flat_labels, weights=flat_weights, minlength=n_imgs * n_bins)
+    prof_sum = np.bincount(flat_labels, weights=flat_weights * flat_vals, minlength=n_imgs * n_bins)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        prof_mn = prof_sum / prof_count
+
+    # 3) sums of squared deviations from the bin mean (two-pass, to avoid the cancellation of sum(x**2) - n*mean**2)
+    prof_ss = np.bincount(flat_labels, weights=flat_weights * (flat_vals - prof_mn[flat_labels]) ** 2, minlength=n_imgs * n_bins)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        prof_std = np.sqrt(prof_ss / prof_count)
+
+    return prof_mn.reshape(n_imgs, n_bins), prof_std.reshape(n_imgs, n_bins), prof_count.reshape(n_imgs, n_bins)
+
+
+def get_dist_dff(fov_map, all_point, all_coords_x, all_coords_y, fov_shape=(512, 512), n_dist_bins=724, point_batch=16, dist_mode='lut'):
+    """
+    Calculate the df/f of a pixel in the response map as a function of distance from the stimulus point.
+    This function computes the mean and standard deviation across pixels within specified distance bins from each stimulus point.
+    Each pixel gets one integer bin label per point and the statistics of all bins are computed with np.bincount (get_radial_profile), for point_batch points at a time.
+    By default (dist_mode='lut') the labels of points at integer coordinates are sliced from a distance lookup table shared across points and calls (get_dist_lut),
+    with dist_mode='bilinear' also those of sub-pixel coordinates, with bilinear weights.
+    
+    ------------------
+    
+    Parameters:
+        fov_map : (np.ndarray)
+            The response map with shape (n_stim_points, height, width) where each slice corresponds to a mean pixel response to a stimulus point (averaged across all repetitions of that stimulus).
+        all_point : (np.ndarray)
+            Array of stimulus point indices corresponding to each stimulation.
+        all_coords_x : (np.ndarray)
+            X coordinates of the stimulus point corresponding to each stimulation
+        all_coords_y : (np.ndarray)
+            Y coordinates of the stimulus point corresponding to each stimulation
+        fov_shape : (tuple)
+            Shape of the field of view (height, width).
+        n_dist_bins : (int)
+            Number of distance bins to compute statistics for.
+        point_batch : (int)
+            Number of stimulus points processed together (bounds the memory of the label maps to point_batch * height * width, x4 for sub-pixel coordinates).
+        dist_mode : (str)
+            'exact' to compute the exact distance of every pixel to each point, 'lut' to slice the labels from the cached lookup table for points at integer
+            coordinates (same result, default), 'bilinear' to also slice them for sub-pixel coordinates with bilinear weights (see use_label_lut).
+
+    Returns:
+        dist_diff_mn : (np.ndarray)
+            Each row corresponds to the mean of the pixel values for all pixels within a distance bin from a stimulus point. Rows correspond to different stimulus points.
+        dist_diff_std : (np.ndarray)
+            Each row corresponds to the standard deviation of the pixel values for all pixels within a distance bin from a stimulus point. Rows correspond to different stimulus points.
+
+    """
+
+    fov_shape = tuple(fov_shape)
+
+    unique_points = np.unique(all_point).astype(int)
+    dist_diff_mn = np.zeros((len(unique_points), n_dist_bins))
+    dist_diff_std = np.zeros((len(unique_points), n_dist_bins))
+
+    for i in unique_points:
+        print(f"Stimulus Point {i}: Coordinates: ({all_coords_x[i]}, {all_coords_y[i]})")
+
+    for batch_on in range(0, len(unique_points), point_batch):
+        batch_points = unique_points[batch_on:batch_on + point_batch]
+
+        all_dist_labels = []
+        all_dist_weights = []
+        for i in batch_points:
+            dist_labels, dist_weights = get_point_dist_labels(fov_shape, n_dist_bins, all_coords_x[i], all_coords_y[i], dist_mode=dist_mode)
+            all_dist_labels.append(dist_labels)
+            all_dist_weights.append(dist_weights)
+
+        # pad to the same number of taps (with empty labels and zero weight) so that the points of a batch can be stacked
+        n_taps = max(len(dist_weights) for dist_weights in all_dist_weights)
+        all_dist_labels = [np.concatenate([dist_labels, np.full((n_taps - len(dist_labels), *fov_shape), -1, dtype=dist_labels.dtype)]) for dist_labels in all_dist_labels]
+        all_dist_weights = [np.concatenate([dist_weights, np.zeros(n_taps - len(dist_weights))]) for dist_weights in all_dist_weights]
+
+        prof_mn, prof_std, _ = get_radial_profile(fov_map[batch_points], np.stack(all_dist_labels), n_dist_bins - 1, all_dist_weights=np.stack(all_dist_weights))
+
+        # the last bin has no upper edge and stays 0
+        dist_diff_mn[batch_points, :-1] = prof_mn
+        dist_diff_std[batch_points, :-1] = prof_std
+
+    return dist_diff_mn, dist_diff_std
+
+
+def get_dist_dff_trials(fov_diff, all_point, all_coords_x, all_coords_y, fov_shape=(512, 512), n_dist_bins=724, trial_batch=16, dist_mode='lut'):
+    """
+    Same as get_dist_dff, but for every single trial instead of the trial-averaged response map (e. g. to get error bars on the spread kernel with bootstrap_dist_dff).
+    The label maps are computed once per point and shared by all of its trials, which are processed trial_batch at a time.
+
+    Parameters:
+        fov_diff : (np.ndarray or StackDiff)
+            The per-trial response images (response - baseline) with shape (n_stim, height, width), e. g. fov_diff from get_fov_resp.
+        all_point : (np.ndarray)
+            Array of stimulus point indices corresponding to each stimulation.
+        all_coords_x : (np.ndarray)
+            X coordinates of the stimulus points (indexed by point, as in get_dist_dff).
+        all_coords_y : (np.ndarray)
+            Y coordinates of the stimulus points (indexed by point, as in get_dist_dff).
+        fov_shape : (tuple)
+            Shape of the field of view (height, width).
+        n_dist_bins : (int)
+            Number of distance bins to compute statistics for.
+        trial_batch : (int)
+            Number of trials processed together (bounds the memory to trial_batch * height * width, x4 for sub-pixel coordinates).
+        dist_mode : (str)
+            'exact', 'lut' or 'bilinear' (see get_dist_dff).
+
+    Returns:
+        dist_diff_trials : (np.ndarray)
+            Mean of the pixel values within each distance bin for every trial with shape (n_stim, n_dist_bins). The last bin stays 0 (as in get_dist_dff).
+    """
+
+    fov_shape = tuple(fov_shape)
+    all_point = np.asarray(all_point).astype(int)
+
+    dist_diff_trials = np.zeros((len(all_point), n_dist_bins))
+
+    for i in np.unique(all_point):
+        dist_labels, dist_weights = get_point_dist_labels(fov_shape, n_dist_bins, all_coords_x[i], all_coords_y[i], dist_mode=dist_mode)
+        point_trials = np.where(all_point == i)[0]
+
+        for batch_on in range(0, len(point_trials), trial_batch):
+            batch_trials = point_trials[batch_on:batch_on + trial_batch]
+            n_batch = len(batch_trials)
+
+            all_dist_labels = np.broadcast_to(dist_labels, (n_batch, *dist_labels.shape))
+            all_dist_weights = np.broadcast_to(dist_weights, (n_batch, len(dist_weights)))
+            prof_mn, _, _ = get_radial_profile(fov_diff[batch_trials], all_dist_labels, n_dist_bins - 1, all_dist_weights=all_dist_weights)
+
+            dist_diff_trials[batch_trials, :-1] = prof_mn
+
+    return dist_diff_trials
+
+
+def get_boot_counts(n_trials, n_boot, rng):
+    """
+    Draw bootstrap resamples of n_trials trials (with replacement) as a matrix of how many times each trial is drawn in each resample.
+    The n_boot * n_trials draws are made at once and counted with a single np.bincount (offset by resample), so a resampled mean is a matrix product.
+
+    Parameters:
+    ----------
+    n_trials : int
+        Number of trials to resample.
+    n_boot : int
+        Number of bootstrap resamples.
+    rng : np.random.Generator
+        Random number generator.
+
+    Returns:
+    -------
+    boot_counts : np.ndarray
+        Number of times each trial is drawn with shape (n_boot, n_trials) (each row sums to n_trials).
+    """
+
+    boot_idx = rng.integers(0, n_trials, size=(n_boot, n_trials)) + np.arange(n_boot)[:, None] * n_trials
+    return np.bincount(boot_idx.ravel(), minlength=n_boot * n_trials).reshape(n_boot, n_trials).astype(np.float64)
+
+
+def get_boot_percentile(boot_mn, q):
+    """
+    Percentiles of every row of the bootstrap resamples, as np.nanpercentile(boot_mn, q, axis=1) (linear interpolation).
+    Only the order statistics around the percentile ranks are selected with np.partition (in place, boot_mn is reordered along the resamples, which are contiguous).
+    Rows where some (but not all) resamples are NaN are sorted (NaN last) and use the ranks of their number of valid resamples, rows that are all NaN stay NaN.
+
+    Parameters:
+    ----------
+    boot_mn : np.ndarray
+        Resampled values with shape (n_cols, n_boot) (reordered in place).
+    q : list
+        Percentiles (0 to 100).
+
+    Returns:
+    -------
+    boot_prctile : np.ndarray
+        Percentiles of every column with shape (len(q), n_cols).
+    """
+
+    n_cols, n_boot = boot_mn.shape
+
+    def lerp_rank(x, n_valid, q_i):
+        # value at the virtual rank (n_valid - 1) * q_i / 100 of each row of x (ordered at least around that rank), interpolated as np.percentile
+        h = (n_valid - 1) * q_i / 100
+        lo = np.floor(h).astype(int)
+        hi = np.minimum(lo + 1, n_valid - 1)
+        rows = np.arange(x.shape[0])
+        a, b, t = x[rows, lo], x[rows, hi], h - lo
+        diff = b - a
+        return np.where(t >= 0.5, b - diff * (1 - t), a + diff * t)
+
+    boot_nan = np.isnan(boot_mn)
+    any_nan = boot_nan.any(axis=1)
+    part_nan = any_nan & ~boot_nan.all(axis=1)
+
+    boot_prctile = np.full((len(q), n_cols), np.nan)
+
+    # 1) rows without NaN: select the order statistics around each rank
+    if np.any(~any_nan):
+        lo = np.floor((n_boot - 1) * np.asarray(q) / 100).astype(int)
+        kth = np.unique(np.concatenate((lo, np.minimum(lo + 1, n_boot - 1))))
+        if np.all(~any_nan):
+            boot_mn.partition(kth, axis=1)
+            x = boot_mn
+        else:
+            x = np.partition(boot_mn[~any_nan], kth, axis=1)
+        n_valid = np.full(x.shape[0], n_boot)
+        for (i, q_i) in enumerate(q):
+            boot_prctile[i, ~any_nan] = lerp_rank(x, n_valid, q_i)
+
+    # 2) rows with some NaN
+    if np.any(part_nan):
+        x = np.sort(boot_mn[part_nan], axis=1)
+        n_valid = np.sum(~boot_nan[part_nan], axis=1)
+        for (i, q_i) in enumerate(q):
+            boot_prctile[i, part_nan] = lerp_rank(x, n_valid, q_i)
+
+    return boot_prctile
+
+
+def bootstrap_dist_dff(dist_diff_trials, all_point, n_boot=10000, ci=95, seed=None):
+    """
+    Bootstrap confidence intervals of the distance profile of each point and of the pooled 1D kernel (k1d of compute_dist_kernel), resampling the trials of each point with replacement.
+    Each resample is a row of a count matrix (get_boot_counts), so the resampled means of all bins are one matrix product per point (NaN bins of a trial are left out of its resampled mean).
+    The same resamples are used for the point profiles and for k1d (the mean across points of the resampled point profiles).
+    The interval bounds are the order statistics around the two percentile ranks, selected with np.partition (get_boot_percentile) instead of a full sort.
+
+    Parameters:
+        dist_diff_trials : (np.ndarray)
+            Distance profile of every trial with shape (n_stim, n_dist_bins) (see get_dist_dff_trials).
+        all_point : (np.ndarray)
+            Array of stimulus point indices corresponding to each stimulation.
+        n_boot : (int)
+            Number of bootstrap resamples (default is 10000).
+        ci : (float)
+            Confidence level in percent (default is 95).
+        seed : (int or None)
+            Seed of the random number generator (default is None).
+
+    Returns:
+        dist_diff_ci : (np.ndarray)
+            Lower and upper bound of the interval of the mean profile of each point with shape (2, n_points, n_dist_bins) (points in np.unique(all_point) order).
+        k1d_ci : (np.ndarray)
+            Lower and upper bound of the interval of k1d with shape (2, n_dist_bins).
+    """
+
+    dist_diff_trials = np.asarray(dist_diff_trials, dtype=np.float64)
+    all_point = np.asarray(all_point)
+    unique_points = np.unique(all_point)
+    n_dist_bins = dist_diff_trials.shape[1]
+
+    rng = np.random.default_rng(seed)
+    q = [(100 - ci) / 2, 100 - (100 - ci) / 2]
+
+    dist_diff_ci = np.zeros((2, len(unique_points), n_dist_bins))
+    k1d_boot_sum = np.zeros((n_dist_bins, n_boot))
+    k1d_boot_n = np.zeros((n_dist_bins, n_boot))
+
+    # buffers reused by all points (bins x resamples, so that the resamples of a bin are contiguous for the percentiles)
+    boot_sum = np.empty((n_dist_bins, n_boot))
+    boot_n = np.empty((n_dist_bins, n_boot))
+    boot_mn = np.empty((n_dist_bins, n_boot))
+    boot_valid = np.empty((n_dist_bins, n_boot), dtype=bool)
+
+    for (p, point) in enumerate(unique_points):
+        point_trials = dist_diff_trials[all_point == point]
+        point_valid = ~np.isnan(point_trials)
+
+        # resampled means of all bins: (n_dist_bins, n_trials) @ (n_trials, n_boot)
+        boot_counts = get_boot_counts(len(point_trials), n_boot, rng).T
+        np.matmul(np.where(point_valid, point_trials, 0).T, boot_counts, out=boot_sum)
+        np.matmul(point_valid.T.astype(np.float64), boot_counts, out=boot_n)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            np.divide(boot_sum, boot_n, out=boot_mn)
+
+        # k1d is the nanmean across points of the point profiles
+        np.logical_not(np.isnan(boot_mn), out=boot_valid)
+        np.add(k1d_boot_sum, boot_mn, out=k1d_boot_sum, where=boot_valid)
+        k1d_boot_n += boot_valid
+
+        dist_diff_ci[:, p] = get_boot_percentile(boot_mn, q) # reorders boot_mn
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        k1d_boot = k1d_boot_sum / k1d_boot_n
+    k1d_ci = get_boot_percentile(k1d_boot, q)
+
+    return dist_diff_ci, k1d_ci
+
+
+@lru_cache(maxsize=8)
+def get_kernel_interp(kernel_size, n_k1d):
+    """
+    Linear interpolation indices and fractions that map a 1D kernel of n_k1d samples (on np.linspace(0, kernel_size//2, n_k1d)) onto the distance grid of a
+    (kernel_size, kernel_size) 2D kernel, memoised per (kernel_size, n_k1d) (bounded LRU, the arrays are read-only).
+    Distances beyond the last sample use the last segment (linear extrapolation, as interp1d(..., fill_value="extrapolate")).
+
+    Parameters:
+    ----------
+    kernel_size : int
+        Size of the 2D kernel.
+    n_k1d : int
+        Number of samples of the 1D kernel.
+
+    Returns:
+    -------
+    interp_idx : np.ndarray
+        Index of the lower sample of the interpolation segment of every kernel pixel with shape (kernel_size, kernel_size).
+    interp_frac : np.ndarray
+        Position of every kernel pixel within its segment (0 at the lower sample, 1 at the upper sample) with shape (kernel_size, kernel_size).
+    """
+
+    x = np.linspace(-kernel_size//2, kernel_size//2, kernel_size)
+    y = np.linspace(-kernel_size//2, kernel_size//2, kernel_size)
+    X, Y = np.meshgrid(x, y)
+    distance = np.sqrt(X**2 + Y**2)
+
+    k1d_dist = np.linspace(0, kernel_size//2, n_k1d)
+    interp_idx = np.clip(np.searchsorted(k1d_dist, distance, side='right') - 1, 0, n_k1d - 2)
+    interp_frac = (distance - k1d_dist[interp_idx]) / (k1d_dist[interp_idx + 1] - k1d_dist[interp_idx])
+
+    interp_idx.setflags(write=False)
+    interp_frac.setflags(write=False)
+
+    return interp_idx, interp_frac
+
+
+def compute_dist_kernel(dist_diff_mn, n_dist_bins=724):
+    """
+    Compute the distance kernel from the mean df/f as a function of distance from the stimulus point.
+    
+    Parameters:
+        dist_diff_mn : (np.ndarray)
+            Each row corresponds to the mean of the pixel values for all pixels within a distance bin from a stimulus point. Rows correspond to different stimulus points.
+        n_dist_bins : (int)
+            Number of distance bins to compute statistics for. This should match the number of distance bins used in get_dist_dff.
+    
+    Returns:
+        k1d : (np.ndarray)
+            The distance kernel computed as the mean of the mean df/f across all stimulus points.
         k2d : (np.ndarray)
             The distance kernel rotated around the center of FOV.
 
     """
     k1d = np.nanmean(dist_diff_mn, axis=0)
 
-    # now generate a 2D kernel from the 1D kernel
+    # now generate a 2D kernel from the 1D kernel, by linear interpolation on the cached distance grid of the kernel
     kernel_size = n_dist_bins  # Size of the 2D kernel (e.g., 512x512)
-    x = np.linspace(-kernel_size//2, kernel_size//2, kernel_size)
-    y = np.linspace(-kernel_size//2, kernel_size//2, kernel_size)
-    # Create a meshgrid for 2D coordinates
-    X, Y = np.meshgrid(x, y)
+    interp_idx, interp_frac = get_kernel_interp(kernel_size, len(k1d))
+    k2d = k1d[interp_idx] + interp_frac * (k1d[interp_idx + 1] - k1d[interp_idx])
 
-    # Calculate the distance from the center for each point in the 2D grid
-    distance = np.sqrt(X**2 + Y**2)
-    # Interpolate the 1D kernel to create a 2D kernel
-    interp_func = interp1d(np.linspace(0, kernel_size//2, len(k1d)), k1d, bounds_error=False, fill_value="extrapolate")
-    # Create the 2D kernel by applying the interpolation function to the distance map
-    k2d = interp_func(distance)
+    return k1d, k2d
+
+
+def get_delta_img(shape, coords_x, coords_y):
+    """
+    Image of a (sub-pixel) unit delta at a stimulus point, spread over the 4 surrounding pixels with bilinear weights (as the label maps of get_dist_labels_lut).
+
+    Parameters:
+    ----------
+    shape : tuple
+        Shape of the image (height, width).
+    coords_x : float
+        X coordinate of the stimulus point (rows), within [0, height - 1).
+    coords_y : float
+        Y coordinate of the stimulus point (columns), within [0, width - 1).
+
+    Returns:
+    -------
+    delta_img : np.ndarray
+        The delta image with shape shape (sums to 1).
+    """
+
+    delta_img = np.zeros(shape)
+
+    ix, iy = int(np.floor(coords_x)), int(np.floor(coords_y))
+    fx, fy = coords_x - ix, coords_y - iy
+    for (cx, cy, w) in [(ix, iy, (1 - fx) * (1 - fy)), (ix + 1, iy, fx * (1 - fy)), (ix, iy + 1, (1 - fx) * fy), (ix + 1, iy + 1, fx * fy)]:
+        delta_img[cx, cy] += w
+
+    return delta_img
+
+
+def compute_dist_kernel_lsq(fov_map, all_point, all_coords_x, all_coords_y, fov_shape=(512, 512), n_dist_bins=724, kernel_size=None, reg=1e-3):
+    """
+    Estimate a shared 2D kernel directly from the response maps of all points, modelling the map of each point as (delta at the stimulus point) * kernel (convolution),
+    fitted only on the pixels measured for that point (inside of the FOV and not NaN). Each offset of the kernel is the mean of the maps re-centred on their stimulus points
+    over the points that measured it, k2d = sum_p corr(delta_p, valid_p * fov_map[p]) / (sum_p corr(delta_p, valid_p) + reg * n_points), with both correlations computed
+    once per map by FFT (zero-padded to (2*height, 2*width) to avoid wrap-around). Offsets seen only by the points near the FOV edge are therefore not pulled towards 0.
+    Unlike compute_dist_kernel the kernel is not assumed to be isotropic. The fit is exact for integer stimulus coordinates, sub-pixel ones are spread with bilinear deltas.
+
+    Parameters:
+        fov_map : (np.ndarray)
+            The response map with shape (n_stim_points, height, width) (as in get_dist_dff). NaN pixels are set to 0.
+        all_point : (np.ndarray)
+            Array of stimulus point indices corresponding to each stimulation.
+        all_coords_x : (np.ndarray)
+            X coordinates of the stimulus points (indexed by point, as in get_dist_dff).
+        all_coords_y : (np.ndarray)
+            Y coordinates of the stimulus points (indexed by point, as in get_dist_dff).
+        fov_shape : (tuple)
+            Shape of the field of view (height, width).
+        n_dist_bins : (int)
+            Number of distance bins of k1d (as in get_dist_dff).
+        kernel_size : (int or None)
+            Size of the returned 2D kernel (default is None, e. g. n_dist_bins as in compute_dist_kernel).
+        reg : (float)
+            Ridge regularisation relative to the number of points (default is 1e-3).
+
+    Returns:
+        k1d : (np.ndarray)
+            Radial profile of k2d with the distance bins of get_dist_dff (the last bin stays 0).
+        k2d : (np.ndarray)
+            The 2D kernel with shape (kernel_size, kernel_size), offset 0 at [kernel_size // 2, kernel_size // 2] (rows along x, columns along y).
+            Offsets not measured by any point are 0.
+    """
+
+    fov_shape = tuple(fov_shape)
+    height, width = fov_shape
+    pad_shape = (2 * height, 2 * width)
+    kernel_size = n_dist_bins if kernel_size is None else kernel_size
+
+    unique_points = np.unique(all_point).astype(int)
+
+    # 1) accumulate the re-centred maps and their coverage (number of points measuring each offset) per frequency
+    k2d_num = np.zeros((pad_shape[0], pad_shape[1] // 2 + 1), dtype=np.complex128)
+    k2d_cov = np.zeros((pad_shape[0], pad_shape[1] // 2 + 1), dtype=np.complex128)
+    n_used = 0
+    for i in unique_points:
+        if not ((0 <= all_coords_x[i] < height - 1) and (0 <= all_coords_y[i] < width - 1)):
+            print(f"Stimulus Point {i}: Coordinates ({all_coords_x[i]}, {all_coords_y[i]}) outside of the FOV, skipping")
+            continue
+
+        valid = ~np.isnan(fov_map[i])
+        delta_f = np.conj(np.fft.rfft2(get_delta_img(pad_shape, all_coords_x[i], all_coords_y[i])))
+
+        k2d_num += delta_f * np.fft.rfft2(np.where(valid, fov_map[i], 0.0), s=pad_shape)
+        k2d_cov += delta_f * np.fft.rfft2(valid.astype(float), s=pad_shape)
+        n_used += 1
+
+    if n_used == 0:
+        raise ValueError("No stimulus points inside of the FOV")
+
+    # 2) back to offsets centred at (height, width), each offset divided by its own coverage
+    k2d_num = np.fft.fftshift(np.fft.irfft2(k2d_num, s=pad_shape))
+    k2d_cov = np.fft.fftshift(np.fft.irfft2(k2d_cov, s=pad_shape))
+    k2d_cov[k2d_cov < 1e-6] = 0 # FFT round-off at offsets no point measured
+    k2d_den = k2d_cov + reg * n_used
+    k2d_full = np.divide(k2d_num, k2d_den, out=np.zeros(pad_shape), where=k2d_cov > 0)
+
+    # 3) crop (or zero-pad) to kernel_size around offset 0
+    k2d = np.zeros((kernel_size, kernel_size))
+    r0, c0 = height - kernel_size // 2, width - kernel_size // 2
+    r_on, c_on = max(r0, 0), max(c0, 0)
+    r_off, c_off = min(r0 + kernel_size, pad_shape[0]), min(c0 + kernel_size, pad_shape[1])
+    k2d[r_on - r0:r_off - r0, c_on - c0:c_off - c0] = k2d_full[r_on:r_off, c_on:c_off]
+
+    # 4) radial profile with the distance bins of get_dist_dff
+    dist_bins = np.linspace(0, np.sqrt(height**2 + width**2), n_dist_bins)
+    dist_labels = get_dist_labels(k2d.shape, kernel_size // 2, kernel_size // 2, dist_bins)
+    prof_mn, _, _ = get_radial_profile(k2d[None], dist_labels, n_dist_bins - 1)
+    k1d = np.zeros(n_dist_bins)
+    k1d[:-1] = prof_mn[0]
+
+    return k1d, k2d
+
+
+def get_dist_dff_polar(fov_map, all_point, all_coords_x, all_coords_y, fov_shape=(512, 512), n_r=128, n_theta=8, r_max=None, point_batch=16, dist_mode='lut'):
+    """
+    Same as get_dist_dff, but the pixels are binned by both distance and angle around each stimulus point (e. g. for anisotropic spread of an elongated PSF).
+    The polar bin of a pixel is a single integer label (radius bin * n_theta + angle bin), so all bins of all points in a batch are computed with the same bincount
+    pass as the radial profiles (get_radial_profile). By default (dist_mode='lut') and with 'bilinear' the labels are sliced from a cached lookup table (get_polar_lut, see use_label_lut).
+
+    Parameters:
+        fov_map : (np.ndarray)
+            The response map with shape (n_stim_points, height, width) (as in get_dist_dff).
+        all_point : (np.ndarray)
+            Array of stimulus point indices corresponding to each stimulation.
+        all_coords_x : (np.ndarray)
+            X coordinates of the stimulus points (indexed by point, as in get_dist_dff).
+        all_coords_y : (np.ndarray)
+            Y coordinates of the stimulus points (indexed by point, as in get_dist_dff).
+        fov_shape : (tuple)
+            Shape of the field of view (height, width).
+        n_r : (int)
+            Number of radius bins (default is 128).
+        n_theta : (int)
+            Number of angle bins over [-pi, pi), angle arctan2(dy, dx) (default is 8).
+        r_max : (float or None)
+            Maximum radius (default is None, e. g. the diagonal of the FOV).
+        point_batch : (int)
+            Number of stimulus points processed together.
+        dist_mode : (str)
+            'exact' to compute the labels from the exact offsets of every pixel, 'lut' (default) or 'bilinear' to slice them from the cached lookup table (see use_label_lut).
+
+    Returns:
+        polar_diff_mn : (np.ndarray)
+            Mean of the pixel values within each polar bin with shape (n_points, n_r, n_theta) (NaN for empty bins).
+        polar_diff_std : (np.ndarray)
+            Standard deviation of the pixel values within each polar bin with shape (n_points, n_r, n_theta) (NaN for empty bins).
+    """
+
+    fov_shape = tuple(fov_shape)
+    r_max = float(np.sqrt(fov_shape[0]**2 + fov_shape[1]**2)) if r_max is None else float(r_max)
+    r_bins = np.linspace(0, r_max, n_r + 1)
+    n_bins = n_r * n_theta
+
+    unique_points = np.unique(all_point).astype(int)
+    polar_diff_mn = np.zeros((len(unique_points), n_bins))
+    polar_diff_std = np.zeros((len(unique_points), n_bins))
+
+    for batch_on in range(0, len(unique_points), point_batch):
+        batch_points = unique_points[batch_on:batch_on + point_batch]
+
+        all_dist_labels = []
+        all_dist_weights = []
+        for i in batch_points:
+            if use_label_lut(fov_shape, all_coords_x[i], all_coords_y[i], dist_mode):
+                dist_labels, dist_weights = slice_label_lut(get_polar_lut(fov_shape, n_r, n_theta, r_max), fov_shape, all_coords_x[i], all_coords_y[i])
+            else:
+                r_idx, c_idx = np.indices(fov_shape)
+                dist_labels, dist_weights = get_polar_labels_offsets(r_idx - all_coords_x[i], c_idx - all_coords_y[i], r_bins, n_theta)[None], np.ones(1)
+
+            all_dist_labels.append(dist_labels)
+            all_dist_weights.append(dist_weights)
+
+        # pad to the same number of taps (as in get_dist_dff)
+        n_taps = max(len(dist_weights) for dist_weights in all_dist_weights)
+        all_dist_labels = [np.concatenate([dist_labels, np.full((n_taps - len(dist_labels), *fov_shape), -1, dtype=dist_labels.dtype)]) for dist_labels in all_dist_labels]
+        all_dist_weights = [np.concatenate([dist_weights, np.zeros(n_taps - len(dist_weights))]) for dist_weights in all_dist_weights]
+
+        prof_mn, prof_std, _ = get_radial_profile(fov_map[batch_points], np.stack(all_dist_labels), n_bins, all_dist_weights=np.stack(all_dist_weights))
+
+        polar_diff_mn[batch_points] = prof_mn
+        polar_diff_std[batch_points] = prof_std
+
+    return polar_diff_mn.reshape(-1, n_r, n_theta), polar_diff_std.reshape(-1, n_r, n_theta)
+
+
+def compute_polar_kernel(polar_diff_mn, r_max, kernel_size=724):
+    """
+    Compute a (possibly anisotropic) 2D kernel from the polar profiles of get_dist_dff_polar.
+    The polar kernel is the mean across points, bins that are empty for all points (e. g. small radii at fine angles) are filled with the mean across angles at that radius,
+    and every kernel pixel is interpolated linearly in radius (between bin centres) and periodically in angle.
+
+    Parameters:
+        polar_diff_mn : (np.ndarray)
+            Polar profiles with shape (n_points, n_r, n_theta).
+        r_max : (float)
+            Maximum radius used in get_dist_dff_polar.
+        kernel_size : (int)
+            Size of the 2D kernel (default is 724), offset 0 at [kernel_size // 2, kernel_size // 2] (rows along x, columns along y).
+
+    Returns:
+        kpolar : (np.ndarray)
+            The polar kernel with shape (n_r, n_theta).
+        k2d : (np.ndarray)
+            The 2D kernel with shape (kernel_size, kernel_size) (0 beyond r_max).
+    """
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning) # mean of empty bins
+        kpolar = np.nanmean(polar_diff_mn, axis=0)
+        kpolar = np.where(np.isnan(kpolar), np.nanmean(kpolar, axis=1, keepdims=True), kpolar)
+
+    n_r, n_theta = kpolar.shape
+    r_width = r_max / n_r
+    theta_width = 2 * np.pi / n_theta
+
+    dr, dc = np.indices((kernel_size, kernel_size)) - kernel_size // 2
+    r = np.sqrt(dr ** 2 + dc ** 2)
+    theta = np.arctan2(dc, dr)
+
+    # position relative to the bin centres (clamped in radius, periodic in angle)
+    r_pos = np.clip(r / r_width - 0.5, 0, n_r - 1)
+    r0 = np.minimum(np.floor(r_pos).astype(int), max(n_r - 2, 0))
+    r1 = np.minimum(r0 + 1, n_r - 1)
+    fr = r_pos - r0
+
+    theta_pos = (theta + np.pi) / theta_width - 0.5
+    t0 = np.floor(theta_pos).astype(int)
+    ft = theta_pos - t0
+    t0, t1 = t0 % n_theta, (t0 + 1) % n_theta
+
+    k2d = (1 - fr) * ((1 - ft) * kpolar[r0, t0] + ft * kpolar[r0, t1]) + fr * ((1 - ft) * kpolar[r1, t0] + ft * kpolar[r1, t1])
+    k2d[r >= r_max] = 0
+
+    return kpolar, k2d
+
+
+def get_trial_windows(act, starts, n_timepoints, rois=None):
+    """
+    Gather windows of n_timepoints frames of the activity traces starting at the given frames, with a single fancy index of a sliding window view of the traces
+    (no per-trial copies). Frames outside of the recording are NaN.
+
+    Parameters:
+    ----------
+    act : np.ndarray
+        Activity traces (shape: (n_rois, n_frames)), e. g. from Suite2pLoader.get_act_session.
+    starts : np.ndarray
+        First frame of each window (shape: (n_trials,)).
+    n_timepoints : int
+        Number of frames per window.
+    rois : np.ndarray or None
+        If None the windows of every ROI are gathered (output shape: (n_rois, n_trials, n_timepoints)),
+        otherwise the ROI of each window (shape: (n_trials,), output shape: (n_trials, n_timepoints)).
+
+    Returns:
+    -------
+    windows : np.ndarray
+        The windows of the traces (float, NaN outside of the recording).
+    """
+
+    act = np.asarray(act)
+    starts = np.asarray(starts, dtype=int)
+    n_frames = act.shape[1]
+    dtype = np.result_type(act.dtype, np.float32)
+
+    out_shape = (act.shape[0], len(starts), n_timepoints) if rois is None else (len(starts), n_timepoints)
+    windows = np.full(out_shape, np.nan, dtype=dtype)
+
+    # 1) windows inside the recording, read from the strided view
+    inside = (starts >= 0) & (starts + n_timepoints <= n_frames)
+    if n_frames >= n_timepoints and np.any(inside):
+        act_view = np.lib.stride_tricks.sliding_window_view(act, n_timepoints, axis=1)
+        if rois is None:
+            windows[:, inside] = act_view[:, starts[inside]]
+        else:
+            windows[inside] = act_view[np.asarray(rois)[inside], starts[inside]]
+
+    # 2) windows crossing the start/end of the recording: clipped frame indices, masked with NaN
+    edge = ~inside
+    if np.any(edge):
+        frame_idxs = starts[edge][:, None] + np.arange(n_timepoints)
+        out_of_range = (frame_idxs < 0) | (frame_idxs >= n_frames)
+        frame_idxs = np.clip(frame_idxs, 0, n_frames - 1)
+        if rois is None:
+            windows[:, edge] = np.where(out_of_range, np.nan, act[:, frame_idxs])
+        else:
+            windows[edge] = np.where(out_of_range, np.nan, act[np.asarray(rois)[edge][:, None], frame_idxs])
+
+    return windows
+
+
+def get_roi_resp(act, all_frame, peristim_wind=(10, 30), bsln_n_frames=None, all_roi=None):
+    """
+    Trial-aligned responses of the ROIs around each stimulation: frames frame - peristim_wind[0] to frame + peristim_wind[1] (inclusive) of every trial (see get_trial_windows).
+
+    Parameters:
+    ----------
+    act : np.ndarray
+        Activity traces (shape: (n_rois, n_frames)), e. g. from Suite2pLoader.get_act_session.
+    all_frame : list
+        A list of frame indices of stimulation (each entry is a single trial of a single point).
+    peristim_wind : tuple
+        Number of frames before and after the stimulation frame (default is (10, 30)).
+    bsln_n_frames : int or None
+        If not None the mean of the bsln_n_frames frames before the stimulation frame is subtracted from each trial (NaN frames are ignored).
+    all_roi : np.ndarray or None
+        If None the responses of all ROIs to every trial are returned, otherwise only the response of ROI all_roi[j] to trial j (e. g. the ROI matched to the stimulated point).
+
+    Returns:
+    -------
+    roi_resp : np.ndarray
+        The responses (shape: (n_rois, n_trials, n_timepoints), or (n_trials, n_timepoints) with all_roi) with n_timepoints = peristim_wind[0] + peristim_wind[1] + 1.
+        Frames outside of the recording are NaN.
+    """
+
+    all_frame = np.asarray(all_frame, dtype=int)
+    n_timepoints = peristim_wind[0] + peristim_wind[1] + 1
+
+    roi_resp = get_trial_windows(act, all_frame - peristim_wind[0], n_timepoints, rois=all_roi)
+
+    if bsln_n_frames is not None:
+        bsln = get_trial_windows(act, all_frame - bsln_n_frames, bsln_n_frames, rois=all_roi)
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning) # mean of empty windows
+            roi_resp -= np.nanmean(bsln, axis=-1, keepdims=True)
+
+    return roi_resp
+
+
+def get_roi_resp_point_mn(roi_resp, all_point):
+    """
+    Average trial-aligned responses across the trials of each stimulation point (NaN frames are ignored, as np.nanmean).
+
+    Parameters:
+    ----------
+    roi_resp : np.ndarray
+        The responses of the ROIs to every trial (shape: (n_rois, n_trials, n_timepoints), see get_roi_resp).
+    all_point : list
+        A list of indices of the stimulated points corresponding to each stimulation.
+
+    Returns:
+    -------
+    roi_resp_point_mn : np.ndarray
+        The mean response to each point (shape: (n_rois, n_points, n_timepoints), points in np.unique(all_point) order).
+    """
+
+    unique_point, point_idx = np.unique(all_point, return_inverse=True)
+
+    # sums and counts per point with one reduceat over the trials sorted by point
+    order = np.argsort(point_idx, kind='stable')
+    group_on = np.searchsorted(point_idx[order], np.arange(len(unique_point)))
+
+    roi_resp_sorted = roi_resp[:, order]
+    valid = ~np.isnan(roi_resp_sorted)
+    resp_sum = np.add.reduceat(np.where(valid, roi_resp_sorted, 0), group_on, axis=1)
+    resp_n = np.add.reduceat(valid, group_on, axis=1)
+
+    return np.divide(resp_sum, resp_n, out=np.full(resp_sum.shape, np.nan), where=resp_n > 0)
+
+
+def get_matched_roi_resp(act, all_frame, all_point, all_point_s2p_idx, peristim_wind=(10, 30), bsln_n_frames=None):
+    """
+    Responses of the ROI matched to each stimulation point to the trials of that point, as s2p_resp of plot_response_matched_rois,
+    plot_response_matched_rois_heatmap and plot_response_matched_rois_avg.
+
+    Parameters:
+    ----------
+    act : np.ndarray
+        Activity traces (shape: (n_rois, n_frames)), e. g. from Suite2pLoader.get_act_session.
+    all_frame : list
+        A list of frame indices of stimulation (each entry is a single trial of a single point).
+    all_point : list
+        A list of indices of the stimulated points corresponding to each stimulation.
+    all_point_s2p_idx : np.ndarray
+        Index (row of act) of the ROI matched to each point (indexed by point).
+    peristim_wind : tuple
+        Number of frames before and after the stimulation frame (default is (10, 30)).
+    bsln_n_frames : int or None
+        If not None the mean of the bsln_n_frames frames before the stimulation frame is subtracted from each trial.
+
+    Returns:
+    -------
+    s2p_resp : np.ndarray
+        The responses (shape: (n_points, n_repetitions, n_timepoints)), trials of each point in the order of all_frame. Frames outside of the recording are NaN.
+    """
+
+    all_point = np.asarray(all_point).astype(int)
+    unique_point, point_counts = np.unique(all_point, return_counts=True)
+    if np.any(point_counts != point_counts[0]):
+        raise ValueError(f"All points should have the same number of repetitions, got {dict(zip(unique_point, point_counts))}")
+
+    roi_resp = get_roi_resp(act, all_frame, peristim_wind=peristim_wind, bsln_n_frames=bsln_n_frames, all_roi=np.asarray(all_point_s2p_idx)[all_point])
 
-    return k1d, k2d
\ No newline at end of file
+    order = np.argsort(all_point, kind='stable')
+    return roi_resp[order].reshape(len(unique_point), point_counts[0], -1)
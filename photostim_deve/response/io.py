@@ -2,7 +2,15 @@ import pandas as pd
 import os
 import numpy as np
 import xml.etree.ElementTree as ET
-
+import tifffile
+import sys
+import threading
+import hashlib
+import json
+import copy
+
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 from scipy.ndimage import maximum_filter1d, minimum_filter1d, gaussian_filter
 
 # i guess all can be loaded from the mark points? e.g. make a list of stimuli based on the parameters of the mark points file...22
@@ -119,228 +127,1670 @@ def mp_dict_to_stim_list(mp_dict, frame_period = 0.033602476, fov_shape=(512, 51
         stim_coords_x[i] = point_coords[int(stim_points[i]), 0]
         stim_coords_y[i] = point_coords[int(stim_points[i]), 1]
 
-    if csv_save_path is not None:
-        stim_df = pd.DataFrame({
-            'time': stim_times,
-            'frame': stim_frames,
-            'point': stim_points,
-            'x': stim_coords_x,
-            'y': stim_coords_y
-        })
-        stim_df.to_csv(csv_save_path, index=False)
-        print(f"Saved stimulation data to {csv_save_path}")
+    if csv_save_path is not None:
+        stim_df = pd.DataFrame({
+            'time': stim_times,
+            'frame': stim_frames,
+            'point': stim_points,
+            'x': stim_coords_x,
+            'y': stim_coords_y
+        })
+        stim_df.to_csv(csv_save_path, index=False)
+        print(f"Saved stimulation data to {csv_save_path}")
+
+
+    return stim_times, stim_frames, stim_points, stim_coords_x, stim_coords_y
+
+def load_photostim_protocol(csv_path):
+    """
+    Load the stimulation protocol from a CSV file.
+
+    Parameters:
+    ----------
+    csv_path : str
+        The path to the CSV file containing the stimulation protocol.
+
+    Returns:
+    -------
+    stim_times : list
+        A list of stimulation times, corresponding frame index and point index for each stimulation.
+    stim_frames : list
+        A list of frame indices for each stimulation.
+    stim_points : list
+        Index of stimulated point corresponding to each stimulation.
+    stim_coords_x : list
+        A list of x coordinates of the stimulated points in the FOV (center of spiral / median of ROI).
+    stim_coords_y : list
+        A list of y coordinates of the stimulated points in the FOV (center of spiral / median of ROI).
+    """
+    
+    stim_df = pd.read_csv(csv_path)
+
+    all_time = stim_df['time'].to_numpy()
+    all_frame = stim_df['frame'].to_numpy().astype(int)
+    all_point = stim_df['point'].to_numpy().astype(int)
+    all_coords_x = stim_df['x'].to_numpy()
+    all_coords_y = stim_df['y'].to_numpy()
+
+    return all_time, all_frame, all_point, all_coords_x, all_coords_y
+
+def get_all_tiff_paths(tiff_dir):
+    """
+    Get full tiff paths from the suite2p motion corrected tiff directory.
+    It also ensures that the tiff files are sorted correctly despite strange s2p naming conventions.
+    
+    -------------
+    
+    Parameters:
+        tiff_dir : (str)
+            Directory containing the motion corrected tiff files from suite2p.
+
+    Returns:
+        all_tiff_paths : (list) 
+            List of full paths to the tiff files, sorted by their start frame index.
+
+    """
+    
+    all_tiff_paths = [os.path.join(tiff_dir, tiff_path) for tiff_path in os.listdir(tiff_dir) if tiff_path.endswith('.tif')]
+    all_tiff_paths.sort()
+
+    # get tiff start frame index for each tiff file (string between file00 and _)
+    tiff_start_frames = [int(os.path.basename(tiff_path).split('file00')[1].split('_')[0]) for tiff_path in all_tiff_paths]
+    tiff_start_frames = np.array(tiff_start_frames)
+
+    # now resort the tiff paths and start frames
+    sort_indices = np.argsort(tiff_start_frames)
+    all_tiff_paths = [all_tiff_paths[i] for i in sort_indices]
+
+    return all_tiff_paths
+
+def get_tiff_n_frames(tiff_path):
+    """
+    Get the number of frames in a (suite2p registered) tiff file without decoding any of the pixel data.
+
+    -------------
+
+    Parameters:
+        tiff_path : (str)
+            Path to the tiff file.
+
+    Returns:
+        n_frames : (int)
+            Number of frames (pages) in the tiff file.
+
+    """
+
+    with tifffile.TiffFile(tiff_path) as tif:
+        series_shape = tif.series[0].shape
+
+    n_frames = series_shape[0] if len(series_shape) > 2 else 1
+
+    return n_frames
+
+class TiffChunk:
+
+    def __init__(self, tiff_path):
+        """
+        Open (suite2p registered) tiff file whose handle and page layout are kept, so that reading frames does not parse the page index again.
+        If the tiff data is stored uncompressed and contiguously it is memory-mapped once (no decoding at all), otherwise the pages are decoded from the open file.
+        Use close() (or a with block) to release the file.
+
+        Parameters:
+            tiff_path: str
+                path to the tiff file
+        """
+
+        self.tiff_path = tiff_path
+        self.tif = tifffile.TiffFile(tiff_path)
+        self.lock = threading.Lock() # the file handle is shared, decoding is serialised
+
+        series = self.tif.series[0]
+        self.frame_shape = tuple(series.shape[-2:])
+        self.n_frames = series.shape[0] if len(series.shape) > 2 else 1
+        self.dtype = series.dtype
+
+        # uncompressed and contiguous: map the pixel data directly (with the byte order of the file)
+        self.data = None
+        if series.dataoffset is not None:
+            self.data = np.memmap(tiff_path, mode='r', dtype=self.dtype.newbyteorder(self.tif.byteorder), offset=series.dataoffset, shape=(self.n_frames, *self.frame_shape))
+
+    def read(self, frame_idxs):
+        """
+        Reads the selected frames.
+
+        Parameters:
+            frame_idxs: array
+                indices of the frames to read (relative to the start of the tiff file)
+
+        Returns:
+            frames: array (len(frame_idxs) x height x width)
+                the selected frames, in the order given by frame_idxs
+        """
+
+        frame_idxs = np.asarray(frame_idxs, dtype=int)
+
+        if len(frame_idxs) == 0:
+            return np.zeros((0, *self.frame_shape), dtype=self.dtype)
+
+        if self.data is not None:
+            # consecutive frames (e. g. a window) are sliced instead of fancy-indexed, so they are copied only once
+            if frame_idxs[-1] - frame_idxs[0] == len(frame_idxs) - 1 and np.all(np.diff(frame_idxs) == 1):
+                return np.array(self.data[frame_idxs[0]:frame_idxs[-1] + 1], dtype=self.dtype)
+            return np.array(self.data[frame_idxs], dtype=self.dtype)
+
+        # compressed: decode only the required pages
+        with self.lock:
+            frames = self.tif.asarray(key=frame_idxs.tolist(), series=0)
+
+        return frames.reshape(len(frame_idxs), *self.frame_shape)
+
+    def close(self):
+        self.data = None
+        self.tif.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def read_tiff_frames(tiff_path, frame_idxs):
+    """
+    Read only the selected frames of a (suite2p registered) tiff file (see TiffChunk, the file is opened for this call only).
+    If the tiff data is stored uncompressed and contiguously it is memory-mapped (no decoding at all), otherwise only the pages corresponding to frame_idxs are decoded.
+
+    -------------
+
+    Parameters:
+        tiff_path : (str)
+            Path to the tiff file.
+        frame_idxs : (np.ndarray)
+            Indices of the frames to read (relative to the start of the tiff file).
+
+    Returns:
+        frames : (np.ndarray)
+            Array of shape (len(frame_idxs), height, width) with the selected frames (in the order given by frame_idxs).
+
+    """
+
+    with TiffChunk(tiff_path) as chunk:
+        return chunk.read(frame_idxs)
+
+class RegTiffMovie:
+
+    def __init__(self, all_tiff_paths):
+        """
+        Virtual movie over the (chunked) registered tiff files written by suite2p.
+        The chunks behave as one concatenated movie: global frame indices are mapped to (chunk, page) and only the pages that are indexed are read from disk,
+        so windows that cross chunk boundaries can be sliced without loading (or concatenating) whole chunks.
+        Each tiff file is opened once (TiffChunk, its page layout is needed for the number of frames) and the handle is reused by every read.
+        close() (or a with block) releases the handles, files are then reopened on the next read.
+
+        Parameters:
+            all_tiff_paths: list
+                list of paths to the tiff files, sorted by their start frame index (see get_all_tiff_paths)
+        """
+
+        self.all_tiff_paths = list(all_tiff_paths)
+        self.chunks = [None] * len(self.all_tiff_paths)
+        self.lock = threading.Lock()
+
+        frame_shape = self.get_chunk(0).frame_shape
+        self.dtype = self.get_chunk(0).dtype
+
+        self.chunk_n_frames = np.array([self.get_chunk(i).n_frames for i in range(len(self.all_tiff_paths))], dtype=int)
+        self.chunk_start = np.concatenate(([0], np.cumsum(self.chunk_n_frames)[:-1])).astype(int)
+        self.chunk_bounds = [(int(on), int(on + n)) for (on, n) in zip(self.chunk_start, self.chunk_n_frames)]
+
+        self.n_frames = int(np.sum(self.chunk_n_frames))
+        self.shape = (self.n_frames, *frame_shape)
+
+    def __len__(self):
+        return self.n_frames
+
+    def get_chunk(self, i):
+        """
+        Returns the open tiff file of chunk i (opened on first use and kept).
+
+        Parameters:
+            i: int
+                index of the chunk
+
+        Returns:
+            chunk: TiffChunk
+                the open tiff file
+        """
+
+        if self.chunks[i] is None:
+            with self.lock:
+                if self.chunks[i] is None:
+                    self.chunks[i] = TiffChunk(self.all_tiff_paths[i])
+
+        return self.chunks[i]
+
+    def close(self):
+        """
+        Closes the open tiff files (they are reopened if the movie is read again).
+        """
+
+        with self.lock:
+            for (i, chunk) in enumerate(self.chunks):
+                if chunk is not None:
+                    chunk.close()
+                self.chunks[i] = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __del__(self):
+        if hasattr(self, 'chunks'):
+            self.close()
+
+    def get_chunk_page(self, frame_idxs):
+        """
+        Maps global frame indices to the tiff chunk and the page within that chunk.
+
+        Parameters:
+            frame_idxs: array
+                global frame indices
+        
+        Returns:
+            chunk: array
+                index of the tiff file containing each frame
+            page: array
+                index of the frame within its tiff file
+        """
+
+        frame_idxs = np.asarray(frame_idxs, dtype=int)
+        chunk = np.searchsorted(self.chunk_start, frame_idxs, side='right') - 1
+        page = frame_idxs - self.chunk_start[chunk]
+
+        return chunk, page
+
+    def get_frames(self, frame_idxs):
+        """
+        Reads the selected frames (only the corresponding pages are read from each tiff file).
+
+        Parameters:
+            frame_idxs: array
+                global frame indices (negative indices count from the end as for an array)
+        
+        Returns:
+            frames: array (len(frame_idxs) x height x width)
+                the selected frames, in the order given by frame_idxs
+        """
+
+        frame_idxs = np.asarray(frame_idxs, dtype=int)
+        frame_idxs = np.where(frame_idxs < 0, frame_idxs + self.n_frames, frame_idxs)
+        if np.any((frame_idxs < 0) | (frame_idxs >= self.n_frames)):
+            raise IndexError(f"Frame index out of range for movie with {self.n_frames} frames")
+
+        chunk, page = self.get_chunk_page(frame_idxs)
+        if len(chunk) > 0 and chunk[0] == chunk[-1] and np.all(chunk == chunk[0]): # all frames in one file, no need to assemble
+            return self.get_chunk(chunk[0]).read(page)
+
+        frames = np.zeros((len(frame_idxs), *self.shape[1:]), dtype=self.dtype)
+        for i in np.unique(chunk):
+            chunk_mask = chunk == i
+            frames[chunk_mask] = self.get_chunk(i).read(page[chunk_mask])
+
+        return frames
+
+    def __getitem__(self, key):
+        if isinstance(key, tuple):
+            return self[key[0]][(slice(None), *key[1:])] if not np.isscalar(key[0]) else self[key[0]][key[1:]]
+
+        if isinstance(key, slice):
+            return self.get_frames(np.arange(self.n_frames)[key])
+
+        if np.isscalar(key):
+            return self.get_frames([key])[0]
+
+        key = np.asarray(key)
+        if key.dtype == bool:
+            key = np.where(key)[0]
+
+        return self.get_frames(key)
+
+class RegBinMovie:
+
+    def __init__(self, s2p_path, channel=1, chunk_n_frames=None):
+        """
+        Registered movie read directly from the raw int16 binary written by suite2p (data.bin / data_chan2.bin next to ops.npy) with np.memmap,
+        so frames are accessed without any decoding and the reg_tif export is not needed. Same interface as RegTiffMovie.
+
+        Parameters:
+            s2p_path: str
+                path to the suite2p plane directory (e. g. session_path/suite2p/plane0)
+            channel: int
+                1 for data.bin (reg_tif), 2 for data_chan2.bin (reg_tif_chan2)
+            chunk_n_frames: int or None
+                number of frames per chunk used to split the work across threads (see iter_window_means_chunks). None to use ops['batch_size'] (the reg_tif chunk size)
+        """
+
+        ops = np.load(os.path.join(s2p_path, 'ops.npy'), allow_pickle=True).item()
+
+        if channel == 1:
+            bin_name = 'data.bin'
+        elif channel == 2:
+            bin_name = 'data_chan2.bin'
+        else:
+            raise ValueError(f"Channel {channel} not recognized, should be 1 or 2")
+
+        self.bin_path = os.path.join(s2p_path, bin_name)
+        self.n_frames = int(ops['nframes'])
+        self.shape = (self.n_frames, int(ops['Ly']), int(ops['Lx']))
+        self.dtype = np.dtype(np.int16)
+
+        bin_size = os.path.getsize(self.bin_path)
+        if bin_size != np.prod(self.shape) * self.dtype.itemsize:
+            raise ValueError(f"Size of {self.bin_path} ({bin_size} bytes) does not match nframes x Ly x Lx from ops.npy {self.shape}")
+
+        self.data = np.memmap(self.bin_path, mode='r', dtype=self.dtype, shape=self.shape)
+
+        chunk_n_frames = int(ops.get('batch_size', 500)) if chunk_n_frames is None else chunk_n_frames
+        self.chunk_bounds = [(on, min(on + chunk_n_frames, self.n_frames)) for on in range(0, self.n_frames, chunk_n_frames)]
+
+    def __len__(self):
+        return self.n_frames
+
+    def __getitem__(self, key):
+        return self.data[key]
+
+    def close(self):
+        """
+        Nothing to release (same interface as RegTiffMovie), the memory map is released with the movie.
+        """
+
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def as_reg_movie(all_tiff_paths):
+    """
+    Returns the registered movie to read frames from: a RegTiffMovie over the list of tiff paths, or the movie itself if a RegTiffMovie or RegBinMovie is given.
+
+    -------------
+
+    Parameters:
+        all_tiff_paths : (list, RegTiffMovie or RegBinMovie)
+            List of paths to the registered tiff files (see get_all_tiff_paths) or an existing movie.
+
+    Returns:
+        movie : (RegTiffMovie or RegBinMovie)
+            The registered movie.
+
+    """
+
+    if isinstance(all_tiff_paths, (RegTiffMovie, RegBinMovie)):
+        return all_tiff_paths
+
+    return RegTiffMovie(all_tiff_paths)
+
+def parse_evoked_protocol_csv(session_path, csv_save_path=None, frame_period=0.033602476):
+    """
+    Convert the evoked stim protcol data (.npy files) to a list of stimulation times (in seconds), corresponding frame index and evoked stim type index (currently all the same, due to a single stim time) for each stimulation.
+    Also saves the stimulation protocol as a .csv file for easier loading in the future.
+
+    Parameters:
+    ----------
+    session_path : str 
+        Path to the session directory containing the .npy files with stimulation protocol data. 
+    csv_save_path : str 
+        Path to save (or load from) the converted stimulation protocol as a .csv file.
+    frame_period : float
+        Exact frame period from metadata used to convert from time to frame index. Default is 0.033602476 (for '30Hz' acquisition).
+    
+    Returns:
+    -------
+    stim_times : list
+        A list of stimulation times, corresponding frame index and evoked stim type index for each stimulation.
+    stim_frames : list
+        A list of frame indices for each stimulation.
+    stim_type : list
+        Evoked stim type index corresponding to each stimulation (currently all the same, due to a single stim time). (Equivalent of 'stim_points' in the 'resp_photostim' protocol).
+
+    """
+    
+    stim_frames = np.load(os.path.join(session_path, 'stim_times.npy')) # NOTE: here the 'stim_times.npy' file actually contains the frame indices of the stim times, not the stim times in seconds. 
+    stim_times = stim_frames * frame_period # convert from frame index to time in seconds
+    stim_type = np.load(os.path.join(session_path, 'stim_protocol.npy'))
+
+    print(f"Loaded stim_times.npy with shape {stim_times.shape} and stim_protocol.npy with shape {stim_type.shape}")
+    print(f'stim_protocol unique values: {np.unique(stim_type)}')
+    print(f'stim_times values: {stim_times}')
+
+    if csv_save_path is not None:
+        stim_df = pd.DataFrame({
+            'time': stim_times,
+            'frame': stim_frames,
+            'type': stim_type
+        })
+        stim_df.to_csv(csv_save_path, index=False)
+        print(f"Saved stimulation data to {csv_save_path}")
+
+    return stim_times, stim_frames, stim_type
+
+def get_prctile_rows(F, q, n_workers=1, block_rows=256):
+    """
+    Percentile of every row (e. g. ROI trace), as np.percentile(F, q, axis=1) (linear interpolation, same result),
+    with np.partition on blocks of rows (selection of the two neighbouring order statistics instead of a full sort), processed by n_workers threads.
+    Blocks are read in float32 unless F is float64. Rows containing NaN fall back to np.percentile.
+
+    Parameters
+    ----------------
+    F : float, 2D array
+        size [neurons x time], traces (can be memory-mapped)
+
+    q : float
+        percentile (0 to 100)
+
+    n_workers : int
+        number of threads processing row blocks concurrently (default is 1)
+
+    block_rows : int
+        number of rows per block (default is 256)
+
+    Returns
+    ----------------
+    F_prctile : float, 1D array
+        size [neurons], percentile of each row
+
+    """
+
+    n_rows, n_frames = F.shape
+    dtype = np.result_type(F.dtype, np.float32)
+
+    # the two order statistics around the (virtual) index of the percentile
+    pos = q / 100 * (n_frames - 1)
+    lo = int(np.floor(pos))
+    hi = min(lo + 1, n_frames - 1)
+    t = pos - lo
+
+    F_prctile = np.zeros(n_rows, dtype=dtype)
+
+    def prctile_block(r0):
+        block = np.array(F[r0:r0+block_rows], dtype=dtype)
+        part = np.partition(block, [lo, hi], axis=1)
+
+        # same interpolation as np.percentile (numpy's lerp)
+        (v_lo, v_hi) = (part[:, lo], part[:, hi])
+        diff = v_hi - v_lo
+        block_prctile = np.where(t >= 0.5, v_hi - diff * (1 - t), v_lo + diff * t)
+
+        nan_rows = np.isnan(block).any(axis=1)
+        if np.any(nan_rows):
+            block_prctile[nan_rows] = np.percentile(block[nan_rows], q, axis=1)
+
+        F_prctile[r0:r0+block_rows] = block_prctile
+
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        list(executor.map(prctile_block, range(0, n_rows, block_rows)))
+
+    return F_prctile
+
+class QuantileSketch:
+
+    def __init__(self, n_rows, k=512, dtype=np.float32):
+        """
+        One-pass quantile sketch of n_rows streams at once (e. g. ROI traces read in time blocks from a memory-mapped file), for percentile baselines of very long recordings.
+        Values are collected in buffers of weight 1, 2, 4, ... (Munro-Paterson / MRL compaction): a full buffer of 2k values is sorted and every other value
+        (alternating between even and odd positions) moves to the next buffer with twice the weight. All streams receive the same number of values, so the
+        compactions of all rows happen together on 2D arrays. Memory is O(k log(n / k)) per row and the rank error is at most n * log2(n / k) / (2k) (see get_rank_error_bound).
+
+        Parameters:
+            n_rows: int
+                number of streams
+            k: int
+                half size of the buffers (default is 512)
+            dtype: np.dtype
+                data type of the stored values (default is np.float32)
+        """
+
+        self.n_rows = n_rows
+        self.k = k
+        self.dtype = dtype
+
+        self.levels = [np.zeros((n_rows, 0), dtype=dtype)] # buffer of each level (weight 2**level)
+        self.offsets = [0] # alternating compaction offset of each level
+        self.n_seen = 0
+
+    def update(self, block):
+        """
+        Add a block of values to every stream.
+
+        Parameters:
+            block: array (n_rows x m)
+                next m values of each stream
+        """
+
+        block = np.asarray(block, dtype=self.dtype)
+        self.levels[0] = np.concatenate((self.levels[0], block), axis=1)
+        self.n_seen += block.shape[1]
+
+        h = 0
+        while h < len(self.levels):
+            while self.levels[h].shape[1] >= 2 * self.k:
+                full = np.sort(self.levels[h][:, :2 * self.k], axis=1)
+                self.levels[h] = self.levels[h][:, 2 * self.k:]
+
+                if h + 1 == len(self.levels):
+                    self.levels.append(np.zeros((self.n_rows, 0), dtype=self.dtype))
+                    self.offsets.append(0)
+
+                self.levels[h + 1] = np.concatenate((self.levels[h + 1], full[:, self.offsets[h]::2]), axis=1)
+                self.offsets[h] = 1 - self.offsets[h]
+            h += 1
+
+    def get_rank_error_bound(self):
+        """
+        Returns:
+            rank_error: float
+                upper bound of the rank error of get_quantile (in number of values)
+        """
+
+        return self.n_seen * (len(self.levels) - 1) / (2 * self.k)
+
+    def get_quantile(self, q):
+        """
+        Approximate percentile of every stream.
+
+        Parameters:
+            q: float
+                percentile (0 to 100)
+
+        Returns:
+            stream_prctile: array (n_rows)
+                value of rank q / 100 * (n_seen - 1) of each stream (within get_rank_error_bound ranks)
+        """
+
+        vals = np.concatenate(self.levels, axis=1)
+        weights = np.concatenate([np.full(level.shape[1], 2 ** h) for (h, level) in enumerate(self.levels)])
+
+        order = np.argsort(vals, axis=1)
+        cum_weights = np.cumsum(weights[order], axis=1)
+
+        idx = np.argmax(cum_weights > q / 100 * (self.n_seen - 1), axis=1)
+        return np.take_along_axis(vals, order, axis=1)[np.arange(self.n_rows), idx]
+
+def get_prctile_sketch(F, q, k=512, block_frames=4096):
+    """
+    Approximate percentile of every row (e. g. ROI trace) in a single pass over time blocks of F (see QuantileSketch), so that memory-mapped traces
+    of very long recordings are never loaded at once.
+
+    Parameters
+    ----------------
+    F : float, 2D array
+        size [neurons x time], traces (can be memory-mapped)
+
+    q : float
+        percentile (0 to 100)
+
+    k : int
+        half size of the sketch buffers (default is 512, larger is more accurate)
+
+    block_frames : int
+        number of frames read at once (default is 4096)
+
+    Returns
+    ----------------
+    F_prctile : float, 1D array
+        size [neurons], approximate percentile of each row
+
+    """
+
+    sketch = QuantileSketch(F.shape[0], k=k, dtype=np.result_type(F.dtype, np.float32))
+
+    for t0 in range(0, F.shape[1], block_frames):
+        sketch.update(F[:, t0:t0+block_frames])
+
+    print(f"Percentile sketch of {F.shape[1]} frames, rank error at most {sketch.get_rank_error_bound():.0f} frames ({sketch.get_rank_error_bound() / max(F.shape[1], 1) * 100:.2f}%)")
+
+    return sketch.get_quantile(q)
+
+# preprocess function to get dff (from Suite2p)
+def preprocess(F: np.ndarray, baseline: str, win_baseline: float, sig_baseline: float,
+               fs: float, prctile_baseline: float = 8, prctile_mode: str = 'partition', n_workers: int = 1) -> np.ndarray:
+    """ preprocesses fluorescence traces for spike deconvolution
+
+    baseline-subtraction with window "win_baseline"
+    
+    Parameters
+    ----------------
+
+    F : float, 2D array
+        size [neurons x time], in pipeline uses neuropil-subtracted fluorescence
+
+    baseline : str
+        setting that describes how to compute the baseline of each trace
+
+    win_baseline : float
+        window (in seconds) for max filter
+
+    sig_baseline : float
+        width of Gaussian filter in frames
+
+    fs : float
+        sampling rate per plane
+
+    prctile_baseline : float
+        percentile of trace to use as baseline if using `constant_prctile` for baseline
+
+    prctile_mode : str
+        how to compute the percentile for `constant_prctile`: 'partition' (exact, see get_prctile_rows) or 'sketch' (one pass, approximate, see get_prctile_sketch)
+
+    n_workers : int
+        number of threads computing the percentile of blocks of rows for `constant_prctile` with 'partition' (default is 1)
+    
+    Returns
+    ----------------
+
+    F : float, 2D array
+        size [neurons x time], baseline-corrected fluorescence
+
+    """
+    win = int(win_baseline * fs)
+    if baseline == "maximin":
+        Flow = gaussian_filter(F, [0., sig_baseline])
+        Flow = minimum_filter1d(Flow, win)
+        Flow = maximum_filter1d(Flow, win)
+    elif baseline == "constant":
+        Flow = gaussian_filter(F, [0., sig_baseline])
+        Flow = np.amin(Flow)
+    elif baseline == "constant_prctile":
+        if prctile_mode == 'partition':
+            Flow = get_prctile_rows(F, prctile_baseline, n_workers=n_workers)
+        elif prctile_mode == 'sketch':
+            Flow = get_prctile_sketch(F, prctile_baseline)
+        else:
+            raise ValueError(f"Invalid prctile_mode: {prctile_mode}. Should be 'partition' or 'sketch'.")
+        Flow = np.expand_dims(Flow, axis=1)
+    else:
+        Flow = 0.
+
+    F = F - Flow
+
+    return F
+
+def baseline_neu_sub(F, Fneu, tau=1.0, neucoeff=0.7, fs=30.0, baseline='maximin', sig_baseline=10.0, win_baseline=60.0, run_dcnv=False, n_workers=1, max_bytes=None, prctile_baseline=8, prctile_mode='partition'):
+    """ 
+    
+    Baseline and neuropil subtraction for fluorescence traces
+
+    The filters of the baseline only run along time, so the traces are processed in blocks of ROIs (rows), by n_workers threads,
+    each block written straight into the output. The result is identical to processing all rows at once, but the temporaries are only
+    as large as a block ('constant' uses the minimum over all ROIs and is always computed at once).
+
+    Inputs
+    ----------------
+    F : float, 2D array
+        size [neurons x time], fluorescence trace
+    
+    Fneu : float, 2D array
+        size [neurons x time], neuropil trace
+
+    n_workers : int
+        number of threads processing blocks of ROIs concurrently (default is 1), also passed to preprocess when all rows are processed at once
+
+    max_bytes : int or None
+        approximate memory budget for the temporaries of all blocks in flight (default is None, e. g. a single block per worker)
+
+    for others see preprocess()
+
+    Returns
+    ----------------
+    Fc : float, 2D array
+        size [neurons x time], baseline and neuropil-corrected fluorescence
+
+    """
+
+    ops = {'tau': tau, 'fs': fs, 'neucoeff': neucoeff,
+        'baseline': baseline, 'sig_baseline': sig_baseline, 'win_baseline': win_baseline}
+
+    print(f"dff with neuropil subtraction (neucoeff={neucoeff}) and baseline subtraction (baseline={baseline}, win_baseline={win_baseline}s, sig_baseline={sig_baseline} frames)")
+
+    def preprocess_rows(r0, r1, n_workers_rows=1):
+        Fc_rows = F[r0:r1] - ops['neucoeff'] * Fneu[r0:r1]
+
+        # baseline operation
+        return preprocess(
+            F=Fc_rows,
+            baseline=ops['baseline'],
+            win_baseline=ops['win_baseline'],
+            sig_baseline=ops['sig_baseline'],
+            fs=ops['fs'],
+            prctile_baseline=prctile_baseline,
+            prctile_mode=prctile_mode,
+            n_workers=n_workers_rows
+            )
+
+    n_rows = F.shape[0]
+    if baseline == 'constant' or (n_workers == 1 and max_bytes is None) or n_rows == 0:
+        return preprocess_rows(0, n_rows, n_workers_rows=n_workers)
+
+    # rows per block so that n_workers blocks of temporaries (Fc, gaussian, min and max filtered traces) fit in max_bytes
+    Fc = np.empty(F.shape, dtype=(F[:1, :1] - ops['neucoeff'] * Fneu[:1, :1]).dtype) # same dtype as the unblocked computation
+    row_bytes = 4 * F.shape[1] * max(Fc.itemsize, 8)
+    block_rows = int(np.ceil(n_rows / n_workers)) if max_bytes is None else int(max(1, max_bytes // (n_workers * row_bytes)))
+
+    def preprocess_block(r0):
+        r1 = min(r0 + block_rows, n_rows)
+        Fc[r0:r1] = preprocess_rows(r0, r1)
+
+    # each block writes only its own rows of the output, at most n_workers blocks are processed at once
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        list(executor.map(preprocess_block, range(0, n_rows, block_rows)))
+
+    # get spike
+    
+    return Fc
+
+class RunningExtremum:
+
+    def __init__(self, n_rows, win, mode='min', dtype=np.float32):
+        """
+        Causal running minimum (or maximum) over the last win values pushed, for n_rows traces at once.
+        Values are grouped in blocks of win frames: the extremum of a window is that of the suffix of the previous block and the prefix of the current block
+        (van Herk / Gil-Werman), so each push is O(1) amortised per trace like a monotonic deque, but vectorised across traces.
+        Before win values have been pushed the extremum is over the values available.
+
+        Parameters:
+            n_rows: int
+                number of traces
+            win: int
+                window size in frames
+            mode: str
+                'min' or 'max'
+            dtype: np.dtype
+                data type of the values
+        """
+
+        if mode not in ['min', 'max']:
+            raise ValueError(f"Invalid mode: {mode}. Should be 'min' or 'max'.")
+
+        self.win = win
+        self.ext = np.minimum if mode == 'min' else np.maximum
+        self.neutral = np.inf if mode == 'min' else -np.inf
+
+        self.block = np.full((n_rows, win), self.neutral, dtype=dtype) # values of the current block
+        self.prefix = np.full(n_rows, self.neutral, dtype=dtype) # extremum of the current block so far
+        self.prev_suffix = np.full((n_rows, win + 1), self.neutral, dtype=dtype) # prev_suffix[:, p] extremum of the previous block from position p on
+        self.pos = 0
+
+    def push(self, v):
+        """
+        Push the values of the next frame and return the extremum over the last win frames.
+
+        Parameters:
+            v: array (n_rows)
+                values of the next frame
+
+        Returns:
+            v_ext: array (n_rows)
+                extremum of each trace over the last win frames (including v)
+        """
+
+        self.block[:, self.pos] = v
+        self.prefix = self.ext(self.prefix, v)
+        v_ext = self.ext(self.prev_suffix[:, self.pos + 1], self.prefix)
+
+        self.pos += 1
+        if self.pos == self.win:
+            # block complete: its suffix extrema cover the part of the following windows that falls into it
+            self.prev_suffix[:, :self.win] = self.ext.accumulate(self.block[:, ::-1], axis=1)[:, ::-1]
+            self.prefix = np.full_like(self.prefix, self.neutral)
+            self.pos = 0
+
+        return v_ext
+
+class StreamingBaseline:
+
+    def __init__(self, n_rois, fs=30.0, neucoeff=0.7, sig_baseline=10.0, win_baseline=60.0, truncate=4.0, dtype=np.float32):
+        """
+        Online (streaming) version of baseline_neu_sub with baseline='maximin', e. g. for closed-loop experiments: frames of F and Fneu are pushed as they are recorded
+        and the neuropil and baseline corrected traces are returned with a fixed latency of get_latency() frames (the centred Gaussian, min and max filters need that many future frames).
+        The Gaussian is computed on a ring buffer of 2 * radius + 1 frames and the min/max filters with RunningExtremum. The start of the session is reflected as in the
+        offline filters (mode='reflect'), so the output matches baseline_neu_sub (exactly for the min/max filters, up to float rounding of the Gaussian) as soon as it is returned,
+        and flush() reflects the end of the session in the same way (the session must be longer than the Gaussian radius and the min/max window).
+
+        Parameters:
+            n_rois: int
+                number of ROIs
+            fs: float
+                sampling rate per plane
+            neucoeff: float
+                neuropil coefficient
+            sig_baseline: float
+                width of the Gaussian filter in frames
+            win_baseline: float
+                window (in seconds) of the min/max filters
+            truncate: float
+                truncation of the Gaussian filter in standard deviations (scipy default)
+            dtype: np.dtype
+                data type of the traces (default is np.float32, as F.npy)
+        """
+
+        self.n_rois = n_rois
+        self.neucoeff = neucoeff
+        self.dtype = np.dtype(dtype)
+
+        self.radius = int(truncate * sig_baseline + 0.5)
+        x = np.arange(-self.radius, self.radius + 1)
+        self.gauss_w = np.exp(-0.5 / sig_baseline**2 * x**2)
+        self.gauss_w /= self.gauss_w.sum()
+
+        win = int(win_baseline * fs)
+        self.half_win = (win - 1) // 2 # frames after the centre of the min/max windows
+        self.run_min = RunningExtremum(n_rois, win, mode='min', dtype=self.dtype)
+        self.run_max = RunningExtremum(n_rois, win, mode='max', dtype=self.dtype)
+
+        self.gauss_buf = np.zeros((n_rois, 2 * self.radius + 1)) # x[i - radius .. i + radius] of the next Gaussian output i
+        self.start_frames = [] # first frames, until the start of the session can be reflected
+        self.Fc_hist = deque() # neuropil corrected frames waiting for their baseline
+        self.n_in = 0 # frames pushed
+        self.n_min = 0 # values pushed to the min filter
+        self.n_max = 0 # values pushed to the max filter
+        self.n_out = 0 # frames returned
+
+    def get_latency(self):
+        """
+        Returns:
+            latency: int
+                number of frames between pushing a frame and getting its corrected value
+        """
+
+        return self.radius + 2 * self.half_win
+
+    def push_gauss(self, x, out):
+        # slide the Gaussian buffer and pass the next smoothed value on to the min filter
+        self.gauss_buf[:, :-1] = self.gauss_buf[:, 1:]
+        self.gauss_buf[:, -1] = x
+        self.push_min((self.gauss_buf @ self.gauss_w).astype(self.dtype), out)
+
+    def push_min(self, g, out):
+        v_min = self.run_min.push(g)
+        self.n_min += 1
+        if self.n_min > self.half_win:
+            self.push_max(v_min, out)
+
+    def push_max(self, m, out):
+        Flow = self.run_max.push(m)
+        self.n_max += 1
+        if self.n_max > self.half_win:
+            out.append(self.Fc_hist.popleft() - Flow)
+            self.n_out += 1
+
+    def update(self, F, Fneu):
+        """
+        Push new frames and return the corrected values of the frames that are complete.
+
+        Parameters:
+            F: array (n_rois x k)
+                fluorescence of the new frames
+            Fneu: array (n_rois x k)
+                neuropil of the new frames
+
+        Returns:
+            Fc: array (n_rois x n_done)
+                baseline and neuropil corrected fluorescence of the frames that are complete
+            frame_idxs: array (n_done)
+                indices (since the start of the session) of the returned frames
+        """
+
+        Fc_new = (np.asarray(F) - self.neucoeff * np.asarray(Fneu)).astype(self.dtype, copy=False)
+        n_out_on = self.n_out
+        out = []
+
+        for j in range(Fc_new.shape[1]):
+            x = Fc_new[:, j]
+            self.Fc_hist.append(x)
+            self.n_in += 1
+
+            if self.n_in <= self.radius:
+                self.start_frames.append(x)
+                continue
+
+            if self.n_in == self.radius + 1:
+                # reflect the start of the session (x[-k] = x[k - 1]) as mode='reflect'
+                if self.radius > 0:
+                    self.gauss_buf[:, :self.radius] = np.stack(self.start_frames[::-1], axis=1)
+                    self.gauss_buf[:, self.radius:-1] = np.stack(self.start_frames, axis=1)
+                self.gauss_buf[:, -1] = x
+                self.start_frames = []
+                self.push_min((self.gauss_buf @ self.gauss_w).astype(self.dtype), out)
+                continue
+
+            self.push_gauss(x, out)
+
+        Fc = np.stack(out, axis=1) if len(out) > 0 else np.zeros((self.n_rois, 0), dtype=self.dtype)
+        return Fc, np.arange(n_out_on, self.n_out)
+
+    def flush(self):
+        """
+        End of the session: reflect the last frames (as mode='reflect') and return the corrected values of all remaining frames.
+
+        Returns:
+            Fc: array (n_rois x n_done)
+                baseline and neuropil corrected fluorescence of the remaining frames
+            frame_idxs: array (n_done)
+                indices (since the start of the session) of the returned frames
+        """
+
+        if self.n_in <= self.radius:
+            raise ValueError(f"Cannot flush a session shorter than the Gaussian radius ({self.radius} frames)")
+
+        n_out_on = self.n_out
+        out = []
+
+        # 1) Gaussian of the last radius frames with the end reflected (x[T + j] = x[T - 1 - j])
+        tail = list(self.Fc_hist)[::-1]
+        for j in range(self.radius):
+            self.push_gauss(tail[j], out)
+
+        # 2) the reflected values at the end are already inside the min/max windows, so the remaining outputs are the extrema over the values available
+        for _ in range(self.half_win):
+            self.push_min(np.full(self.n_rois, np.inf, dtype=self.dtype), out)
+        for _ in range(self.n_in - self.n_out):
+            self.push_max(np.full(self.n_rois, -np.inf, dtype=self.dtype), out)
+
+        Fc = np.stack(out, axis=1) if len(out) > 0 else np.zeros((self.n_rois, 0), dtype=self.dtype)
+        return Fc, np.arange(n_out_on, self.n_out)
+
+def get_baseline_pad(baseline='maximin', sig_baseline=10.0, win_baseline=60.0, fs=30.0, truncate=4.0):
+    """
+    Number of frames on each side of a frame that its baseline (see preprocess) depends on, e. g. to compute the baseline on a time slice of the traces.
+
+    Parameters:
+        baseline: str
+            baseline mode (see preprocess)
+        sig_baseline: float
+            width of the Gaussian filter in frames
+        win_baseline: float
+            window (in seconds) of the min/max filters
+        fs: float
+            sampling rate per plane
+        truncate: float
+            truncation of the Gaussian filter in standard deviations (scipy default)
+
+    Returns:
+        pad: int or None
+            number of frames on each side (Gaussian radius + half window of the min and of the max filter) for 'maximin', 0 for no baseline,
+            None if the baseline depends on the whole trace ('constant', 'constant_prctile')
+    """
+
+    if baseline == 'maximin':
+        win = int(win_baseline * fs)
+        return int(truncate * sig_baseline + 0.5) + 2 * (win // 2)
+    elif baseline in ['constant', 'constant_prctile']:
+        return None
+    else:
+        return 0
+
+def baseline_neu_sub_sliced(F, Fneu, c_idxs=None, t_idxs=None, tau=1.0, neucoeff=0.7, fs=30.0, baseline='maximin', sig_baseline=10.0, win_baseline=60.0):
+    """
+    Same as baseline_neu_sub(F, Fneu)[c_idxs][:, t_idxs], but only the selected rows and the frames around t_idxs are read (e. g. from np.load(..., mmap_mode='r')).
+    The selected frames are grouped into segments padded by get_baseline_pad frames on each side (segments whose padding overlaps are merged),
+    so the baseline of every selected frame is computed on all the frames it depends on and matches the computation on the full traces.
+    Baselines that depend on the whole traces are computed on full rows: all frames of the selected rows for 'constant_prctile' (per ROI),
+    all rows and frames for 'constant' (minimum over all ROIs), so the result matches baseline_neu_sub(F, Fneu) for every mode.
+
+    Inputs
+    ----------------
+    F : float, 2D array
+        size [neurons x time], fluorescence trace (can be memory-mapped)
+
+    Fneu : float, 2D array
+        size [neurons x time], neuropil trace (can be memory-mapped)
+
+    c_idxs : array or None
+        indices (or boolean mask) of the neurons to extract. None for all neurons
+
+    t_idxs : array or None
+        indices (or boolean mask) of the frames to extract. None for all frames
+
+    for others see preprocess()
+
+    Returns
+    ----------------
+    Fc : float, 2D array
+        size [len(c_idxs) x len(t_idxs)], baseline and neuropil-corrected fluorescence
+
+    """
+
+    rows = slice(None) if c_idxs is None else np.asarray(c_idxs)
+    rows = np.where(rows)[0] if isinstance(rows, np.ndarray) and rows.dtype == bool else rows
+
+    n_frames = F.shape[1]
+    pad = get_baseline_pad(baseline=baseline, sig_baseline=sig_baseline, win_baseline=win_baseline, fs=fs)
+
+    if baseline == 'constant': # the minimum is taken over all ROIs, so the other rows are needed as well
+        Fc = baseline_neu_sub(np.asarray(F), np.asarray(Fneu), tau=tau, neucoeff=neucoeff, fs=fs, baseline=baseline, sig_baseline=sig_baseline, win_baseline=win_baseline)[rows]
+        return Fc[:, t_idxs] if t_idxs is not None else Fc
+
+    if t_idxs is None or pad is None:
+        Fc = baseline_neu_sub(np.asarray(F[rows]), np.asarray(Fneu[rows]), tau=tau, neucoeff=neucoeff, fs=fs, baseline=baseline, sig_baseline=sig_baseline, win_baseline=win_baseline)
+        return Fc[:, t_idxs] if t_idxs is not None else Fc
+
+    t_idxs = np.asarray(t_idxs)
+    t_idxs = np.where(t_idxs)[0] if t_idxs.dtype == bool else np.where(t_idxs < 0, t_idxs + n_frames, t_idxs)
+    t_unique, t_inverse = np.unique(t_idxs, return_inverse=True)
+
+    # 1) segments of selected frames whose padded ranges overlap
+    seg_breaks = np.where(np.diff(t_unique) > 2 * pad)[0] + 1
+    seg_bounds = zip(np.concatenate(([0], seg_breaks)), np.concatenate((seg_breaks, [len(t_unique)])))
+
+    print(f"dff with neuropil subtraction (neucoeff={neucoeff}) and baseline subtraction (baseline={baseline}, win_baseline={win_baseline}s, sig_baseline={sig_baseline} frames) on {len(seg_breaks) + 1} time segment(s) (padding {pad} frames)")
+
+    # 2) baseline on each padded segment, keeping only the selected frames
+    Fc = None
+    for (i_on, i_off) in seg_bounds:
+        seg_on = max(t_unique[i_on] - pad, 0)
+        seg_off = min(t_unique[i_off - 1] + pad + 1, n_frames)
+
+        Fc_seg = np.asarray(F[rows, seg_on:seg_off]) - neucoeff * np.asarray(Fneu[rows, seg_on:seg_off])
+        Fc_seg = preprocess(F=Fc_seg, baseline=baseline, win_baseline=win_baseline, sig_baseline=sig_baseline, fs=fs)
+
+        if Fc is None:
+            Fc = np.zeros((Fc_seg.shape[0], len(t_unique)), dtype=Fc_seg.dtype)
+        Fc[:, i_on:i_off] = Fc_seg[:, t_unique[i_on:i_off] - seg_on]
+
+    return Fc[:, t_inverse]
+
+STAT_COLS_NAME = 'stat_cols.npz' # columnar sidecar of stat.npy (see save_stat_columns)
+
+class StatColumns:
+
+    def __init__(self, cols, ragged_offsets, ragged_shapes=None, present=None):
+        """
+        Columnar (struct-of-arrays) version of the suite2p stat (list of per-ROI dicts).
+        Fixed-size fields (med, npix, radius, compact, ...) are arrays with one row per ROI, variable-length fields (ypix, xpix, lam, ...) are flat arrays
+        of all ROIs with CSR offsets (the values of ROI i are flat[offsets[i]:offsets[i+1]]). Variable-shape fields with more than one dimension are flattened the same way
+        with the shape of each ROI in ragged_shapes, and fields missing in some ROIs have a presence mask (missing ROIs have no values and no key in their dict).
+        Indexing with an integer returns the dict of that ROI (as stat[i]), indexing with an array or slice returns the StatColumns of the selected ROIs.
+
+        Parameters:
+            cols: dict
+                field name -> array (one row per ROI for fixed-size fields, flat array for variable-length fields)
+            ragged_offsets: dict
+                variable-length field name -> CSR offsets (length n_rois + 1)
+            ragged_shapes: dict or None
+                variable-shape field name -> shape of the values of each ROI (n_rois x ndim)
+            present: dict or None
+                name of a field missing in some ROIs -> boolean mask of the ROIs that have it (n_rois)
+        """
+
+        self.cols = cols
+        self.ragged_offsets = ragged_offsets
+        self.ragged_shapes = {} if ragged_shapes is None else ragged_shapes
+        self.present = {} if present is None else present
+        self.n_rois = len(next(iter(ragged_offsets.values()))) - 1 if len(ragged_offsets) > 0 else len(next(iter(cols.values())))
+
+    def __len__(self):
+        return self.n_rois
+
+    def keys(self):
+        return self.cols.keys()
+
+    def get_roi_value(self, key, i):
+        # value of field key for ROI i (as in stat[i][key])
+        if key not in self.ragged_offsets:
+            return self.cols[key][i]
+
+        offsets = self.ragged_offsets[key]
+        val = self.cols[key][offsets[i]:offsets[i+1]]
+        return val.reshape(self.ragged_shapes[key][i]) if key in self.ragged_shapes else val
+
+    def get_ragged(self, key):
+        """
+        Returns the values of a variable-length field split per ROI (list of arrays, None for ROIs missing the field).
+        """
+
+        return [self.get_roi_value(key, i) if key not in self.present or self.present[key][i] else None for i in range(self.n_rois)]
+
+    def __getitem__(self, key):
+        if np.isscalar(key):
+            i = int(key) + (self.n_rois if key < 0 else 0)
+            return {k: self.get_roi_value(k, i) for k in self.cols if k not in self.present or self.present[k][i]}
+
+        idxs = np.arange(self.n_rois)[key]
+
+        cols = {}
+        ragged_offsets = {}
+        for (k, v) in self.cols.items():
+            if k not in self.ragged_offsets:
+                cols[k] = v[idxs]
+                continue
+
+            # gather the CSR segments of the selected ROIs without a loop
+            offsets = self.ragged_offsets[k]
+            lens = offsets[idxs + 1] - offsets[idxs]
+            new_offsets = np.concatenate(([0], np.cumsum(lens))).astype(np.int64)
+            flat_idxs = np.repeat(offsets[idxs] - new_offsets[:-1], lens) + np.arange(new_offsets[-1])
+            cols[k] = v[flat_idxs]
+            ragged_offsets[k] = new_offsets
+
+        ragged_shapes = {k: v[idxs] for (k, v) in self.ragged_shapes.items()}
+        present = {k: v[idxs] for (k, v) in self.present.items()}
+
+        return StatColumns(cols, ragged_offsets, ragged_shapes=ragged_shapes, present=present)
+
+def stat_to_columns(stat):
+    """
+    Converts the suite2p stat (list of per-ROI dicts) to a StatColumns.
+    Fields with the same shape for all ROIs are stacked, 1D fields of varying length (e. g. ypix, xpix, lam) are stored as flat arrays with CSR offsets,
+    fields of varying shape with more than one dimension are flattened with the shape of each ROI, and fields missing in some ROIs get a presence mask.
+    Fields that cannot be stored without pickling (objects, or varying dimensions) raise a ValueError.
+
+    Parameters:
+        stat: array or list
+            list of dictionaries containing the ROI properties (one dictionary per ROI)
+
+    Returns:
+        stat_cols: StatColumns
+            columnar stat
+    """
+
+    cols = {}
+    ragged_offsets = {}
+    ragged_shapes = {}
+    present = {}
+
+    keys = list(dict.fromkeys(key for roi in stat for key in roi)) # all fields, in order of appearance
+    for key in keys:
+        key_present = np.array([key in roi for roi in stat], dtype=bool)
+        vals = [np.asarray(roi[key]) for roi in stat if key in roi]
+
+        if any(v.dtype == object for v in vals):
+            raise ValueError(f"Stat field {key} contains objects and cannot be stored in columns")
+        if any(v.ndim != vals[0].ndim for v in vals):
+            raise ValueError(f"Stat field {key} has a different number of dimensions across ROIs and cannot be stored in columns")
+
+        if all(v.shape == vals[0].shape for v in vals) and np.all(key_present):
+            cols[key] = np.stack(vals)
+            continue
+
+        # varying shapes and/or missing ROIs: flat values with CSR offsets (missing ROIs have no values)
+        lens = np.zeros(len(stat), dtype=np.int64)
+        lens[key_present] = [v.size for v in vals]
+        cols[key] = np.concatenate([v.ravel() for v in vals]) if len(vals) > 0 else np.zeros(0)
+        ragged_offsets[key] = np.concatenate(([0], np.cumsum(lens))).astype(np.int64)
+
+        if vals[0].ndim != 1:
+            shapes = np.zeros((len(stat), vals[0].ndim), dtype=np.int64)
+            shapes[key_present] = [v.shape for v in vals]
+            ragged_shapes[key] = shapes
+
+        if not np.all(key_present):
+            present[key] = key_present
+            print(f"Stat field {key} is missing in {np.sum(~key_present)} ROIs (stored with a presence mask)")
+
+    return StatColumns(cols, ragged_offsets, ragged_shapes=ragged_shapes, present=present)
+
+def save_stat_columns(s2p_path, force=False):
+    """
+    One-time conversion of stat.npy of a suite2p plane to the columnar, pickle-free sidecar stat_cols.npz (in the same directory).
+
+    Parameters:
+        s2p_path: str
+            path to the suite2p plane directory (e. g. session_path/suite2p/plane0)
+        force: bool
+            if True the sidecar is rewritten even if it is up to date
+
+    Returns:
+        stat_cols_path: str
+            path to the sidecar
+    """
+
+    stat_path = os.path.join(s2p_path, 'stat.npy')
+    stat_cols_path = os.path.join(s2p_path, STAT_COLS_NAME)
+
+    if not force and os.path.exists(stat_cols_path) and os.path.getmtime(stat_cols_path) >= os.path.getmtime(stat_path):
+        return stat_cols_path
+
+    stat_cols = stat_to_columns(np.load(stat_path, allow_pickle=True))
+
+    arrays = {f'col_{k}': v for (k, v) in stat_cols.cols.items()}
+    arrays.update({f'offsets_{k}': v for (k, v) in stat_cols.ragged_offsets.items()})
+    arrays.update({f'shapes_{k}': v for (k, v) in stat_cols.ragged_shapes.items()})
+    arrays.update({f'present_{k}': v for (k, v) in stat_cols.present.items()})
+    np.savez(stat_cols_path, **arrays)
+    print(f"Saved columnar stat ({len(stat_cols)} ROIs, {len(stat_cols.cols)} fields) to {stat_cols_path}")
+
+    return stat_cols_path
+
+def read_stat_columns(stat_cols_path):
+    """
+    Reads a stat_cols.npz sidecar written by save_stat_columns.
+
+    Parameters:
+        stat_cols_path: str
+            path to the sidecar
+
+    Returns:
+        stat_cols: StatColumns
+            columnar stat
+    """
+
+    with np.load(stat_cols_path, allow_pickle=False) as npz:
+        cols = {k[len('col_'):]: npz[k] for k in npz.files if k.startswith('col_')}
+        ragged_offsets = {k[len('offsets_'):]: npz[k] for k in npz.files if k.startswith('offsets_')}
+        ragged_shapes = {k[len('shapes_'):]: npz[k] for k in npz.files if k.startswith('shapes_')}
+        present = {k[len('present_'):]: npz[k] for k in npz.files if k.startswith('present_')}
+
+    return StatColumns(cols, ragged_offsets, ragged_shapes=ragged_shapes, present=present)
+
+def get_stat_cols_path(s2p_path):
+    """
+    Returns the path to the columnar sidecar of stat.npy if it exists and is not older than stat.npy, otherwise None.
+    """
+
+    stat_path = os.path.join(s2p_path, 'stat.npy')
+    stat_cols_path = os.path.join(s2p_path, STAT_COLS_NAME)
+
+    if os.path.exists(stat_cols_path) and (not os.path.exists(stat_path) or os.path.getmtime(stat_cols_path) >= os.path.getmtime(stat_path)):
+        return stat_cols_path
+
+    return None
+
+def load_stat(s2p_path):
+    """
+    Loads the stat of a suite2p plane, from the columnar sidecar if it exists and is up to date (see save_stat_columns), otherwise from stat.npy.
+
+    Parameters:
+        s2p_path: str
+            path to the suite2p plane directory (e. g. session_path/suite2p/plane0)
+
+    Returns:
+        stat: StatColumns or array
+            the ROI properties (both support len(stat), stat[i][key] and stat[idxs])
+    """
+
+    stat_cols_path = get_stat_cols_path(s2p_path)
+    if stat_cols_path is not None:
+        return read_stat_columns(stat_cols_path)
+
+    return np.load(os.path.join(s2p_path, 'stat.npy'), allow_pickle=True)
+
+def get_stat_field(stat, key):
+    """
+    Returns a fixed-size field of all ROIs as an array (e. g. 'med' -> (n_rois x 2)), without iterating over dicts if stat is a StatColumns.
+    Variable-length fields and fields missing in some ROIs are gathered per ROI as for stat.npy (KeyError if a ROI is missing the field).
+
+    Parameters:
+        stat: StatColumns or array
+            the ROI properties of a plane
+        key: str
+            name of the field
+
+    Returns:
+        field: array
+            the field with one row per ROI
+    """
+
+    if isinstance(stat, StatColumns) and key in stat.cols and key not in stat.ragged_offsets:
+        return stat.cols[key]
+
+    return np.array([stat[i][key] for i in range(len(stat))])
+
+class DffDiskCache:
+
+    def __init__(self, cache_dir, max_bytes=None, key_mode='stat'):
+        """
+        On-disk cache of processed activity (e. g. neuropil and baseline corrected dF/F), shared across sessions and notebooks.
+        Each entry is a float32 .npy (so it can be opened with mmap_mode='r') named by a hash of the inputs (F.npy, Fneu.npy) and the processing parameters,
+        with a .json of the inputs and parameters next to it. With max_bytes the least recently used entries (by file mtime, refreshed on every hit) are evicted.
+
+        Parameters:
+            cache_dir: str
+                directory of the cache
+            max_bytes: int or None
+                maximum total size of the cached .npy files in bytes. None for no limit
+            key_mode: str
+                'stat' to identify the inputs by path, size and mtime (fast), 'content' to hash their contents (robust to copies and touches, reads the inputs once)
+        """
+
+        if key_mode not in ['stat', 'content']:
+            raise ValueError(f"Invalid key_mode: {key_mode}. Should be 'stat' or 'content'.")
+
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.key_mode = key_mode
+
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def get_input_id(self, path):
+        # identity of an input file according to key_mode
+        if self.key_mode == 'stat':
+            st = os.stat(path)
+            return [os.path.abspath(path), st.st_size, st.st_mtime_ns]
+
+        file_hash = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 24), b''):
+                file_hash.update(block)
+        return [file_hash.hexdigest()]
+
+    def get_key(self, input_paths, params):
+        """
+        Returns the cache key of the given inputs and processing parameters.
+
+        Parameters:
+            input_paths: list
+                paths to the input files
+            params: dict
+                processing parameters (e. g. neucoeff, baseline, win_baseline, sig_baseline, fs)
+
+        Returns:
+            key: str
+                hex digest identifying the entry
+        """
+
+        key_dict = {'inputs': [self.get_input_id(path) for path in input_paths], 'params': params, 'key_mode': self.key_mode}
+        return hashlib.sha1(json.dumps(key_dict, sort_keys=True, default=str).encode()).hexdigest()
+
+    def get_path(self, key):
+        return os.path.join(self.cache_dir, f'{key}.npy')
+
+    def load(self, key, mmap_mode='r'):
+        """
+        Returns the cached array for key (memory-mapped by default) or None if it is not cached.
+        """
+
+        path = self.get_path(key)
+        if not os.path.exists(path):
+            return None
+
+        os.utime(path) # mark as recently used
+        return np.load(path, mmap_mode=mmap_mode)
+
+    def save(self, key, arr, meta=None):
+        """
+        Stores arr (as float32) under key and evicts old entries if the cache exceeds max_bytes.
+
+        Parameters:
+            key: str
+                cache key (see get_key)
+            arr: array
+                array to store
+            meta: dict or None
+                description of the entry stored next to it as .json
+        """
+
+        path = self.get_path(key)
+        tmp_path = f'{path[:-len(".npy")]}.tmp{os.getpid()}.npy' # written under a temporary name so that readers never see a partial file
+        np.save(tmp_path, np.asarray(arr, dtype=np.float32))
+        os.replace(tmp_path, path)
+
+        if meta is not None:
+            with open(os.path.join(self.cache_dir, f'{key}.json'), 'w') as f:
+                json.dump(meta, f, indent=2, default=str)
 
+        print(f"Cached {arr.shape} activity to {path}")
+        self.evict(keep=key)
 
-    return stim_times, stim_frames, stim_points, stim_coords_x, stim_coords_y
+    def evict(self, keep=None):
+        """
+        Removes the least recently used entries until the cache fits in max_bytes (the entry keep is never removed).
+        """
 
-def load_photostim_protocol(csv_path):
+        if self.max_bytes is None:
+            return
+
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith('.npy') and '.tmp' not in name:
+                st = os.stat(os.path.join(self.cache_dir, name))
+                entries.append((st.st_mtime_ns, st.st_size, name[:-len('.npy')]))
+
+        total = sum(size for (_, size, _) in entries)
+        for (_, size, key) in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+
+            os.remove(self.get_path(key))
+            meta_path = os.path.join(self.cache_dir, f'{key}.json')
+            if os.path.exists(meta_path):
+                os.remove(meta_path)
+            total -= size
+            print(f"Evicted cached activity {key} ({size / 1e6:.1f} MB)")
+
+    def clear(self):
+        """
+        Removes all entries.
+        """
+
+        for name in os.listdir(self.cache_dir):
+            if name.endswith('.npy') or name.endswith('.json'):
+                os.remove(os.path.join(self.cache_dir, name))
+
+def get_nbytes(obj):
     """
-    Load the stimulation protocol from a CSV file.
+    Approximate memory footprint of a loaded file (arrays, dicts and lists are traversed, e. g. the list of dicts in stat.npy).
 
     Parameters:
-    ----------
-    csv_path : str
-        The path to the CSV file containing the stimulation protocol.
+        obj: object
+            the loaded object
 
     Returns:
-    -------
-    stim_times : list
-        A list of stimulation times, corresponding frame index and point index for each stimulation.
-    stim_frames : list
-        A list of frame indices for each stimulation.
-    stim_points : list
-        Index of stimulated point corresponding to each stimulation.
-    stim_coords_x : list
-        A list of x coordinates of the stimulated points in the FOV (center of spiral / median of ROI).
-    stim_coords_y : list
-        A list of y coordinates of the stimulated points in the FOV (center of spiral / median of ROI).
+        nbytes: int
+            approximate number of bytes
     """
-    
-    stim_df = pd.read_csv(csv_path)
-
-    all_time = stim_df['time'].to_numpy()
-    all_frame = stim_df['frame'].to_numpy().astype(int)
-    all_point = stim_df['point'].to_numpy().astype(int)
-    all_coords_x = stim_df['x'].to_numpy()
-    all_coords_y = stim_df['y'].to_numpy()
-
-    return all_time, all_frame, all_point, all_coords_x, all_coords_y
 
-def get_all_tiff_paths(tiff_dir):
+    if isinstance(obj, np.ndarray):
+        if obj.dtype == object:
+            return obj.nbytes + sum(get_nbytes(o) for o in obj.flat)
+        return obj.nbytes
+    if isinstance(obj, dict):
+        return sys.getsizeof(obj) + sum(get_nbytes(v) for v in obj.values())
+    if isinstance(obj, (list, tuple)):
+        return sys.getsizeof(obj) + sum(get_nbytes(o) for o in obj)
+    if hasattr(obj, '__dict__'): # e. g. StatColumns
+        return sys.getsizeof(obj) + get_nbytes(vars(obj))
+    return sys.getsizeof(obj)
+
+def get_obj_copy(obj):
     """
-    Get full tiff paths from the suite2p motion corrected tiff directory.
-    It also ensures that the tiff files are sorted correctly despite strange s2p naming conventions.
-    
-    -------------
-    
+    Copy of a loaded file (arrays, dicts and lists are traversed as in get_nbytes, e. g. the list of dicts in stat.npy), much faster than copy.deepcopy on stat.npy.
+
     Parameters:
-        tiff_dir : (str)
-            Directory containing the motion corrected tiff files from suite2p.
+        obj: object
+            the loaded object
 
     Returns:
-        all_tiff_paths : (list) 
-            List of full paths to the tiff files, sorted by their start frame index.
-
+        obj_copy: object
+            copy whose arrays, dicts and lists are not shared with obj (other objects are immutable or copied with copy.deepcopy)
     """
-    
-    all_tiff_paths = [os.path.join(tiff_dir, tiff_path) for tiff_path in os.listdir(tiff_dir) if tiff_path.endswith('.tif')]
-    all_tiff_paths.sort()
 
-    # get tiff start frame index for each tiff file (string between file00 and _)
-    tiff_start_frames = [int(os.path.basename(tiff_path).split('file00')[1].split('_')[0]) for tiff_path in all_tiff_paths]
-    tiff_start_frames = np.array(tiff_start_frames)
+    if isinstance(obj, np.ndarray):
+        if obj.dtype == object:
+            obj_copy = np.empty(obj.shape, dtype=object)
+            obj_copy.flat[:] = [get_obj_copy(o) for o in obj.flat]
+            return obj_copy
+        return obj.copy()
+    if isinstance(obj, dict):
+        return {k: get_obj_copy(v) for (k, v) in obj.items()}
+    if isinstance(obj, list):
+        return [get_obj_copy(o) for o in obj]
+    if isinstance(obj, tuple):
+        return tuple(get_obj_copy(o) for o in obj)
+    if isinstance(obj, (str, bytes, int, float, complex, bool, np.generic)) or obj is None:
+        return obj
+    if hasattr(obj, '__dict__'): # e. g. StatColumns
+        obj_copy = copy.copy(obj)
+        obj_copy.__dict__ = get_obj_copy(vars(obj))
+        return obj_copy
+    return copy.deepcopy(obj)
+
+class FileCache:
+
+    def __init__(self, max_bytes=None):
+        """
+        Cache of loaded files shared across loaders (e. g. suite2p stat.npy / ops.npy), so every file is parsed once.
+        Entries are keyed on the absolute path and invalidated when the file's mtime or size changes. With max_bytes the least recently used entries are evicted.
+        Every get returns a copy of the cached object (get_obj_copy), so callers can modify arrays and dicts in place without affecting other loaders.
 
-    # now resort the tiff paths and start frames
-    sort_indices = np.argsort(tiff_start_frames)
-    all_tiff_paths = [all_tiff_paths[i] for i in sort_indices]
+        Parameters:
+            max_bytes: int or None
+                memory cap in bytes (approximate, see get_nbytes). None for no cap
+        """
 
-    return all_tiff_paths
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict() # path -> (file signature, object, nbytes)
+        self.nbytes = 0
+        self.lock = threading.Lock()
 
-def parse_evoked_protocol_csv(session_path, csv_save_path=None, frame_period=0.033602476):
-    """
-    Convert the evoked stim protcol data (.npy files) to a list of stimulation times (in seconds), corresponding frame index and evoked stim type index (currently all the same, due to a single stim time) for each stimulation.
-    Also saves the stimulation protocol as a .csv file for easier loading in the future.
+    def get(self, path, load_func):
+        """
+        Returns a copy of the cached object for path, (re)loading it with load_func(path) if it is not cached or the file changed on disk.
 
-    Parameters:
-    ----------
-    session_path : str 
-        Path to the session directory containing the .npy files with stimulation protocol data. 
-    csv_save_path : str 
-        Path to save (or load from) the converted stimulation protocol as a .csv file.
-    frame_period : float
-        Exact frame period from metadata used to convert from time to frame index. Default is 0.033602476 (for '30Hz' acquisition).
-    
-    Returns:
-    -------
-    stim_times : list
-        A list of stimulation times, corresponding frame index and evoked stim type index for each stimulation.
-    stim_frames : list
-        A list of frame indices for each stimulation.
-    stim_type : list
-        Evoked stim type index corresponding to each stimulation (currently all the same, due to a single stim time). (Equivalent of 'stim_points' in the 'resp_photostim' protocol).
+        Parameters:
+            path: str
+                path to the file
+            load_func: callable
+                function loading the file
 
-    """
-    
-    stim_frames = np.load(os.path.join(session_path, 'stim_times.npy')) # NOTE: here the 'stim_times.npy' file actually contains the frame indices of the stim times, not the stim times in seconds. 
-    stim_times = stim_frames * frame_period # convert from frame index to time in seconds
-    stim_type = np.load(os.path.join(session_path, 'stim_protocol.npy'))
+        Returns:
+            obj: object
+                copy of the loaded object (owned by the caller)
+        """
 
-    print(f"Loaded stim_times.npy with shape {stim_times.shape} and stim_protocol.npy with shape {stim_type.shape}")
-    print(f'stim_protocol unique values: {np.unique(stim_type)}')
-    print(f'stim_times values: {stim_times}')
+        path = os.path.abspath(path)
+        st = os.stat(path)
+        sig = (st.st_mtime_ns, st.st_size)
 
-    if csv_save_path is not None:
-        stim_df = pd.DataFrame({
-            'time': stim_times,
-            'frame': stim_frames,
-            'type': stim_type
-        })
-        stim_df.to_csv(csv_save_path, index=False)
-        print(f"Saved stimulation data to {csv_save_path}")
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is not None and entry[0] == sig:
+                self.entries.move_to_end(path)
+                return get_obj_copy(entry[1])
 
-    return stim_times, stim_frames, stim_type
+        obj = load_func(path)
+        nbytes = get_nbytes(obj)
 
-# preprocess function to get dff (from Suite2p)
-def preprocess(F: np.ndarray, baseline: str, win_baseline: float, sig_baseline: float,
-               fs: float, prctile_baseline: float = 8) -> np.ndarray:
-    """ preprocesses fluorescence traces for spike deconvolution
+        with self.lock:
+            if path in self.entries:
+                self.nbytes -= self.entries.pop(path)[2]
+            self.entries[path] = (sig, obj, nbytes)
+            self.nbytes += nbytes
+            self.evict()
 
-    baseline-subtraction with window "win_baseline"
-    
-    Parameters
-    ----------------
+        return get_obj_copy(obj)
 
-    F : float, 2D array
-        size [neurons x time], in pipeline uses neuropil-subtracted fluorescence
+    def evict(self):
+        # drop least recently used entries until below max_bytes (the newest entry is always kept)
+        while self.max_bytes is not None and self.nbytes > self.max_bytes and len(self.entries) > 1:
+            (_, (_, _, nbytes)) = self.entries.popitem(last=False)
+            self.nbytes -= nbytes
 
-    baseline : str
-        setting that describes how to compute the baseline of each trace
+    def set_max_bytes(self, max_bytes):
+        """
+        Changes the memory cap (evicting entries if needed).
 
-    win_baseline : float
-        window (in seconds) for max filter
+        Parameters:
+            max_bytes: int or None
+                memory cap in bytes. None for no cap
+        """
 
-    sig_baseline : float
-        width of Gaussian filter in frames
+        with self.lock:
+            self.max_bytes = max_bytes
+            self.evict()
 
-    fs : float
-        sampling rate per plane
+    def invalidate(self, path=None):
+        """
+        Drops cached entries.
 
-    prctile_baseline : float
-        percentile of trace to use as baseline if using `constant_prctile` for baseline
-    
-    Returns
-    ----------------
+        Parameters:
+            path: str or None
+                file or directory whose entries to drop (all files below a directory). None to drop everything
+        """
 
-    F : float, 2D array
-        size [neurons x time], baseline-corrected fluorescence
+        with self.lock:
+            if path is None:
+                self.entries.clear()
+                self.nbytes = 0
+                return
 
+            path = os.path.abspath(path)
+            for key in [key for key in self.entries if key == path or key.startswith(path + os.sep)]:
+                self.nbytes -= self.entries.pop(key)[2]
+
+def get_img_crops(imgs, meds, win_size=32):
     """
-    win = int(win_baseline * fs)
-    if baseline == "maximin":
-        Flow = gaussian_filter(F, [0., sig_baseline])
-        Flow = minimum_filter1d(Flow, win)
-        Flow = maximum_filter1d(Flow, win)
-    elif baseline == "constant":
-        Flow = gaussian_filter(F, [0., sig_baseline])
-        Flow = np.amin(Flow)
-    elif baseline == "constant_prctile":
-        Flow = np.percentile(F, prctile_baseline, axis=1)
-        Flow = np.expand_dims(Flow, axis=1)
-    else:
-        Flow = 0.
+    Crops of win_size x win_size pixels around the given centres (e. g. ROI medians) from a stack of images, gathered with a single fancy index of a
+    sliding window view of the zero-padded stack (no per-ROI copy loop). Crop i covers rows meds[i, 0] - win_size//2 to meds[i, 0] + win_size//2 (same for columns),
+    pixels outside of the images are 0.
 
-    F = F - Flow
+    Parameters:
+        imgs: array (n_imgs x height x width)
+            stack of images (e. g. meanImg, max_proj and meanImg_chan2 of a plane)
+        meds: array (n_rois x 2)
+            integer (y, x) centres of the crops
+        win_size: int
+            size of the crops
 
-    return F
+    Returns:
+        crops: array (n_imgs x n_rois x win_size x win_size)
+            crops of every image around every centre
+    """
 
-def baseline_neu_sub(F, Fneu, tau=1.0, neucoeff=0.7, fs=30.0, baseline='maximin', sig_baseline=10.0, win_baseline=60.0, run_dcnv=False):
-    """ 
-    
-    Baseline and neuropil subtraction for fluorescence traces
+    imgs = np.asarray(imgs, dtype=np.float64)
+    meds = np.asarray(meds, dtype=int).reshape(-1, 2)
 
-    Inputs
-    ----------------
-    F : float, 2D array
-        size [neurons x time], fluorescence trace
-    
-    Fneu : float, 2D array
-        size [neurons x time], neuropil trace
+    imgs_pad = np.pad(imgs, ((0, 0), (win_size, win_size), (win_size, win_size)))
+    windows = np.lib.stride_tricks.sliding_window_view(imgs_pad, (win_size, win_size), axis=(1, 2))
 
-    for others see preprocess()
+    return windows[:, meds[:, 0] + win_size - win_size//2, meds[:, 1] + win_size - win_size//2]
 
-    Returns
-    ----------------
-    Fc : float, 2D array
-        size [neurons x time], baseline and neuropil-corrected fluorescence
+def get_zoom_img_sessions(loaders, c_idxs=None, img_type='meanImg', win_size=32):
+    """
+    Extracts the ROI crops (see Suite2pLoader.get_zoom_img) of several sessions, e. g. for QC of thousands of ROIs at once.
+
+    Parameters:
+        loaders: list
+            Suite2pLoader of each session
+        c_idxs: list or None
+            c_idxs of each session (see Suite2pLoader.get_zoom_img). None to extract all neurons of every session
+        img_type: str or list
+            type(s) of image to extract (see Suite2pLoader.get_zoom_img)
+        win_size: int
+            size of the window around the median pixel to extract
 
+    Returns:
+        zoom_img: array
+            crops of all sessions concatenated along the ROI axis (n_cells x win_size x win_size, or len(img_type) x n_cells x win_size x win_size)
+        session_idx: array
+            index of the session of each crop
     """
 
-    ops = {'tau': tau, 'fs': fs, 'neucoeff': neucoeff,
-        'baseline': baseline, 'sig_baseline': sig_baseline, 'win_baseline': win_baseline}
+    c_idxs = [None] * len(loaders) if c_idxs is None else c_idxs
+    roi_axis = 0 if isinstance(img_type, str) else 1
 
-    print(f"dff with neuropil subtraction (neucoeff={neucoeff}) and baseline subtraction (baseline={baseline}, win_baseline={win_baseline}s, sig_baseline={sig_baseline} frames)")
+    zoom_img = [loader.get_zoom_img(c_idxs=c_idxs_i, img_type=img_type, win_size=win_size) for (loader, c_idxs_i) in zip(loaders, c_idxs)]
+    session_idx = np.concatenate([np.full(zoom_img_i.shape[roi_axis], i) for (i, zoom_img_i) in enumerate(zoom_img)])
 
-    Fc = F - ops['neucoeff'] * Fneu
+    return np.concatenate(zoom_img, axis=roi_axis), session_idx
 
-    # baseline operation
-    Fc = preprocess(
-        F=Fc,
-        baseline=ops['baseline'],
-        win_baseline=ops['win_baseline'],
-        sig_baseline=ops['sig_baseline'],
-        fs=ops['fs']
-        )
+# cache shared by all Suite2pLoader instances, capped at 1 GB by default (use S2P_FILE_CACHE.set_max_bytes to change the cap)
+S2P_FILE_CACHE = FileCache(max_bytes=2**30)
 
-    # get spike
-    
-    return Fc
+# parameters of baseline_neu_sub used by Suite2pLoader for dF/F (shared by get_act_plane and the key of the dF/F cache, fs is added per session)
+S2P_DFF_PARAMS = {'neucoeff': 0.7, 'baseline': 'maximin', 'win_baseline': 60.0, 'sig_baseline': 10.0}
 
 # Suite2p loader class (taken from 'longipy')
 class Suite2pLoader: 
 
-    def __init__(self, ds_path, fs=30, act_type='dff', n_planes=1):
+    def __init__(self, ds_path, fs=30, act_type='dff', n_planes=1, cache=None, n_workers=1, dff_cache=None):
         """
-        Loader for suite2p data.
+        Loader for suite2p data. The plane files (stat.npy, ops.npy, iscell.npy, redcell.npy) are loaded lazily on first use and kept in a FileCache.
 
         Parameters:
             ds_path: str
@@ -351,15 +1801,101 @@ class Suite2pLoader:
                 type of activity to extract. Can be 'dff' or 'spks'
             n_planes: int
                 number of planes in the session
+            cache: FileCache or None
+                cache of the loaded files. None to use the cache shared across loaders (S2P_FILE_CACHE)
+            n_workers: int
+                number of threads loading and processing planes concurrently in multi-plane sessions (default is 1, e. g. one plane after the other)
+            dff_cache: DffDiskCache or None
+                on-disk cache of the dF/F of each plane (computed once for all ROIs and frames, then read memory-mapped). None to recompute it on every call
         """
 
         self.ds_path = ds_path
         self.fs = fs
         self.act_type = act_type
         self.n_planes = n_planes
+        self.cache = S2P_FILE_CACHE if cache is None else cache
+        self.n_workers = n_workers
+        self.dff_cache = dff_cache
+
+    def map_planes(self, plane_func):
+        """
+        Applies plane_func to every plane index, with up to n_workers planes in flight in a thread pool (np.load and the scipy baseline filters release the GIL).
+        Results are returned in plane order, and at most n_workers planes are processed at once, so the intermediate memory is bounded by n_workers planes.
+
+        Parameters:
+            plane_func: callable
+                function of the plane index (0 to n_planes - 1)
+
+        Returns:
+            results: list
+                result of plane_func for each plane, in plane order
+        """
+
+        if self.n_workers == 1 or self.n_planes == 1:
+            return [plane_func(i) for i in range(self.n_planes)]
+
+        with ThreadPoolExecutor(max_workers=min(self.n_workers, self.n_planes)) as executor:
+            return list(executor.map(plane_func, range(self.n_planes)))
 
-        self.get_ops_session() # to get the number of channels
+    @property
+    def n_channels(self):
+        ops = self.get_ops_session()
+        return ops['nchannels'] if self.n_planes == 1 else ops[-1]['nchannels']
 
+    def load_plane_file(self, file_name, plane='plane0'):
+        """
+        Loads a .npy file of a plane through the cache (the file is only read again if it changed on disk).
+
+        Parameters:
+            file_name: str
+                name of the file (e. g. 'stat.npy')
+            plane: str
+                name of the plane
+
+        Returns:
+            data: array
+                the loaded array (a copy of the cached one, see FileCache)
+        """
+
+        return self.cache.get(os.path.join(self.ds_path, 'suite2p', plane, file_name), lambda path: np.load(path, allow_pickle=True))
+
+    def load_stat_plane(self, plane='plane0'):
+        """
+        Loads the stat of a plane through the cache, from the columnar sidecar stat_cols.npz if it is up to date (see save_stat_columns), otherwise from stat.npy.
+
+        Parameters:
+            plane: str
+                name of the plane
+
+        Returns:
+            stat: StatColumns or array
+                the ROI properties (a copy of the cached ones, see FileCache)
+        """
+
+        stat_cols_path = get_stat_cols_path(os.path.join(self.ds_path, 'suite2p', plane))
+        if stat_cols_path is not None:
+            return self.cache.get(stat_cols_path, read_stat_columns)
+
+        return self.load_plane_file('stat.npy', plane=plane)
+
+    def convert_stat(self, force=False):
+        """
+        Writes the columnar sidecar of stat.npy for every plane (see save_stat_columns), so that later loads skip unpickling the list of dicts.
+
+        Parameters:
+            force: bool
+                if True the sidecars are rewritten even if they are up to date
+        """
+
+        for i in range(self.n_planes):
+            save_stat_columns(os.path.join(self.ds_path, 'suite2p', f'plane{i}'), force=force)
+
+    def clear_cache(self):
+        """
+        Drops the cached files of this session (e. g. after re-running suite2p in place).
+        """
+
+        self.cache.invalidate(os.path.join(self.ds_path, 'suite2p'))
 
     def get_n_rois(self, c_idxs=None):
         """
@@ -395,20 +1931,15 @@ class Suite2pLoader:
         """
 
         if self.n_planes == 1:
-            cell = np.load(os.path.join(self.ds_path, 'suite2p', 'plane0', f'{mode}.npy'), allow_pickle=True)
+            cell = self.load_plane_file(f'{mode}.npy')
             cell_bool = cell[c_idxs, 0]
             cell_prob = cell[c_idxs, 1]
 
         elif self.n_planes > 1:
-            cell_bool = []
-            cell_prob = []
-            for i in range(self.n_planes):
-                cell = np.load(os.path.join(self.ds_path, 'suite2p', f'plane{i}', f'{mode}.npy'), allow_pickle=True)
-                cell_bool.append(cell[c_idxs[i], 0])
-                cell_prob.append(cell[c_idxs[i], 1])
+            cell = self.map_planes(lambda i: self.load_plane_file(f'{mode}.npy', plane=f'plane{i}'))
 
-            cell_bool = np.concatenate(cell_bool, axis=0)
-            cell_prob = np.concatenate(cell_prob, axis=0)
+            cell_bool = np.concatenate([cell[i][c_idxs[i], 0] for i in range(self.n_planes)], axis=0)
+            cell_prob = np.concatenate([cell[i][c_idxs[i], 1] for i in range(self.n_planes)], axis=0)
         return cell_bool, cell_prob
 
     def get_cell_plane(self, c_idxs=None):
@@ -467,7 +1998,7 @@ class Suite2pLoader:
         return s2p_idxs
 
 
-    def get_act_plane(self, c_idxs_plane=None, t_idxs_plane=None, plane='plane0'):
+    def get_act_plane(self, c_idxs_plane=None, t_idxs_plane=None, plane='plane0', mmap=True):
         """
         Extracts activity of all selected neurons in a plane.
 
@@ -478,31 +2009,46 @@ class Suite2pLoader:
                 indices of the frames to extract. None to extract all frames.
             plane: str
                 name of the plane to extract the activity from
+            mmap: bool
+                if True the activity files are memory-mapped and only the selected neurons and frames (plus the padding needed by the baseline, see baseline_neu_sub_sliced) are read.
+                If False the full files are loaded
 
         Returns:
             act_pl: array
                 activity of all selected neurons in the plane
         """
 
+        mmap_mode = 'r' if mmap else None
+
         if self.act_type == 'dff':
-            F = np.load(os.path.join(self.ds_path, 'suite2p', plane, 'F.npy'))
-            Fneu = np.load(os.path.join(self.ds_path, 'suite2p', plane, 'Fneu.npy'))
+            F = np.load(os.path.join(self.ds_path, 'suite2p', plane, 'F.npy'), mmap_mode=mmap_mode)
+            Fneu = np.load(os.path.join(self.ds_path, 'suite2p', plane, 'Fneu.npy'), mmap_mode=mmap_mode)
 
-            act_pl = baseline_neu_sub(F, Fneu, fs=self.fs)
+            print(f'Indexing activity data by t_idxs ({(len(t_idxs_plane)/F.shape[1])*100:.0f}% of frames)') if t_idxs_plane is not None else None
 
-            print(f'Indexing activity data by t_idxs ({(len(t_idxs_plane)/act_pl.shape[1])*100:.0f}% of frames)') if t_idxs_plane is not None else None
+            if self.dff_cache is not None:
+                act_pl = self.get_dff_plane_cached(plane=plane)
+                rows = np.arange(act_pl.shape[0])[c_idxs_plane] if c_idxs_plane is not None else np.arange(act_pl.shape[0])
+                cols = np.arange(act_pl.shape[1])[t_idxs_plane] if t_idxs_plane is not None else np.arange(act_pl.shape[1])
+                act_pl = np.array(act_pl[np.ix_(rows, cols)])
+            elif mmap:
+                act_pl = baseline_neu_sub_sliced(F, Fneu, c_idxs=c_idxs_plane, t_idxs=t_idxs_plane, fs=self.fs, **S2P_DFF_PARAMS)
+            else:
+                act_pl = baseline_neu_sub(F, Fneu, fs=self.fs, **S2P_DFF_PARAMS)
 
-            act_pl = act_pl[c_idxs_plane, :] if c_idxs_plane is not None else act_pl[:,:]
-            act_pl = act_pl[:, t_idxs_plane] if t_idxs_plane is not None else act_pl[:,:]
+                act_pl = act_pl[c_idxs_plane, :] if c_idxs_plane is not None else act_pl[:,:]
+                act_pl = act_pl[:, t_idxs_plane] if t_idxs_plane is not None else act_pl[:,:]
 
 
         elif self.act_type == 'spks':
-            act_pl = np.load(os.path.join(self.ds_path, 'suite2p', plane, 'spks.npy'))
+            act_pl = np.load(os.path.join(self.ds_path, 'suite2p', plane, 'spks.npy'), mmap_mode=mmap_mode)
 
             print(f'Indexing activity data by t_idxs ({(len(t_idxs_plane)/act_pl.shape[1])*100:.0f}% of frames)') if t_idxs_plane is not None else None
 
-            act_pl = act_pl[c_idxs_plane, :] if c_idxs_plane is not None else act_pl[:,:]
-            act_pl = act_pl[:, t_idxs_plane] if t_idxs_plane is not None else act_pl[:,:]
+            # rows and frames are selected together so that only the selected entries are read from the memory-mapped file
+            rows = np.arange(act_pl.shape[0])[c_idxs_plane] if c_idxs_plane is not None else np.arange(act_pl.shape[0])
+            cols = np.arange(act_pl.shape[1])[t_idxs_plane] if t_idxs_plane is not None else np.arange(act_pl.shape[1])
+            act_pl = np.array(act_pl[np.ix_(rows, cols)])
 
 
         else:
@@ -510,6 +2056,34 @@ class Suite2pLoader:
 
         return act_pl
     
+    def get_dff_plane_cached(self, plane='plane0'):
+        """
+        Returns the dF/F of all ROIs and frames of a plane from the on-disk cache (dff_cache), computing and storing it first if needed.
+        The cache key covers F.npy, Fneu.npy and the parameters of baseline_neu_sub (S2P_DFF_PARAMS and fs, as in get_act_plane).
+
+        Parameters:
+            plane: str
+                name of the plane
+
+        Returns:
+            dff: array (memory-mapped, float32)
+                dF/F of the plane (n_rois x n_frames)
+        """
+
+        input_paths = [os.path.join(self.ds_path, 'suite2p', plane, file_name) for file_name in ['F.npy', 'Fneu.npy']]
+        params = {**S2P_DFF_PARAMS, 'fs': float(self.fs)}
+        key = self.dff_cache.get_key(input_paths, params)
+
+        dff = self.dff_cache.load(key)
+        if dff is None:
+            F = np.load(input_paths[0], mmap_mode='r')
+            Fneu = np.load(input_paths[1], mmap_mode='r')
+            dff = baseline_neu_sub(F, Fneu, **params)
+            self.dff_cache.save(key, dff, meta={'inputs': input_paths, 'params': params})
+            dff = self.dff_cache.load(key)
+
+        return dff
+
     def get_act_session(self, c_idxs=None, t_idxs=None):
         """
         Extracts activity of all selected neurons in the session.
@@ -530,15 +2104,15 @@ class Suite2pLoader:
             self.act = self.get_act_plane(c_idxs_plane=c_idxs, t_idxs_plane=t_idxs, plane='plane0').squeeze()
 
         elif self.n_planes > 1:
-            act = []
-            for i in range(self.n_planes):
+            def get_act_plane_i(i):
                 print(f'Loading activity for plane{i}')
 
                 c_idxs_plane = c_idxs[i] if c_idxs is not None else None
                 t_idxs_plane = t_idxs if t_idxs is not None else None
 
-                act_pl = self.get_act_plane(c_idxs_plane=c_idxs_plane, t_idxs_plane=t_idxs_plane, plane=f'plane{i}')
-                act.append(act_pl)
+                return self.get_act_plane(c_idxs_plane=c_idxs_plane, t_idxs_plane=t_idxs_plane, plane=f'plane{i}')
+
+            act = self.map_planes(get_act_plane_i)
 
             self.act = np.concatenate(act, axis=0)
 
@@ -554,19 +2128,19 @@ class Suite2pLoader:
         
         Returns:
             stat: list or list of lists
-                list of dictionaries containing the ROI properties (one dictinoary per ROI) for each plane.
+                list of dictionaries containing the ROI properties (one dictinoary per ROI) for each plane (a StatColumns if the plane has a stat_cols.npz sidecar, see load_stat_plane).
         """
 
         if self.n_planes == 1:
-            stat = np.load(os.path.join(self.ds_path, 'suite2p', 'plane0', 'stat.npy'), allow_pickle=True)
+            stat = self.load_stat_plane()
             stat = stat[c_idxs] if c_idxs is not None else stat
 
         elif self.n_planes > 1:
-            stat = []
-            for i in range(self.n_planes):
-                stat_pl = np.load(os.path.join(self.ds_path, 'suite2p', f'plane{i}', 'stat.npy'), allow_pickle=True)
-                stat_pl = stat_pl[c_idxs[i]] if c_idxs is not None else stat_pl
-                stat.append(stat_pl)
+            def get_stat_plane_i(i):
+                stat_pl = self.load_stat_plane(plane=f'plane{i}')
+                return stat_pl[c_idxs[i]] if c_idxs is not None else stat_pl
+
+            stat = self.map_planes(get_stat_plane_i)
 
         return stat
 
@@ -580,16 +2154,10 @@ class Suite2pLoader:
         """
         
         if self.n_planes == 1:
-            ops = np.load(os.path.join(self.ds_path, 'suite2p', 'plane0', 'ops.npy'), allow_pickle=True).item()
-            self.n_channels = ops['nchannels']
+            ops = self.load_plane_file('ops.npy').item()
         
         elif self.n_planes > 1:
-            ops = []
-            print('Number of planes:', self.n_planes)
-            for i in range(self.n_planes):
-                ops_pl = np.load(os.path.join(self.ds_path, 'suite2p', f'plane{i}', 'ops.npy'), allow_pickle=True).item()
-                ops.append(ops_pl)
-                self.n_channels = ops_pl['nchannels']
+            ops = self.map_planes(lambda i: self.load_plane_file('ops.npy', plane=f'plane{i}').item())
 
         return ops
     
@@ -661,12 +2229,12 @@ class Suite2pLoader:
         stat = self.get_stat_session(c_idxs=c_idxs)
 
         if self.n_planes == 1:
-            meds = np.array([stat[i]['med'] for i in range(len(stat))])
+            meds = get_stat_field(stat, 'med')
 
         elif self.n_planes > 1: 
             meds = []
             for i in range(self.n_planes):
-                meds_pl = np.array([stat[i][j]['med'] for j in range(len(stat[i]))])
+                meds_pl = get_stat_field(stat[i], 'med')
                 meds.append(meds_pl)
         
         return meds
@@ -713,12 +2281,12 @@ class Suite2pLoader:
         stat = self.get_stat_session(c_idxs=c_idxs)
 
         if self.n_planes == 1:
-            npix = np.array([stat[i]['npix'] for i in range(len(stat))])
+            npix = get_stat_field(stat, 'npix')
 
         elif self.n_planes > 1: 
             npix = []
             for i in range(self.n_planes):
-                npix_pl = np.array([stat[i][j]['npix'] for j in range(len(stat[i]))])
+                npix_pl = get_stat_field(stat[i], 'npix')
                 npix.append(npix_pl)
 
             npix = np.concatenate(npix, axis=0)
@@ -727,61 +2295,35 @@ class Suite2pLoader:
     def get_zoom_img(self, c_idxs=None, img_type='mean', win_size=32):
         """
         Extracts the zoomed in FOV around the median pixel of the ROIs.
+        All crops of a plane (for all image types) are gathered at once from a sliding window view of the zero-padded images (see get_img_crops).
 
         Parameters:
             c_idxs: list
                 List of arrays of indices of the neurons to extract. Each list corresponds to a plane. None to extract all neurons
-            img_type: str
-                type of image to extract. Can be 'meanImg', 'meanImg_chan2' or 'max_proj'
+            img_type: str or list
+                type of image to extract. Can be 'meanImg', 'meanImg_chan2' or 'max_proj', or a list of them
             win_size: int
                 size of the window around the median pixel to extract
         
         Returns:
-            zoomin_fov: array (n_cells x win_size x win_size) or list of arrays
-                zoomed in FOV around the median pixel of the ROIs for each plane.
+            zoomin_fov: array (n_cells x win_size x win_size)
+                zoomed in FOV around the median pixel of the ROIs (all planes concatenated).
+                If img_type is a list, the crops of each image type are stacked (len(img_type) x n_cells x win_size x win_size).
         """
 
-        meds = self.get_meds_session(c_idxs=c_idxs)
-        img_load = self.get_img_session(img_type=img_type)
-        
+        img_types = [img_type] if isinstance(img_type, str) else list(img_type)
 
+        meds = self.get_meds_session(c_idxs=c_idxs)
+        img_load = [self.get_img_session(img_type=img_type_i) for img_type_i in img_types]
 
         if self.n_planes == 1:
-
-            img = np.zeros((img_load.shape[0] + 2*win_size, img_load.shape[1] + 2*win_size))
-            img[win_size:img_load.shape[0] + win_size, win_size:img_load.shape[1] + win_size] = img_load
-
-            zoom_img = np.zeros((len(meds), win_size, win_size))
-            for i in range(len(meds)):
-                y, x = meds[i]
-
-                x += win_size # account for padding
-                y += win_size
-
-                zoom_img[i, :, :] = img[y-win_size//2:y+win_size//2, x-win_size//2:x+win_size//2]
-            
+            zoom_img = get_img_crops(np.stack(img_load), meds, win_size=win_size)
 
         elif self.n_planes > 1:
-            zoom_img = []
-            for i in range(self.n_planes):
-
-                img = np.zeros((img_load[i].shape[0] + 2*win_size, img_load[i].shape[1] + 2*win_size))
-                img[win_size:img_load[i].shape[0] + win_size, win_size:img_load[i].shape[1] + win_size] = img_load[i]
-
-                zoom_img_pl = np.zeros((len(meds[i]), win_size, win_size))
-                for j in range(len(meds[i])):
-                    y, x = meds[i][j]
-
-                    x += win_size # account for padding
-                    y += win_size
-
-                    zoom_img_pl[j, :, :] = img[y-win_size//2:y+win_size//2, x-win_size//2:x+win_size//2]
-
-                zoom_img.append(zoom_img_pl)
-
-            zoom_img = np.concatenate(zoom_img, axis=0)
+            zoom_img = [get_img_crops(np.stack([img_load_i[i] for img_load_i in img_load]), meds[i], win_size=win_size) for i in range(self.n_planes)]
+            zoom_img = np.concatenate(zoom_img, axis=1)
 
-        return zoom_img
+        return zoom_img[0] if isinstance(img_type, str) else zoom_img
 
     def get_zoom_roi(self, c_idxs=None, win_size=32, force_med_recalc=False):
         """
@@ -0,0 +1,122 @@
+import warnings
+
+import numpy as np
+
+from photostim_deve.response.compute import (PointStats, compute_dist_kernel_lsq, get_dist_dff, get_dist_dff_polar, get_median_hist, iter_window_means,
+                                              iter_window_means_chunks)
+
+
+def test_compute_dist_kernel_lsq_edge_points():
+    # maps of a known isotropic kernel, stimulus points near the FOV edge (only some of them see the long offsets)
+    fov_shape = (128, 128)
+    kernel_size = 201
+    true_size = 2 * fov_shape[0] + 1
+    rr, cc = np.mgrid[:true_size, :true_size] - true_size // 2
+    k2d_true = np.exp(-np.sqrt(rr**2 + cc**2) / 40)
+
+    all_coords_x = np.array([5, 10, 120, 64, 3, 100])
+    all_coords_y = np.array([7, 118, 4, 2, 64, 110])
+    fov_map = np.zeros((len(all_coords_x),) + fov_shape)
+    for i, (x, y) in enumerate(zip(all_coords_x, all_coords_y)):
+        r0, c0 = true_size // 2 - x, true_size // 2 - y
+        fov_map[i] = k2d_true[r0:r0 + fov_shape[0], c0:c0 + fov_shape[1]]
+    fov_map[0, :20, 60:80] = np.nan # unmeasured pixels are ignored as well
+    all_point = np.repeat(np.arange(len(all_coords_x)), 3)
+
+    _, k2d = compute_dist_kernel_lsq(fov_map, all_point, all_coords_x, all_coords_y, fov_shape=fov_shape, kernel_size=kernel_size, reg=0)
+
+    crop = (true_size - kernel_size) // 2
+    k2d_true = k2d_true[crop:crop + kernel_size, crop:crop + kernel_size]
+    measured = k2d != 0
+    assert measured[kernel_size // 2, kernel_size // 2 + 90]
+    assert measured[kernel_size // 2 + 60, kernel_size // 2]
+    np.testing.assert_allclose(k2d[measured], k2d_true[measured], atol=1e-6)
+
+
+def test_dist_dff_lut_matches_exact():
+    # the default lookup table labels match the exact distances (integer, edge and sub-pixel points, NaN pixels)
+    rng = np.random.default_rng(0)
+    fov_shape = (64, 80)
+    fov_map = rng.random((4,) + fov_shape)
+    fov_map[0, :5, :5] = np.nan
+    all_coords_x = np.array([0, 10, 63.5, 64])
+    all_coords_y = np.array([3, 79, 20.25, 80])
+    all_point = np.arange(4)
+
+    for func, kwargs in [(get_dist_dff, {'n_dist_bins': 103}), (get_dist_dff_polar, {})]:
+        res_lut = func(fov_map, all_point, all_coords_x, all_coords_y, fov_shape=fov_shape, **kwargs)
+        res_exact = func(fov_map, all_point, all_coords_x, all_coords_y, fov_shape=fov_shape, dist_mode='exact', **kwargs)
+        for (a, b) in zip(res_lut, res_exact):
+            np.testing.assert_array_equal(a, b)
+
+
+def test_iter_window_means_chunk_boundaries():
+    # windows inside, across and at the edges of the chunks (and empty ones) match np.mean of the slices, serial and threaded
+    class ChunkedMovie:
+        def __init__(self, movie, chunk_n_frames):
+            self.movie = movie
+            self.shape = movie.shape
+            self.chunk_bounds = [(on, min(on + chunk_n_frames, len(movie))) for on in range(0, len(movie), chunk_n_frames)]
+
+        def __getitem__(self, key):
+            return self.movie[key]
+
+    rng = np.random.default_rng(0)
+    movie = rng.random((50, 6, 7)).astype(np.float32)
+    wind_on = np.array([0, 8, 9, 18, 25, 30, 40, 45, 12])
+    wind_off = np.array([3, 12, 11, 22, 35, 30, 50, 50, 12])
+    wind_frame = wind_on
+
+    expected = [np.mean(movie[on:off], axis=0) if off > on else None for (on, off) in zip(wind_on, wind_off)]
+
+    res = dict(iter_window_means(movie, wind_on, wind_off))
+    for n_workers in [1, 3]:
+        res_chunks = dict(iter_window_means_chunks(ChunkedMovie(movie, 10), wind_on, wind_off, wind_frame, n_workers=n_workers, wind_batch=2))
+        assert res_chunks.keys() == res.keys() == set(range(len(wind_on)))
+        for k in range(len(wind_on)):
+            if expected[k] is None:
+                assert res[k] is None and res_chunks[k] is None
+            else:
+                np.testing.assert_allclose(res[k], expected[k], rtol=1e-5)
+                np.testing.assert_allclose(res_chunks[k], expected[k], rtol=1e-5)
+
+
+def test_point_stats_matches_nanmean_nanvar():
+    rng = np.random.default_rng(0)
+    fov_shape = (5, 6)
+    all_point = np.array([0, 1, 0, 2, 0, 1, 0])
+    imgs = rng.normal(size=(len(all_point),) + fov_shape)
+    imgs[0, 0, 0] = imgs[2, 0, 0] = imgs[4, 0, 0] = imgs[6, 0, 0] = np.nan # all trials of point 0 missing a pixel
+    imgs[1, 1, 1] = np.nan
+
+    point_stats = PointStats(4, fov_shape)
+    for (point, img) in zip(all_point, imgs):
+        point_stats.update(point, img)
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning) # all-NaN pixels
+        for point in range(4): # point 3 has no trials
+            point_imgs = imgs[all_point == point]
+            np.testing.assert_array_equal(point_stats.count[point], np.sum(~np.isnan(point_imgs), axis=0))
+            np.testing.assert_allclose(point_stats.get_mean()[point], np.nanmean(point_imgs, axis=0), atol=1e-12)
+            np.testing.assert_allclose(point_stats.get_var()[point], np.nanvar(point_imgs, axis=0), atol=1e-12)
+            np.testing.assert_allclose(point_stats.get_var(ddof=1)[point], np.nanvar(point_imgs, axis=0, ddof=1), atol=1e-12)
+
+
+def test_median_hist_error_bound():
+    rng = np.random.default_rng(0)
+    for n in [9, 10]: # odd and even number of values
+        stack = rng.normal(size=(n, 20, 30)).astype(np.float32)
+        stack[:, 0, 0] = np.nan
+        stack[:3, 1, 1] = np.nan
+
+        n_bins = 64
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+            stack_md = np.nanmedian(stack, axis=0)
+            half_bin = (np.nanmax(stack, axis=0) - np.nanmin(stack, axis=0)) / (2 * n_bins)
+        stack_md_hist = get_median_hist(stack, n_bins=n_bins, tile_rows=7)
+
+        assert np.isnan(stack_md_hist[0, 0])
+        valid = ~np.isnan(stack_md)
+        assert np.all(np.abs(stack_md_hist[valid] - stack_md[valid]) <= half_bin[valid] * (1 + 1e-5) + 1e-6)
@@ -0,0 +1,188 @@
+import os
+import time
+
+import numpy as np
+import pytest
+import tifffile
+
+from photostim_deve.response.io import (DffDiskCache, FileCache, QuantileSketch, RegBinMovie, RegTiffMovie, StreamingBaseline, baseline_neu_sub, get_stat_field,
+                                        load_stat, save_stat_columns, stat_to_columns)
+
+
+def test_stat_columns_heterogeneous(tmp_path):
+    # ROIs with ragged pixels, a 2D field of varying shape, a field missing in some ROIs and one only in the last ROI
+    rng = np.random.default_rng(0)
+    stat = []
+    for i in range(5):
+        npix = 3 + i
+        roi = {'ypix': rng.integers(0, 512, npix), 'xpix': rng.integers(0, 512, npix), 'lam': rng.random(npix).astype(np.float32),
+               'med': [i, 2 * i], 'npix': npix, 'patch': rng.random((2, i + 1))}
+        if i % 2 == 0:
+            roi['inmerge'] = 0.5 * i
+        if i == 4:
+            roi['imerge'] = [1, 2, 3]
+        stat.append(roi)
+    np.save(os.path.join(tmp_path, 'stat.npy'), np.array(stat, dtype=object))
+
+    stat_npy = load_stat(str(tmp_path))
+    save_stat_columns(str(tmp_path))
+    stat_cols = load_stat(str(tmp_path))
+    assert not isinstance(stat_npy, type(stat_cols))
+
+    assert len(stat_cols) == len(stat_npy)
+    for idxs in [slice(None), np.array([4, 0, 2]), np.array([1, 3])]:
+        sub_cols = stat_cols[idxs]
+        sub_npy = stat_npy[idxs]
+        for i in range(len(sub_npy)):
+            assert sub_cols[i].keys() == sub_npy[i].keys()
+            for key in sub_npy[i]:
+                np.testing.assert_array_equal(sub_cols[i][key], sub_npy[i][key])
+        for key in ['med', 'npix']:
+            np.testing.assert_array_equal(get_stat_field(sub_cols, key), get_stat_field(sub_npy, key))
+
+    # fields missing in some ROIs cannot be gathered for all ROIs, in both formats
+    for stat in [stat_npy, stat_cols]:
+        with pytest.raises(KeyError):
+            get_stat_field(stat, 'inmerge')
+    np.testing.assert_array_equal(get_stat_field(stat_cols[[0, 2, 4]], 'inmerge'), get_stat_field(stat_npy[[0, 2, 4]], 'inmerge'))
+
+def test_stat_to_columns_raises_on_objects():
+    with pytest.raises(ValueError):
+        stat_to_columns([{'npix': 1, 'meta': {'a': 1}}, {'npix': 2, 'meta': {'a': 2}}])
+    with pytest.raises(ValueError):
+        stat_to_columns([{'patch': np.zeros(3)}, {'patch': np.zeros((2, 2))}])
+
+
+def test_reg_movies_indexing(tmp_path):
+    # chunked tiffs and the suite2p binary behave as the concatenated array
+    rng = np.random.default_rng(0)
+    movie = rng.integers(-1000, 1000, (23, 8, 9)).astype(np.int16)
+
+    all_tiff_paths = []
+    for (i, on) in enumerate(range(0, len(movie), 10)):
+        all_tiff_paths.append(os.path.join(tmp_path, f'file{i:03d}_chan0.tif'))
+        tifffile.imwrite(all_tiff_paths[-1], movie[on:on + 10], photometric='minisblack')
+
+    np.save(os.path.join(tmp_path, 'ops.npy'), {'nframes': len(movie), 'Ly': movie.shape[1], 'Lx': movie.shape[2], 'batch_size': 10})
+    movie.tofile(os.path.join(tmp_path, 'data.bin'))
+
+    keys = [5, -1, slice(None), slice(8, 13), slice(18, 3, -2), np.array([22, 0, 10, 10, 9]), np.arange(len(movie)) % 3 == 0, (slice(9, 12), 2), (4, slice(1, 3))]
+    with RegTiffMovie(all_tiff_paths) as tiff_movie, RegBinMovie(str(tmp_path)) as bin_movie:
+        for reg_movie in [tiff_movie, bin_movie]:
+            assert reg_movie.shape == movie.shape and len(reg_movie) == len(movie)
+            assert reg_movie.chunk_bounds == [(0, 10), (10, 20), (20, 23)]
+            for key in keys:
+                np.testing.assert_array_equal(reg_movie[key], movie[key])
+
+        with pytest.raises(IndexError):
+            tiff_movie[len(movie)]
+
+    np.testing.assert_array_equal(tiff_movie[8:13], movie[8:13]) # files are reopened after close
+
+
+def test_streaming_baseline_matches_offline():
+    rng = np.random.default_rng(0)
+    n_rois, n_frames = 4, 400
+    F = (100 + np.cumsum(rng.normal(size=(n_rois, n_frames)), axis=1)).astype(np.float32)
+    Fneu = (50 + rng.normal(size=(n_rois, n_frames))).astype(np.float32)
+    params = {'neucoeff': 0.7, 'fs': 10.0, 'sig_baseline': 3.0, 'win_baseline': 5.0}
+
+    Fc = baseline_neu_sub(F, Fneu, baseline='maximin', **params)
+
+    streaming = StreamingBaseline(n_rois, **params)
+    Fc_stream = np.full(F.shape, np.nan, dtype=np.float32)
+    for on in range(0, n_frames, 7): # blocks of frames as they are recorded
+        Fc_block, frame_idxs = streaming.update(F[:, on:on + 7], Fneu[:, on:on + 7])
+        n_pushed = min(on + 7, n_frames)
+        assert len(frame_idxs) == 0 or frame_idxs[-1] == n_pushed - 1 - streaming.get_latency()
+        Fc_stream[:, frame_idxs] = Fc_block
+    Fc_block, frame_idxs = streaming.flush()
+    Fc_stream[:, frame_idxs] = Fc_block
+
+    np.testing.assert_allclose(Fc_stream, Fc, rtol=1e-4, atol=1e-3)
+
+
+def test_quantile_sketch_error_bound():
+    rng = np.random.default_rng(0)
+    n_rows, k = 3, 16
+    vals = rng.normal(size=(n_rows, 2000)).astype(np.float32)
+
+    sketch = QuantileSketch(n_rows, k=k)
+    for on in range(0, vals.shape[1], 37):
+        sketch.update(vals[:, on:on + 37])
+    assert len(sketch.levels) > 1 # compactions happened
+
+    rank_error = sketch.get_rank_error_bound()
+    vals_sorted = np.sort(vals, axis=1)
+    for q in [1, 8, 50, 99]:
+        approx = sketch.get_quantile(q)
+        for i in range(n_rows):
+            rank = q / 100 * (vals.shape[1] - 1)
+            ranks = np.searchsorted(vals_sorted[i], approx[i], side='left'), np.searchsorted(vals_sorted[i], approx[i], side='right') - 1
+            assert ranks[0] - rank_error <= rank <= ranks[1] + rank_error + 1
+
+
+def test_file_cache_invalidation(tmp_path):
+    path = os.path.join(tmp_path, 'ops.npy')
+    np.save(path, {'nframes': 10, 'meanImg': np.zeros(3)})
+    n_loads = []
+    def load_func(path):
+        n_loads.append(path)
+        return np.load(path, allow_pickle=True).item()
+
+    cache = FileCache()
+    ops = cache.get(path, load_func)
+    ops['meanImg'][0] = 1 # callers own a copy
+    assert cache.get(path, load_func)['meanImg'][0] == 0
+    assert len(n_loads) == 1
+
+    time.sleep(0.01)
+    np.save(path, {'nframes': 20, 'meanImg': np.zeros(4)}) # changed on disk
+    assert cache.get(path, load_func)['nframes'] == 20
+    assert len(n_loads) == 2
+
+    cache.invalidate(str(tmp_path))
+    cache.get(path, load_func)
+    assert len(n_loads) == 3
+
+    cache.set_max_bytes(1) # the newest entry is always kept
+    other_path = os.path.join(tmp_path, 'stat.npy')
+    np.save(other_path, {'npix': np.arange(100)})
+    cache.get(other_path, load_func)
+    assert list(cache.entries) == [os.path.abspath(other_path)]
+
+
+def test_dff_disk_cache_keys_and_eviction(tmp_path):
+    cache_dir = os.path.join(tmp_path, 'cache')
+    F_path = os.path.join(tmp_path, 'F.npy')
+    np.save(F_path, np.zeros((2, 10), dtype=np.float32))
+    params = {'neucoeff': 0.7, 'baseline': 'maximin'}
+
+    for key_mode in ['stat', 'content']:
+        cache = DffDiskCache(cache_dir, key_mode=key_mode)
+        key = cache.get_key([F_path], params)
+        assert key == cache.get_key([F_path], dict(params))
+        assert key != cache.get_key([F_path], {**params, 'neucoeff': 0.8})
+
+    # same contents with a new mtime: new key by stat, same key by content
+    keys_before = [DffDiskCache(cache_dir, key_mode=key_mode).get_key([F_path], params) for key_mode in ['stat', 'content']]
+    st = os.stat(F_path)
+    os.utime(F_path, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+    keys_after = [DffDiskCache(cache_dir, key_mode=key_mode).get_key([F_path], params) for key_mode in ['stat', 'content']]
+    assert keys_before[0] != keys_after[0] and keys_before[1] == keys_after[1]
+
+    arr = np.ones((2, 100), dtype=np.float32)
+    cache = DffDiskCache(os.path.join(tmp_path, 'lru'), max_bytes=2 * (arr.nbytes + 128) + 10) # room for 2 entries (.npy header is 128 bytes)
+    assert cache.load('a') is None
+    for (i, key) in enumerate(['a', 'b', 'c']):
+        cache.save(key, arr * i)
+        st = os.stat(cache.get_path(key))
+        os.utime(cache.get_path(key), ns=(st.st_atime_ns, 10**18 + i * 10**9)) # distinct mtimes
+        if key == 'b':
+            cache.load('a') # a is now the most recently used
+            st = os.stat(cache.get_path('a'))
+            os.utime(cache.get_path('a'), ns=(st.st_atime_ns, 10**18 + 5 * 10**9))
+
+    assert cache.load('b') is None # least recently used entry was evicted
+    np.testing.assert_array_equal(cache.load('a'), arr * 0)
+    np.testing.assert_array_equal(cache.load('c'), arr * 2)